@@ -10,6 +10,11 @@ DEFAULT_AGENT_CONFIG = {
     "lustre_client_root": "/mnt/lustre_clients",
     "copytool_fifo_directory": "/var/spool",
     "copytool_template": "--quiet --update-interval %(report_interval)s --event-fifo %(event_fifo)s --archive %(archive_number)s %(hsm_arguments)s %(mountpoint)s",
+    "outbound_spool_directory": "/var/spool/chroma-agent",
+    "outbound_spool_max_bytes": 0,  # 0 disables spooling of undelivered messages
+    "lustre_sample_period": 0,  # Seconds between samples of Lustre counters, 0 samples at each scan
+    "network_counter_period": 60,  # Seconds between reports of interface counters, 0 disables them
+    "network_change_listener": True,  # Report link and address changes as they happen, not just at polls
 }
 
 PRODUCTION_CONFIG_STORE = "/var/lib/chroma"
@@ -4,32 +4,83 @@
 
 
 import Queue
-from collections import defaultdict
+from collections import defaultdict, deque
+import functools
 import json
 import socket
 import threading
 import traceback
 import datetime
 import sys
+import time
+import zlib
 from chroma_agent.plugin_manager import (
     DevicePluginMessageCollection,
     DevicePluginMessage,
     PRIO_HIGH,
+    PRIO_NORMAL,
+    PRIO_LOW,
 )
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from chroma_agent import version
 from chroma_agent.log import daemon_log, console_log, logging_in_debug_mode
+from chroma_agent.lib.scheduler import Scheduler
+from chroma_agent.lib.priority_queue import AgingPriorityQueue
+from chroma_agent.lib import tree_delta
+from chroma_agent.lib.backoff import (
+    DecorrelatedJitter,
+    phase_offset,
+    next_phase,
+    parse_retry_after,
+)
 from iml_common.lib.date_time import IMLDateTime
-from iml_common.lib.util import ExceptionThrowingThread
 
 MAX_BYTES_PER_POST = 8 * 1024 ** 2  # 8MiB, should be <= SSLRenegBufferSize
 
+# POST bodies smaller than this are sent as plain JSON, larger ones are gzip compressed if the manager
+# accepts that (see HttpWriter.compress)
+COMPRESSION_THRESHOLD = 4 * 1024
+COMPRESSION_LEVEL = 6
+
+# Bounds of the jittered wait between session requests, see DecorrelatedJitter
 MIN_SESSION_BACKOFF = datetime.timedelta(seconds=10)
 MAX_SESSION_BACKOFF = datetime.timedelta(seconds=60)
 
+# Threads shared by all device plugins for running their polls
+PLUGIN_POLL_WORKERS = 4
+# Bounds of the jittered wait before retrying a failed POST (undelivered messages are spooled or requeued)
+MIN_POST_RETRY_PERIOD = 1.0
+MAX_POST_RETRY_PERIOD = 60.0
+
+# Seconds a queued message may wait before it is sent ahead of higher priority messages
+MESSAGE_MAX_WAIT = 30.0
+
+# Seconds after starting that messages spooled by a previous run of the agent wait for their plugin's new
+# session, after which those still waiting are discarded, see HttpWriter.restore()
+RESTORED_SPOOL_WAIT = 300.0
+
+# Posted DATA messages kept per session until the manager acknowledges them, so that they can be sent
+# again after a failure.  A session which has to drop unacknowledged messages can no longer be resumed.
+REPLAY_BUFFER_BYTES = 8 * 1024 ** 2
+
+# How often a plugin without a session is polled, so that it requests one (subject to backoff) or starts
+# its session promptly once the manager creates it.
+SESSION_REQUEST_POLL_PERIOD = 1.0
+
 GET_REQUEST_TIMEOUT = 60.0
 POST_REQUEST_TIMEOUT = 60.0
 
+# Keep-alive connections held open to the manager.  The reader long poll and the writer each hold one, so
+# anything above 2 is headroom for the odd concurrent request.
+HTTP_POOL_SIZE = 4
+# Drop the pool (and so close its connections) if nothing has used it for this many seconds.
+HTTP_IDLE_TIMEOUT = 300.0
+# Attempts to re-establish a connection that fails to connect, before reporting an HttpError.  Only connection
+# establishment is retried: a request that may have reached the manager is never resent here.
+HTTP_CONNECT_RETRIES = 2
+
 # FIXME: this file needs a concurrency review pass
 
 
@@ -41,6 +92,95 @@ class CryptoClient(object):
         if not self.fqdn:
             self.fqdn = socket.getfqdn()
 
+        # A single requests.Session is shared by every thread using this client so that TCP connections (and
+        # the TLS session negotiated with our client certificate) are reused between requests.
+        self._http_lock = threading.Lock()
+        self._http_session = None
+        self._http_last_used = None
+        # Counters from pools that have since been closed, so that stats survive a reconnect.
+        self._retired_stats = {"handshakes": 0, "requests": 0, "resets": 0}
+
+    def _new_http_session(self):
+        http_session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=Retry(total=HTTP_CONNECT_RETRIES, read=False),
+        )
+        http_session.mount("https://", adapter)
+        http_session.mount("http://", adapter)
+
+        return http_session
+
+    def _pool_counts(self, http_session):
+        """Return the (new connections, requests) made so far through the pools of http_session"""
+        connections = requests_made = 0
+
+        for adapter in set(http_session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                try:
+                    pool = pools[key]
+                except KeyError:
+                    continue
+                connections += pool.num_connections
+                requests_made += pool.num_requests
+
+        return connections, requests_made
+
+    def _close_http_session(self):
+        """Close the current pool, if any.  Must be called with _http_lock held."""
+        if self._http_session is not None:
+            connections, requests_made = self._pool_counts(self._http_session)
+            self._retired_stats["handshakes"] += connections
+            self._retired_stats["requests"] += requests_made
+            self._retired_stats["resets"] += 1
+            self._http_session.close()
+            self._http_session = None
+
+    def _get_http_session(self):
+        with self._http_lock:
+            now = time.time()
+            if (
+                self._http_session is not None
+                and now - self._http_last_used > HTTP_IDLE_TIMEOUT
+            ):
+                daemon_log.debug("Closing idle connections to %s" % self.url)
+                self._close_http_session()
+
+            if self._http_session is None:
+                self._http_session = self._new_http_session()
+
+            self._http_last_used = now
+
+            return self._http_session
+
+    def reset_connections(self):
+        """Close all pooled connections, the next request will reconnect"""
+        with self._http_lock:
+            self._close_http_session()
+
+        daemon_log.debug(
+            "Connection stats for %s: %s" % (self.url, self.connection_stats)
+        )
+
+    @property
+    def connection_stats(self):
+        """
+        :return: dict of 'handshakes' (new connections made), 'requests' (requests sent), 'reused' (requests
+                 sent over an existing connection) and 'resets' (times the pool has been thrown away)
+        """
+        with self._http_lock:
+            stats = dict(self._retired_stats)
+            if self._http_session is not None:
+                connections, requests_made = self._pool_counts(self._http_session)
+                stats["handshakes"] += connections
+                stats["requests"] += requests_made
+
+        stats["reused"] = max(0, stats["requests"] - stats["handshakes"])
+
+        return stats
+
     def get(self, **kwargs):
         kwargs["timeout"] = GET_REQUEST_TIMEOUT
         return self.request("get", **kwargs)
@@ -49,18 +189,28 @@ class CryptoClient(object):
         kwargs["timeout"] = POST_REQUEST_TIMEOUT
         return self.request("post", data=json.dumps(data), **kwargs)
 
+    def post_encoded(self, body, content_encoding=None, **kwargs):
+        """POST a body that has already been JSON encoded, and compressed if content_encoding is given"""
+        kwargs["timeout"] = POST_REQUEST_TIMEOUT
+        if content_encoding:
+            kwargs["headers"] = {"Content-Encoding": content_encoding}
+        return self.request("post", data=body, **kwargs)
+
     def request(self, method, **kwargs):
         cert, key = self._crypto.certificate_file, self._crypto.private_key_file
         if cert:
             kwargs["cert"] = (cert, key)
 
+        headers = {"Content-Type": "application/json"}
+        headers.update(kwargs.pop("headers", {}))
+
         try:
-            response = requests.request(
+            response = self._get_http_session().request(
                 method,
                 self.url,
                 # FIXME: set verify to true if we have a CA bundle
                 verify=False,
-                headers={"Content-Type": "application/json"},
+                headers=headers,
                 **kwargs
             )
         except (
@@ -70,6 +220,8 @@ class CryptoClient(object):
             requests.exceptions.SSLError,
         ) as e:
             daemon_log.error("Error connecting to %s: %s" % (self.url, e))
+            # The pooled connections may be dead (e.g. the manager restarted), start afresh next time.
+            self.reset_connections()
             raise HttpError()
         except Exception as e:
             # If debugging is enabled meaning we are in test for example then raise the error again and the app
@@ -80,6 +232,7 @@ class CryptoClient(object):
             if logging_in_debug_mode:
                 raise
 
+            self.reset_connections()
             raise HttpError()
 
         if not response.ok:
@@ -87,14 +240,134 @@ class CryptoClient(object):
                 "Bad status %s from %s to %s" % (response.status_code, method, self.url)
             )
             if response.status_code == 413:
-                daemon_log.error("Oversized request: %s" % json.dumps(kwargs, indent=2))
-            raise HttpError()
+                daemon_log.error(
+                    "Oversized request: %s bytes" % len(kwargs.get("data") or "")
+                )
+            raise HttpError(
+                status_code=response.status_code,
+                retry_after=parse_retry_after(response.headers.get("Retry-After")),
+            )
         try:
             return response.json()
         except ValueError:
             return None
 
 
+class PostBody(object):
+    """
+    Assemble the JSON body of a single POST from messages that have already been serialized.
+
+    Once the body grows past COMPRESSION_THRESHOLD it is gzip compressed as it is built, and the
+    MAX_BYTES_PER_POST limit is applied to the bytes that will actually be sent.
+    """
+
+    # gzip header and trailer, which are not covered by the deflate bound
+    GZIP_OVERHEAD = 18
+
+    def __init__(self, envelope, limit=None, threshold=None, compress=True):
+        """
+        :param envelope: dict of the fields other than 'messages' to include in the body
+        :param limit: Maximum size of the body, defaults to MAX_BYTES_PER_POST
+        :param threshold: Size at which to start compressing, defaults to COMPRESSION_THRESHOLD
+        :param compress: False to never compress the body
+        """
+        self._limit = MAX_BYTES_PER_POST if limit is None else limit
+        self._threshold = COMPRESSION_THRESHOLD if threshold is None else threshold
+        self._compress_allowed = compress
+
+        prefix = json.dumps(envelope)[:-1]
+        self._prefix = prefix + (', "messages": [' if envelope else '"messages": [')
+        self._suffix = "]}"
+
+        self._chunks = [self._prefix]
+        self._raw_length = len(self._prefix)
+        self._compressor = None
+        self._compressed_length = 0
+        # Bytes passed to the compressor since it was last flushed, its output for them may still be buffered
+        self._unflushed = 0
+
+        self.count = 0
+
+    @staticmethod
+    def _deflate_bound(length):
+        """Worst case size of length bytes once deflated, as zlib's deflateBound()"""
+        return length + (length >> 12) + (length >> 14) + (length >> 25) + 13
+
+    def _size_bound(self, extra):
+        """Upper bound for the size of the finished body if extra bytes were added to it"""
+        if self._compressor is None:
+            return self._raw_length + extra + len(self._suffix)
+        else:
+            return (
+                self._compressed_length
+                + self._deflate_bound(self._unflushed + extra + len(self._suffix))
+                + self.GZIP_OVERHEAD
+            )
+
+    def _compress(self, data, flush_mode=None):
+        output = self._compressor.compress(data)
+        self._unflushed += len(data)
+
+        if flush_mode is not None:
+            output += self._compressor.flush(flush_mode)
+            self._unflushed = 0
+
+        self._chunks.append(output)
+        self._compressed_length += len(output)
+
+    def _write(self, data):
+        self._raw_length += len(data)
+
+        if self._compressor is not None:
+            self._compress(data)
+        else:
+            self._chunks.append(data)
+
+            if self._compress_allowed and self._raw_length >= self._threshold:
+                self._compressor = zlib.compressobj(
+                    COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+                )
+                raw = "".join(self._chunks)
+                self._chunks = []
+                self._compress(raw)
+
+    def add(self, fragment):
+        """
+        Append a serialized message to the body.  The first message is always accepted.
+
+        :return: False (leaving the body unchanged) if the message would take the body over the size limit
+        """
+        data = ", " + fragment if self.count else fragment
+
+        if self.count and self._size_bound(len(data)) > self._limit:
+            if self._unflushed:
+                # The bound is pessimistic about compressed data still inside the compressor, find out
+                # exactly how much there is before giving up on this message.
+                self._compress("", zlib.Z_SYNC_FLUSH)
+
+            if self._size_bound(len(data)) > self._limit:
+                return False
+
+        self._write(data)
+        self.count += 1
+
+        return True
+
+    def finish(self):
+        """
+        Complete the body, no more messages may be added afterwards.
+
+        :return: tuple of (body, content_encoding), where content_encoding is None if uncompressed
+        """
+        self._write(self._suffix)
+
+        if self._compressor is None:
+            return "".join(self._chunks), None
+        else:
+            self._compress("", zlib.Z_FINISH)
+            return "".join(self._chunks), "gzip"
+
+
 class AgentDaemonContext(object):
     """
     Simple class that may be expanded in the future to allow more AgentDaemon context to be passed to action_plugins
@@ -109,7 +382,18 @@ class AgentDaemonContext(object):
 
 
 class AgentClient(CryptoClient):
-    def __init__(self, url, action_plugins, device_plugins, server_properties, crypto):
+    def __init__(
+        self,
+        url,
+        action_plugins,
+        device_plugins,
+        server_properties,
+        crypto,
+        spool=None,
+    ):
+        """
+        :param spool: Optional chroma_agent.lib.spool.Spool to keep messages in when they cannot be delivered
+        """
         super(AgentClient, self).__init__(url, crypto)
 
         self._fqdn = server_properties.fqdn
@@ -120,7 +404,7 @@ class AgentClient(CryptoClient):
 
         self.action_plugins = action_plugins
         self.device_plugins = device_plugins
-        self.writer = HttpWriter(self)
+        self.writer = HttpWriter(self, spool)
         self.reader = HttpReader(self)
         self.sessions = SessionTable(self)
 
@@ -141,6 +425,8 @@ class AgentClient(CryptoClient):
         # self.reader.join()
         self.writer.join()
         self.sessions.terminate_all()
+        daemon_log.info("Manager connection stats: %s" % self.connection_stats)
+        daemon_log.info("Outgoing message queue stats: %s" % self.writer.queue_stats)
         daemon_log.debug("Client joined")
 
     def register(self, address=None):
@@ -186,12 +472,19 @@ MESSAGE_TYPES = [
 
 
 class Message(object):
-    def __cmp__(self, other):
+    # The JSON serialization of the message, see encode()
+    encoded = None
+
+    @property
+    def priority(self):
         # If this message has a body, use its priority.  Otherwise it is a
         # control plane message, set its priority to high.
-        prio_self = self.body.priority if self.body is not None else PRIO_HIGH
-        prio_other = other.body.priority if other.body is not None else PRIO_HIGH
-        return cmp(prio_self, prio_other)
+        if self.body is None:
+            return PRIO_HIGH
+        elif isinstance(self.body, DevicePluginMessage):
+            return self.body.priority
+        else:
+            return PRIO_NORMAL
 
     def __init__(
         self,
@@ -234,10 +527,40 @@ class Message(object):
             "fqdn": fqdn,
         }
 
+    def encode(self, fqdn):
+        """
+        Serialize the message for sending.  The result is kept in .encoded so that a message is only
+        serialized once however many times it is measured, logged or requeued.
 
-class Session(object):
-    POLL_PERIOD = 10
+        :return: str containing the JSON for the message
+        """
+        if self.encoded is None:
+            self.encoded = json.dumps(self.dump(fqdn))
+
+        return self.encoded
+
+    def supersede(self, newer, fqdn):
+        """
+        Replace the content of this snapshot with that of a newer snapshot from the same session,
+        merged by the newer one's DevicePluginMessage.merge, keeping this message's place in the
+        queue.
+
+        :return: False if they cannot be merged, and both must be sent
+        """
+        body = newer.body.merge(self.body.message, newer.body.message)
+        if body is None:
+            return False
 
+        self.body = DevicePluginMessage(
+            body, priority=self.body.priority, snapshot=True, merge=newer.body.merge
+        )
+        self.session_seq = newer.session_seq
+        self.encoded = None
+        self.encode(fqdn)
+        return True
+
+
+class Session(object):
     def __init__(self, client, id, plugin_name):
         self.id = id
         self._plugin_name = plugin_name
@@ -246,22 +569,69 @@ class Session(object):
         self._client = client
         self._poll_counter = 0
         self._seq = 0
-        self._last_poll = None
 
-    def poll(self):
-        now = datetime.datetime.now()
-        if self._last_poll is None or now - self._last_poll > datetime.timedelta(
-            seconds=self.POLL_PERIOD
+        # DATA messages posted but not yet acknowledged by the manager, oldest first
+        self._unacknowledged = deque()
+        self._unacknowledged_bytes = 0
+        # The highest session_seq the manager has acknowledged
+        self._acknowledged_seq = -1
+        # Set if unacknowledged messages had to be dropped, so resending the rest would leave a gap
+        self._replay_overflowed = False
+        self._replay_lock = threading.Lock()
+
+    @property
+    def poll_period(self):
+        """Seconds between calls to poll(), set by the plugin"""
+        return self._plugin.POLL_PERIOD
+
+    @property
+    def tree_deltas(self):
+        """
+        True if the plugin may send a tree delta against its previous result, see
+        DevicePlugin._delta_result.  The manager must apply deltas, and must have acknowledged every
+        message of the session, so that the previous result is the last one it has acknowledged.
+        Until then results are sent whole, and a delta that is lost rather than acknowledged ends
+        the session (see SessionTable.recover and HttpWriter._spool_messages).
+        """
+        if not (
+            self._client.sessions.tree_deltas
+            and self._client.sessions.acknowledged_delivery
         ):
-            self._last_poll = now
-            try:
-                self._poll_counter += 1
-                if self._poll_counter == 1:
-                    return self._plugin.start_session()
-                else:
-                    return self._plugin.update_session()
-            except NotImplementedError:
-                return None
+            return False
+
+        with self._replay_lock:
+            return self._acknowledged_seq == self._seq - 1
+
+    @property
+    def network_rates(self):
+        """
+        True if the network plugin may send interface counters as rates apart from the rest of the
+        interfaces, which are set to None while unchanged, see LinuxNetworkDevicePlugin
+        """
+        return self._client.sessions.network_rates
+
+    @property
+    def snapshot_updates(self):
+        """True if the plugin's session updates may replace one another, see DevicePlugin.SNAPSHOT_UPDATES"""
+        return self._plugin.SNAPSHOT_UPDATES
+
+    def merge_updates(self, earlier, later):
+        """Combine two of the plugin's session updates, see DevicePlugin.merge_updates"""
+        return self._plugin.merge_updates(earlier, later)
+
+    def poll(self):
+        try:
+            self._poll_counter += 1
+            if self._poll_counter == 1:
+                return self._plugin.start_session()
+            else:
+                return self._plugin.update_session()
+        except NotImplementedError:
+            return None
+
+    def poll_now(self):
+        """Poll the plugin as soon as possible, see DevicePlugin.poll_now()"""
+        self._writer.wake_plugin(self._plugin_name)
 
     def send_message(self, body, callback=None):
         daemon_log.info("Session.send_message %s/%s" % (self._plugin_name, self.id))
@@ -272,6 +642,46 @@ class Session(object):
         )
         self._seq += 1
 
+    def sent(self, message):
+        """Called by the writer once message has been posted, keep it until the manager acknowledges it"""
+        with self._replay_lock:
+            if message.session_seq <= self._acknowledged_seq:
+                # Acknowledged by a GET response while the POST was still in flight
+                return
+
+            self._unacknowledged.append(message)
+            self._unacknowledged_bytes += len(message.encoded)
+
+            while self._unacknowledged_bytes > REPLAY_BUFFER_BYTES:
+                dropped = self._unacknowledged.popleft()
+                self._unacknowledged_bytes -= len(dropped.encoded)
+                self._replay_overflowed = True
+
+    def acknowledge(self, session_seq):
+        """The manager has received every message up to and including session_seq"""
+        with self._replay_lock:
+            self._acknowledged_seq = max(self._acknowledged_seq, session_seq)
+            while (
+                self._unacknowledged
+                and self._unacknowledged[0].session_seq <= session_seq
+            ):
+                acknowledged = self._unacknowledged.popleft()
+                self._unacknowledged_bytes -= len(acknowledged.encoded)
+
+    def take_unacknowledged(self):
+        """
+        :return: The messages to send again to resume the session, oldest first, or None if the
+                 session cannot be resumed
+        """
+        with self._replay_lock:
+            if self._replay_overflowed:
+                return None
+
+            messages = list(self._unacknowledged)
+            self._unacknowledged.clear()
+            self._unacknowledged_bytes = 0
+            return messages
+
     def receive_message(self, body):
         daemon_log.info("Session.receive_message %s/%s" % (self._plugin_name, self.id))
         self._plugin.on_message(body)
@@ -291,13 +701,35 @@ class SessionTable(object):
         # Map of plugin name to when we last requested a session
         self._requested_at = {}
         # Map of plugin name to how long to wait between session requests
-        self._backoffs = defaultdict(lambda: MIN_SESSION_BACKOFF)
+        self._backoffs = defaultdict(
+            lambda: DecorrelatedJitter(
+                MIN_SESSION_BACKOFF.total_seconds(), MAX_SESSION_BACKOFF.total_seconds()
+            )
+        )
+
+        # Set once the manager acknowledges a message.  From then on posted messages are kept until they
+        # are acknowledged, and sessions are resumed rather than terminated after a failed request.
+        self.acknowledged_delivery = False
+        # Set while the manager says that it applies tree deltas, see capability_hint()
+        self.tree_deltas = False
+        # Set while the manager says that it takes network counter rates, see Session.network_rates
+        self.network_rates = False
+
+    def update_capabilities(self, body):
+        """Note which of the optional message formats a response from the manager says it takes"""
+        for name in ["tree_deltas", "network_rates"]:
+            enabled = capability_hint(body, name)
+            if enabled is not None:
+                setattr(self, name, enabled)
 
     def create(self, plugin_name, id):
         daemon_log.info("SessionTable.create %s/%s" % (plugin_name, id))
         self._requested_at.pop(plugin_name, None)
         self._backoffs.pop(plugin_name, None)
-        self._sessions[plugin_name] = Session(self._client, id, plugin_name)
+        session = Session(self._client, id, plugin_name)
+        # Messages spooled before the agent restarted take the first session_seqs of the new session
+        session._seq = self._client.writer.restore(plugin_name, id)
+        self._sessions[plugin_name] = session
 
     def get(self, plugin_name, id=None):
         session = self._sessions[plugin_name]
@@ -324,6 +756,77 @@ class SessionTable(object):
             session.teardown()
         self._sessions.clear()
 
+    def sent(self, messages):
+        """Called by the writer with the messages in a POST once the manager has accepted it"""
+        if not self.acknowledged_delivery:
+            return
+
+        for message in messages:
+            if message.type == "DATA":
+                try:
+                    session = self.get(message.plugin_name, message.session_id)
+                except KeyError:
+                    continue
+                session.sent(message)
+
+    def acknowledge(self, acks):
+        """
+        Handle acknowledgements from the manager, a list of dicts with the plugin, session_id and the
+        highest session_seq the manager has received for the session.  Messages are posted in order,
+        and after a failure unacknowledged messages are resent before anything newer, so everything
+        up to that session_seq has been received (a coalesced snapshot's session_seq is never sent).
+
+        A manager that does acknowledgements includes them in every response, even if the list is
+        empty, so this is known from the first GET before any session is created.
+        """
+        self.acknowledged_delivery = True
+
+        for ack in acks:
+            try:
+                session = self.get(ack["plugin"], ack["session_id"])
+            except KeyError:
+                continue
+            session.acknowledge(ack["session_seq"])
+
+    def recover(self, plugin_names=None):
+        """
+        Called when messages to or from the manager may have been lost.  If the manager acknowledges
+        delivery each session is resumed by sending its unacknowledged messages again, otherwise (or if
+        the session could not keep every unacknowledged message) it is terminated and must start over.
+        Without acknowledgements a session whose undelivered messages are in the writer's spool is left
+        alone, they will be sent in order once the manager can be reached.
+
+        :param plugin_names: The sessions affected, all of them if None
+        """
+        if plugin_names is None:
+            plugin_names = self._sessions.keys()
+
+        for plugin_name in plugin_names:
+            try:
+                session = self.get(plugin_name)
+            except KeyError:
+                continue
+
+            if self.acknowledged_delivery:
+                messages = session.take_unacknowledged()
+            elif self._client.writer.spooled(plugin_name, session.id):
+                daemon_log.info(
+                    "SessionTable.recover %s/%s has spooled messages, keeping it"
+                    % (plugin_name, session.id)
+                )
+                continue
+            else:
+                messages = None
+
+            if messages is None:
+                self.terminate(plugin_name)
+            else:
+                daemon_log.info(
+                    "SessionTable.recover %s/%s resending %s messages"
+                    % (plugin_name, session.id, len(messages))
+                )
+                self._client.writer.resend(messages)
+
 
 class ExceptionCatchingThread(threading.Thread):
     def run(self):
@@ -341,133 +844,535 @@ class ExceptionCatchingThread(threading.Thread):
 class HttpWriter(ExceptionCatchingThread):
     """Send messages to the manager, and handle control messages received in response"""
 
-    def __init__(self, client):
+    def __init__(self, client, spool=None):
         super(HttpWriter, self).__init__()
         self._client = client
+        # DATA messages that failed to send are kept here and resent, rather than terminating their sessions
+        self._spool = spool
+        # (plugin name, session id) of the sessions with messages in the spool, until it is emptied
+        self._spooled_sessions = set()
+        # Messages in the spool from a previous run of the agent go at the start of their plugin's next
+        # session, see restore().  The session_seq each is to have there, by spool cursor, the number
+        # each plugin has until its session is created, and then the id of that session.
+        self._restored_seqs = {}
+        self._restored_counts = defaultdict(int)
+        self._restored_session_ids = {}
+        self._restored_lock = threading.Lock()
+        self._restore_until = time.time() + RESTORED_SPOOL_WAIT
+        if not self._spool_empty:
+            for cursor, record in self._spool.peek():
+                plugin_name = record.split("\n", 1)[0]
+                self._restored_seqs[cursor] = self._restored_counts[plugin_name]
+                self._restored_counts[plugin_name] += 1
         self._stopping = threading.Event()
         self._messages_waiting = threading.Event()
         self._last_poll = defaultdict(lambda: None)
-        self._messages = Queue.PriorityQueue()
-        self._retry_messages = Queue.Queue()
+        self._messages = AgingPriorityQueue(PRIO_LOW + 1, MESSAGE_MAX_WAIT)
+        # Messages to send again to resume sessions, oldest first, sent ahead of anything else
+        self._retry_messages = deque()
+        self._retry_lock = threading.Lock()
+        # A queued message which did not fit in the previous POST, sent before the rest of the queue
+        self._overflow = None
+        # Snapshot messages still in _messages, by (plugin name, session id), see put()
+        self._queued_snapshots = {}
+        self._queued_snapshots_lock = threading.Lock()
+        # Wait between attempts while POSTs are failing
+        self._retry_backoff = DecorrelatedJitter(
+            MIN_POST_RETRY_PERIOD, MAX_POST_RETRY_PERIOD
+        )
+        # Seconds the manager asked us to wait before the next POST, if it did
+        self._retry_after = None
+        # Decides when each device plugin is polled, and runs the polls
+        self._scheduler = Scheduler(PLUGIN_POLL_WORKERS, name="PluginScheduler")
+        # Set once the manager says that it accepts gzip compressed POST bodies, see compression_hint()
+        self.compress = False
 
     def put(self, message):
         """Called from a different thread context than the main loop"""
-        self._messages.put(message)
+        # Serialize in the caller's thread, so the writer only has to concatenate the results
+        message.encode(self._client._fqdn)
+
+        key = self._snapshot_key(message)
+        if key is not None:
+            with self._queued_snapshots_lock:
+                queued = self._queued_snapshots.get(key)
+                if queued is not None and queued.supersede(message, self._client._fqdn):
+                    # Only the latest state matters, so the snapshot that is already waiting was
+                    # updated instead
+                    daemon_log.debug(
+                        "HttpWriter coalesced snapshot %s/%s" % (key[0], key[1])
+                    )
+                    return
+
+                self._queued_snapshots[key] = message
+
+        self._messages.put(message, message.priority)
         self._messages_waiting.set()
 
-    def _run_plugin(self, plugin_name):
-        # Ensure that there is a time at least this long between
-        # calls to .poll() (just to avoid spinning)
-        POLL_PERIOD = 1.0
+    @property
+    def queue_stats(self):
+        """Counters for each priority level of the outgoing queue, highest priority first"""
+        return self._messages.stats
 
-        while not self._stopping.is_set():
-            started_at = datetime.datetime.now()
+    def _snapshot_key(self, message):
+        """
+        Return the key under which message may replace an earlier undelivered message, or None if
+        it must always be sent.  Only plugin DATA marked as a snapshot qualifies: control messages
+        and anything with a callback (e.g. action completions) are never coalesced.
+        """
+        if (
+            message.type == "DATA"
+            and message.callback is None
+            and isinstance(message.body, DevicePluginMessage)
+            and message.body.snapshot
+        ):
+            return (message.plugin_name, message.session_id)
 
-            self.poll(plugin_name)
+        return None
 
-            # Ensure that we poll at most every POLL_PERIOD
-            self._stopping.wait(
-                timeout=max(
-                    0, POLL_PERIOD - (datetime.datetime.now() - started_at).seconds
-                )
-            )
+    def resend(self, messages):
+        """
+        Send messages again, oldest first, ahead of anything not yet sent (including messages already
+        waiting to be sent again, which are newer).  May be called from any thread.
+        """
+        for message in messages:
+            # Callbacks have already been run when the message was first sent
+            message.callback = None
 
-    def _run(self):
-        threads = []
+        with self._retry_lock:
+            self._retry_messages.extendleft(reversed(messages))
+        self._messages_waiting.set()
 
+    @property
+    def _retry_empty(self):
+        with self._retry_lock:
+            return not self._retry_messages
+
+    def _get_message(self):
+        """Take the next message from the primary queue, raising Queue.Empty if there is none"""
+        message = self._messages.get_nowait()
+
+        key = self._snapshot_key(message)
+        if key is not None:
+            # From now on the message may be sent at any moment, so it can no longer be updated
+            with self._queued_snapshots_lock:
+                if self._queued_snapshots.get(key) is message:
+                    del self._queued_snapshots[key]
+
+        return message
+
+    def _poll_plugin(self, plugin_name):
+        """
+        Called by the scheduler, returns the number of seconds from now until the plugin should next
+        be polled
+        """
+        started_at = time.time()
+        self.poll(plugin_name)
+
+        try:
+            period = self._client.sessions.get(plugin_name).poll_period
+        except KeyError:
+            return SESSION_REQUEST_POLL_PERIOD
+
+        # Poll at this agent's own point in the period, so that the fleet's polls are spread across it.
+        # That is the first such point from half a period after this poll started, so that a poll which
+        # ran a little early is not repeated around the same point, nor is a period skipped after a slow one.
+        now = time.time()
+        after = max(now, started_at + period / 2.0)
+        return after - now + next_phase(self._phase_key(plugin_name), period, now=after)
+
+    def wake_plugin(self, plugin_name):
+        """Poll the plugin as soon as possible rather than when it is next due.  May be called from any thread."""
+        self._scheduler.wake(plugin_name)
+
+    def _phase_key(self, plugin_name):
+        return "%s/%s" % (self._client._fqdn, plugin_name)
+
+    def _run(self):
         for plugin_name in self._client.device_plugins.get_plugins():
-            thread = ExceptionThrowingThread(
-                target=self._run_plugin, args=(plugin_name,)
+            self._scheduler.add(
+                plugin_name,
+                functools.partial(self._poll_plugin, plugin_name),
+                SESSION_REQUEST_POLL_PERIOD,
+                # Spread the first session requests when a fleet of agents start together
+                delay=phase_offset(
+                    self._phase_key(plugin_name), MIN_SESSION_BACKOFF.total_seconds()
+                ),
+                # _poll_plugin returns the time to the plugin's next phase
+                delay_from_return=True,
             )
-            threads.append(thread)
-            thread.start()
+        self._scheduler.start()
 
-        while not self._stopping.is_set():
-            while not (self._messages.empty() and self._retry_messages.empty()):
-                self.send()
+        try:
+            while not self._stopping.is_set():
+                while not (
+                    self._messages.empty()
+                    and self._retry_empty
+                    and self._overflow is None
+                    and self._spool_empty
+                ):
+                    if self.send():
+                        self._retry_backoff.reset()
+                        delay = self._retry_after
+                    else:
+                        # Undelivered messages are spooled or requeued, wait a while before trying again
+                        delay = max(self._retry_backoff.next(), self._retry_after or 0)
+
+                    if delay:
+                        daemon_log.info(
+                            "HttpWriter waiting %.1fs before next POST" % delay
+                        )
+                        # Wait on _stopping rather than _messages_waiting, new messages must wait too
+                        self._stopping.wait(timeout=delay)
 
-            self._messages_waiting.wait()
-            self._messages_waiting.clear()
+                    if self._stopping.is_set():
+                        break
 
-        ExceptionThrowingThread.wait_for_threads(threads)
+                self._messages_waiting.wait()
+                self._messages_waiting.clear()
+        finally:
+            # Also if the loop fails, so that no poll threads are left running
+            self._scheduler.stop()
+            self._scheduler.join()
+
+        if self._spool is not None:
+            self._spool.close()
 
     def stop(self):
         self._stopping.set()
         self._messages_waiting.set()  # Trigger this to cause  _run to loop spin and see that _stopping is set.
 
-    def send(self):
-        """Return True if the POST succeeds, else False"""
+    @property
+    def _spool_empty(self):
+        return self._spool is None or self._spool.empty
+
+    def restore(self, plugin_name, session_id):
+        """
+        Called as a session is created, to send it any messages of the plugin spooled by a previous run
+        of the agent, ahead of the new session's own.  May be called from any thread.
+
+        :return: The number of session_seqs those messages take, from 0, the session's own starting
+                 after them
+        """
+        with self._restored_lock:
+            count = self._restored_counts.pop(plugin_name, 0)
+            if time.time() >= self._restore_until:
+                # Too late, they are discarded
+                return 0
+
+            if count:
+                daemon_log.info(
+                    "HttpWriter restoring %s spooled messages into %s/%s"
+                    % (count, plugin_name, session_id)
+                )
+                self._restored_session_ids[plugin_name] = session_id
+            return count
+
+    def _restore_message(self, cursor, plugin_name, message_json):
+        """
+        :return: tuple of the id of the plugin's new session and the JSON of a message spooled by a
+                 previous run of the agent moved into it, or (None, None) if it cannot be
+        """
+        with self._restored_lock:
+            session_id = self._restored_session_ids.get(plugin_name)
+        if session_id is None:
+            # The plugin has not had a new session in time
+            return None, None
+
+        try:
+            self._client.sessions.get(plugin_name, session_id)
+        except KeyError:
+            # The new session has already ended
+            return None, None
+
+        message = json.loads(message_json)
+        body = message["body"]
+        if isinstance(body, dict) and any(
+            tree_delta.is_delta(value) for value in body.values()
+        ):
+            # Against a previous result that the manager held for the old session
+            return None, None
+
+        message["session_id"] = session_id
+        message["session_seq"] = self._restored_seqs[cursor]
+        return session_id, json.dumps(message)
+
+    def spooled(self, plugin_name, session_id):
+        """:return: True if the session has messages waiting in the spool.  May be called from any thread."""
+        return (plugin_name, session_id) in self._spooled_sessions
+
+    def _add_spooled(self, body):
+        """
+        Add messages from the spool to body, oldest first.
+
+        :return: tuple of (spool cursor to commit if the POST succeeds, list of the Messages added,
+                 True if body is now full)
+        """
+        cursor = None
+        stale = 0
+        body_full = False
         messages = []
-        completion_callbacks = []
 
-        post_envelope = {
-            "messages": [],
-            "server_boot_time": self._client.boot_time.isoformat() + "Z",
-            "client_start_time": self._client.start_time.isoformat() + "Z",
-        }
+        for record_cursor, record in self._spool.peek():
+            plugin_name, session_id, message_json = record.split("\n", 2)
 
-        # Any message we drop will need its session killed
-        kill_sessions = set()
+            if record_cursor in self._restored_seqs:
+                with self._restored_lock:
+                    waiting = plugin_name in self._restored_counts
+                if waiting and time.time() < self._restore_until:
+                    # Spooled before the agent restarted, and the plugin's new session has yet to
+                    # start: keep it and everything after it until it has
+                    break
+                session_id, message_json = self._restore_message(
+                    record_cursor, plugin_name, message_json
+                )
 
-        messages_bytes = len(json.dumps(post_envelope))
-        while True:
             try:
-                message = self._retry_messages.get_nowait()
-                daemon_log.debug("HttpWriter got message from retry queue")
-            except Queue.Empty:
+                session = self._client.sessions.get(plugin_name)
+            except KeyError:
+                session = None
+
+            if (
+                message_json is None
+                or session is None
+                or str(session.id) != str(session_id)
+            ):
+                # The session has ended since the message was spooled, the manager would reject it
+                stale += 1
+            elif not body.add(message_json):
+                body_full = True
+                break
+            else:
+                # Enough of the message for SessionTable.sent() to keep it until it is acknowledged
+                message = Message(
+                    "DATA",
+                    plugin_name,
+                    None,
+                    session.id,
+                    json.loads(message_json)["session_seq"],
+                )
+                message.encoded = message_json
+                messages.append(message)
+
+            cursor = record_cursor
+
+        if stale:
+            daemon_log.info("HttpWriter discarded %s stale spooled messages" % stale)
+
+        return cursor, messages, body_full
+
+    def _spool_messages(self, messages):
+        records = [
+            "%s\n%s\n%s" % (message.plugin_name, message.session_id, message.encoded)
+            for message in messages
+            if message.type == "DATA"
+        ]
+        daemon_log.info("HttpWriter spooling %s messages" % len(records))
+        self._spooled_sessions = self._spooled_sessions | set(
+            (message.plugin_name, message.session_id)
+            for message in messages
+            if message.type == "DATA"
+        )
+        dropped = self._spool.append(records)
+
+        # A session that has lost messages to a full spool must start over
+        for plugin_name, session_id in set(
+            tuple(record.split("\n", 2)[:2]) for record in dropped
+        ):
+            try:
+                session = self._client.sessions.get(plugin_name)
+            except KeyError:
+                continue
+
+            if str(session.id) == session_id:
+                daemon_log.warning(
+                    "HttpWriter: spool overflowed, terminating session %s/%s"
+                    % (plugin_name, session_id)
+                )
+                self._client.sessions.terminate(plugin_name)
+
+    def _add_retries(self, body):
+        """
+        Add messages being sent again to body, oldest first.
+
+        :return: tuple of (list of the Messages added, True if body is now full)
+        """
+        messages = []
+
+        while True:
+            with self._retry_lock:
+                if not self._retry_messages:
+                    return messages, False
+                message = self._retry_messages.popleft()
+
+            if not body.add(message.encode(self._client._fqdn)):
+                with self._retry_lock:
+                    self._retry_messages.appendleft(message)
+                return messages, True
+
+            messages.append(message)
+
+    def _drop_oversized_spooled(self, spool_cursor, message):
+        """A spooled message too large to ever be posted is dropped, and its session must start over"""
+        daemon_log.warning(
+            "HttpWriter: dropping oversized spooled message, terminating session %s/%s"
+            % (message.plugin_name, message.session_id)
+        )
+        self._spool.commit(spool_cursor)
+        if self._spool.empty:
+            self._spooled_sessions = set()
+            self._restored_seqs = {}
+
+        try:
+            self._client.sessions.get(message.plugin_name, message.session_id)
+        except KeyError:
+            # Already gone
+            return
+        self._client.sessions.terminate(message.plugin_name)
+
+    def send(self):
+        """Return False if the POST fails, else True"""
+        messages = []
+        completion_callbacks = []
+
+        body = PostBody(
+            {
+                "server_boot_time": self._client.boot_time.isoformat() + "Z",
+                "client_start_time": self._client.start_time.isoformat() + "Z",
+            },
+            compress=self.compress,
+        )
+
+        # Messages sent again to resume sessions are the oldest, then come those spooled by earlier
+        # failed POSTs, then anything queued since
+        retried_messages, body_full = self._add_retries(body)
+        spool_cursor, spooled_messages = None, []
+        if not body_full and not self._spool_empty:
+            spool_cursor, spooled_messages, body_full = self._add_spooled(body)
+        spooled_count = len(spooled_messages)
+
+        while not body_full:
+            if self._overflow is not None:
+                message, self._overflow = self._overflow, None
+                daemon_log.debug("HttpWriter got message that overflowed previous POST")
+            else:
                 try:
-                    message = self._messages.get_nowait()
+                    message = self._get_message()
                     daemon_log.debug("HttpWriter got message from primary queue")
                 except Queue.Empty:
                     break
 
-            if message.callback:
-                completion_callbacks.append(message.callback)
-            message_length = len(json.dumps(message.dump(self._client._fqdn)))
-
-            if message_length > MAX_BYTES_PER_POST:
-                daemon_log.warning(
-                    "Oversized message %s/%s: %s"
-                    % (
-                        message_length,
-                        MAX_BYTES_PER_POST,
-                        message.dump(self._client._fqdn),
-                    )
-                )
+            message_json = message.encode(self._client._fqdn)
 
-            if messages and message_length > MAX_BYTES_PER_POST - messages_bytes:
-                # This message will not fit into this POST: pop it back into the queue
+            if not body.add(message_json):
+                # This message will not fit into this POST: keep it for the next one
                 daemon_log.info(
-                    "HttpWriter message %s overflowed POST %s/%s (%d "
+                    "HttpWriter message %s/%s overflowed POST %s/%s (%d "
                     "messages), enqueuing"
                     % (
-                        message.dump(self._client._fqdn),
-                        message_length,
+                        message.type,
+                        message.plugin_name,
+                        len(message_json),
                         MAX_BYTES_PER_POST,
                         len(messages),
                     )
                 )
-                self._retry_messages.put(message)
+                self._overflow = message
                 break
 
+            if message.callback:
+                completion_callbacks.append(message.callback)
             messages.append(message)
-            messages_bytes += message_length
 
-        daemon_log.debug("HttpWriter sending %s messages" % len(messages))
+        data, content_encoding = body.finish()
+
+        if len(data) > MAX_BYTES_PER_POST:
+            # Only a body's first message can take it over the limit, so it holds just that one
+            if spooled_messages:
+                self._drop_oversized_spooled(spool_cursor, spooled_messages[0])
+                return True
+
+            daemon_log.warning(
+                "Oversized message %s/%s from %s"
+                % (
+                    len(data),
+                    MAX_BYTES_PER_POST,
+                    ", ".join(
+                        sorted(
+                            set(
+                                message.plugin_name
+                                for message in retried_messages + messages
+                            )
+                        )
+                    ),
+                )
+            )
+
+        daemon_log.debug(
+            "HttpWriter sending %s messages (%s from spool, %s resent)"
+            % (
+                len(retried_messages) + spooled_count + len(messages),
+                spooled_count,
+                len(retried_messages),
+            )
+        )
+
         try:
-            post_envelope["messages"] = [m.dump(self._client._fqdn) for m in messages]
-            self._client.post(post_envelope)
-        except HttpError:
+            response = self._client.post_encoded(data, content_encoding)
+        except HttpError as e:
             daemon_log.warning("HttpWriter: request failed")
-            # Terminate any sessions which we've just droppped messages for
-            for message in messages:
-                if message.type == "DATA":
-                    kill_sessions.add(message.plugin_name)
-            for plugin_name in kill_sessions:
-                self._client.sessions.terminate(plugin_name)
+            self._retry_after = e.retry_after
+
+            if content_encoding is not None and e.status_code in (400, 415):
+                # The manager turns out not to understand compressed bodies after all
+                daemon_log.warning(
+                    "HttpWriter: manager rejected %s body, sending uncompressed"
+                    % content_encoding
+                )
+                self.compress = False
+
+            if self._spool is not None and len(data) <= MAX_BYTES_PER_POST:
+                # Messages being sent again are older than anything spooled, so they stay ahead of it.
+                # Spooled messages stay in the spool, and the new ones are added after them.
+                self.resend(retried_messages)
+                self._spool_messages(messages)
+                return False
+
+            messages = retried_messages + messages
+
+            # Any session we've just dropped messages for must resend them or be terminated
+            affected_sessions = set(
+                message.plugin_name for message in messages if message.type == "DATA"
+            )
+            if len(data) > MAX_BYTES_PER_POST:
+                # Sending it again will never work
+                for plugin_name in affected_sessions:
+                    self._client.sessions.terminate(plugin_name)
+            else:
+                # Keep them with the session's unacknowledged messages, so they are sent again in order
+                # ahead of anything else
+                self._client.sessions.sent(messages)
+                self._client.sessions.recover(affected_sessions)
 
             return False
         else:
+            self._retry_after = retry_after_hint(response)
+            self._client.sessions.sent(retried_messages + spooled_messages + messages)
+
+            compress = compression_hint(response)
+            if compress is not None:
+                self.compress = compress
+
+            self._client.sessions.update_capabilities(response)
+
+            if isinstance(response, dict) and "acks" in response:
+                self._client.sessions.acknowledge(response["acks"])
+
+            if spool_cursor is not None:
+                self._spool.commit(spool_cursor)
+                if self._spool.empty:
+                    self._spooled_sessions = set()
+                    self._restored_seqs = {}
             return True
         finally:
             for callback in completion_callbacks:
@@ -486,26 +1391,22 @@ class HttpWriter(ExceptionCatchingThread):
         except KeyError:
             # Request to open a session
             #
+            backoff = self._client.sessions._backoffs[plugin_name]
             if plugin_name in self._client.sessions._requested_at:
-                next_request_at = (
-                    self._client.sessions._requested_at[plugin_name]
-                    + self._client.sessions._backoffs[plugin_name]
-                )
+                next_request_at = self._client.sessions._requested_at[
+                    plugin_name
+                ] + datetime.timedelta(seconds=backoff.delay)
                 if now < next_request_at:
                     # We're still in our backoff period, skip requesting a session
                     daemon_log.debug(
                         "Delaying session request until %s" % next_request_at
                     )
                     return
-                else:
-                    if (
-                        self._client.sessions._backoffs[plugin_name]
-                        < MAX_SESSION_BACKOFF
-                    ):
-                        self._client.sessions._backoffs[plugin_name] *= 2
 
             daemon_log.debug("Requesting session for plugin %s" % plugin_name)
             self._client.sessions._requested_at[plugin_name] = now
+            # Wait this long for a response before asking again
+            backoff.next()
             self.put(Message("SESSION_CREATE_REQUEST", plugin_name))
         else:
             try:
@@ -525,14 +1426,21 @@ class HttpWriter(ExceptionCatchingThread):
                     elif isinstance(data, DevicePluginMessage):
                         session.send_message(data)
                     else:
-                        session.send_message(DevicePluginMessage(data))
+                        session.send_message(
+                            DevicePluginMessage(
+                                data,
+                                snapshot=session.snapshot_updates,
+                                merge=session.merge_updates,
+                            )
+                        )
 
 
 class HttpReader(ExceptionCatchingThread):
     """Receive data messages from the manager"""
 
-    # Time to wait after a failed HTTP request
+    # Bounds of the jittered wait after a failed HTTP request
     HTTP_RETRY_PERIOD = 10
+    MAX_HTTP_RETRY_PERIOD = 60
 
     def __init__(self, client):
         super(HttpReader, self).__init__()
@@ -541,6 +1449,9 @@ class HttpReader(ExceptionCatchingThread):
         self.daemon = True
         self._client = client
         self._stopping = threading.Event()
+        self._retry_backoff = DecorrelatedJitter(
+            self.HTTP_RETRY_PERIOD, self.MAX_HTTP_RETRY_PERIOD
+        )
 
     def _handle_messages(self, messages):
         daemon_log.info("HttpReader: got %s messages" % (len(messages)))
@@ -589,23 +1500,48 @@ class HttpReader(ExceptionCatchingThread):
         get_args = {
             "server_boot_time": self._client.boot_time.isoformat() + "Z",
             "client_start_time": self._client.start_time.isoformat() + "Z",
+            # Tell the manager that we can resume sessions from acknowledgements
+            "acks": 1,
+            # and that we can gzip POST bodies, if it says that it accepts them
+            "gzip": 1,
+            # and that we can send tree deltas and network counter rates, if it says that it takes them
+            "tree_deltas": 1,
+            "network_rates": 1,
         }
         while not self._stopping.is_set():
             daemon_log.info("HttpReader: get")
             try:
                 body = self._client.get(params=get_args)
-            except HttpError:
+            except HttpError as e:
                 daemon_log.warning("HttpReader: request failed")
                 # We potentially dropped TX messages if this happened, which could include
-                # session control messages, so have to completely reset.
-                # NB could change this to only terminate_all if an HTTP request was started: there is
-                # no need to do the teardown if we didn't even get a TCP connection to the manager.
-                self._client.sessions.terminate_all()
-
-                self._stopping.wait(timeout=self.HTTP_RETRY_PERIOD)
+                # session control messages, so resume from what the manager has acknowledged, or
+                # completely reset if it doesn't do acknowledgements.
+                # NB could change this to only recover if an HTTP request was started: there is
+                # no need to do anything if we didn't even get a TCP connection to the manager.
+                self._client.sessions.recover()
+
+                self._stopping.wait(
+                    timeout=max(self._retry_backoff.next(), e.retry_after or 0)
+                )
                 continue
             else:
+                self._retry_backoff.reset()
+
+                compress = compression_hint(body)
+                if compress is not None:
+                    self._client.writer.compress = compress
+
+                self._client.sessions.update_capabilities(body)
+
+                if "acks" in body:
+                    self._client.sessions.acknowledge(body["acks"])
                 self._handle_messages(body["messages"])
+
+                # The manager may ask us to slow down
+                retry_after = retry_after_hint(body)
+                if retry_after:
+                    self._stopping.wait(timeout=retry_after)
         daemon_log.info("HttpReader: stopping")
 
     def stop(self):
@@ -619,5 +1555,44 @@ class HttpReader(ExceptionCatchingThread):
 #        pass
 
 
+def retry_after_hint(body):
+    """:return: The seconds to wait before the next request, if the manager asked in a response body"""
+    if isinstance(body, dict):
+        return parse_retry_after(body.get("retry_after"))
+
+    return None
+
+
+def compression_hint(body):
+    """
+    A manager that accepts compressed POST bodies lists the encodings in 'content_encodings' in every
+    response, so this is known from the first GET.
+
+    :return: True if POST bodies may be gzip compressed, False if not, None if the body does not say
+    """
+    if isinstance(body, dict) and "content_encodings" in body:
+        return "gzip" in (body["content_encodings"] or [])
+
+    return None
+
+
+def capability_hint(body, name):
+    """
+    A manager that takes one of the optional message formats the agent offers on each GET (e.g.
+    tree_deltas) says so with its name in every response, so this is known from the first GET.
+
+    :return: True if the format may be sent, False if not, None if the body does not say
+    """
+    if isinstance(body, dict) and name in body:
+        return bool(body[name])
+
+    return None
+
+
 class HttpError(Exception):
-    pass
+    def __init__(self, *args, **kwargs):
+        # HTTP status of the response, if there was one
+        self.status_code = kwargs.pop("status_code", None)
+        # Seconds the manager asked us to wait before trying again, if it said
+        self.retry_after = kwargs.pop("retry_after", None)
+        super(HttpError, self).__init__(*args, **kwargs)
@@ -13,11 +13,12 @@ import socket
 
 from urlparse import urljoin
 
-from chroma_agent import config
+from chroma_agent import config, DEFAULT_AGENT_CONFIG
 from chroma_agent.conf import ENV_PATH
 from chroma_agent.crypto import Crypto
 from chroma_agent.plugin_manager import ActionPluginManager, DevicePluginManager
 from chroma_agent.agent_client import AgentClient
+from chroma_agent.lib.spool import Spool
 from chroma_agent.log import (
     daemon_log,
     daemon_log_setup,
@@ -57,6 +58,29 @@ class ServerProperties(object):
                 return datetime.datetime.fromtimestamp(int(val))
 
 
+def outbound_spool():
+    """
+    :return: A Spool for messages that could not be delivered to the manager, or None if spooling is disabled
+    """
+    try:
+        agent_settings = config.get("settings", "agent")
+    except KeyError:
+        agent_settings = {}
+
+    def setting(key):
+        return agent_settings.get(key, DEFAULT_AGENT_CONFIG[key])
+
+    if not setting("outbound_spool_max_bytes"):
+        return None
+
+    daemon_log.info(
+        "Spooling undelivered messages in %s" % setting("outbound_spool_directory")
+    )
+    return Spool(
+        setting("outbound_spool_directory"), setting("outbound_spool_max_bytes")
+    )
+
+
 def main():
     """handle unexpected exceptions"""
     parser = argparse.ArgumentParser(
@@ -100,6 +124,7 @@ def main():
             DevicePluginManager(),
             ServerProperties(),
             Crypto(ENV_PATH),
+            outbound_spool(),
         )
 
         def teardown_callback(*args, **kwargs):
@@ -26,6 +26,7 @@ from chroma_agent.log import (
     decrease_loglevel,
 )
 from chroma_agent.utils import lsof
+from chroma_agent.lib.backoff import DecorrelatedJitter
 from chroma_agent.agent_client import (
     CryptoClient,
     ExceptionCatchingThread,
@@ -71,6 +72,9 @@ class CopytoolEventRelay(ExceptionCatchingThread):
         self.send_queue = Queue.Queue()
         self.retry_queue = Queue.Queue()
         self.poll_interval = RELAY_POLL_INTERVAL
+        self.retry_backoff = DecorrelatedJitter(
+            MIN_SESSION_BACKOFF.seconds, MAX_SESSION_BACKOFF.seconds
+        )
         self.active_operations = {}
 
     def put(self, event):
@@ -157,22 +161,18 @@ class CopytoolEventRelay(ExceptionCatchingThread):
                     pass
                 # Reset any backoff delay that might have been added
                 self.reset_backoff()
-            except HttpError:
+            except HttpError as e:
                 copytool_log.error("Failed to relay events, requeueing")
                 for event in envelope["events"]:
                     self.retry_queue.put(event)
-                self.backoff()
+                self.backoff(e.retry_after)
 
     def reset_backoff(self):
         self.poll_interval = RELAY_POLL_INTERVAL
+        self.retry_backoff.reset()
 
-    def backoff(self):
-        if self.poll_interval == RELAY_POLL_INTERVAL:
-            self.poll_interval = MIN_SESSION_BACKOFF.seconds
-        else:
-            self.poll_interval *= 2
-            if self.poll_interval > MAX_SESSION_BACKOFF.seconds:
-                self.poll_interval = MAX_SESSION_BACKOFF.seconds
+    def backoff(self, retry_after=None):
+        self.poll_interval = max(self.retry_backoff.next(), retry_after or 0)
 
         copytool_log.info("Retry interval increased to %d seconds" % self.poll_interval)
 
@@ -3,19 +3,40 @@
 # license that can be found in the LICENSE file.
 
 
-def local_audit_classes():
+def local_audit_classes(context=None):
     import lustre
 
     classes = []
-    classes.extend(lustre.local_audit_classes())
+    classes.extend(lustre.local_audit_classes(context))
     return classes
 
 
+class ScanContext(object):
+    """Things read during one scan, shared by every audit taking part in it so that each is read
+    once per scan however many audits use it.  Create a new one for each scan.
+    """
+
+    def __init__(self):
+        self._cache = {}
+        # Parameter values by path, see LustreGetParamMixin
+        self.params = {}
+        # Lines of files read, by absolute path, see FileSystemMixin
+        self.files = {}
+
+    def cached(self, key, f):
+        """Return f(), calling it only the first time key is asked for."""
+        if key not in self._cache:
+            self._cache[key] = f()
+
+        return self._cache[key]
+
+
 class BaseAudit(object):
     """Base Audit class."""
 
     def __init__(self, **kwargs):
         self.raw_metrics = {}
+        self.context = kwargs.get("context") or ScanContext()
 
     def metrics(self):
         raise NotImplementedError
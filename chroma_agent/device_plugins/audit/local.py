@@ -18,55 +18,59 @@ class LocalAudit(BaseAudit, FileSystemMixin):
     def audit_classes(self):
         if not hasattr(self, "audit_classes_list"):
             self.audit_classes_list = (
-                chroma_agent.device_plugins.audit.local_audit_classes()
+                chroma_agent.device_plugins.audit.local_audit_classes(self.context)
             )
         return self.audit_classes_list
 
-    # Flagrantly "borrowed" from:
-    # http://stackoverflow.com/questions/5575124/python-combine-several-nested-lists-into-a-dictionary
-    def __mergedicts(self, *dicts):
-        """Recursively merge an arbitrary number of dictionaries.
-        pyflakes:ignore >>> import pprint
-        >>> d1 = {'a': {'b': {'x': '1',
-        ...                   'y': '2'}}}
-        >>> d2 = {'a': {'c': {'gg': {'m': '3'},
-        ...                   'xx': '4'}}}
-        pyflakes:ignore >>> pprint.pprint(mergedicts(d1, d2), width=2)
-        {'a': {'b': {'x': '1',
-                     'y': '2'},
-               'c': {'gg': {'m': '3'},
-                     'xx': '4'}}}
-        """
+    def __merge_into(self, target, source):
+        """Recursively merge the source dict into the target dict, in place.
 
-        keys = set(k for d in dicts for k in d)
+        Each dict of source is visited once, so merging the metrics of many
+        audits into one accumulator takes time linear in their size.  Dicts
+        of source not already in target are taken as they are, not copied.
 
-        def vals(key):
-            """Returns all values for `key` in all `dicts`."""
-            return [d[key] for d in dicts if key in d]
+        >>> d1 = {'a': {'b': {'x': '1', 'y': '2'}}}
+        >>> d2 = {'a': {'c': {'gg': {'m': '3'}, 'xx': '4'}}}
+        >>> self.__merge_into(d1, d2)
+        {'a': {'b': {'x': '1', 'y': '2'}, 'c': {'gg': {'m': '3'}, 'xx': '4'}}}
+        """
+        stack = [(target, source)]
 
-        def recurse(*values):
-            """Recurse if the values are dictionaries."""
-            if isinstance(values[0], dict):
-                return self.__mergedicts(*values)
-            if len(values) == 1:
-                return values[0]
-            raise TypeError("Multiple non-dictionary values for a key.")
+        while stack:
+            target_dict, source_dict = stack.pop()
+            for key, value in source_dict.items():
+                if key not in target_dict:
+                    target_dict[key] = value
+                elif isinstance(target_dict[key], dict) and isinstance(value, dict):
+                    stack.append((target_dict[key], value))
+                else:
+                    raise TypeError("Multiple non-dictionary values for a key.")
 
-        return dict((key, recurse(*vals(key))) for key in keys)
+        return target
 
     def metrics(self):
         """Returns an aggregated dict of all subclass metrics."""
         agg_raw = {}
         for cls in self.audit_classes():
-            audit = cls()
+            audit = cls(context=self.context)
             audit_metrics = audit.metrics()
-            agg_raw = self.__mergedicts(agg_raw, audit_metrics["raw"])
+            self.__merge_into(agg_raw, audit_metrics["raw"])
 
         return {"raw": agg_raw}
 
+    def counters(self):
+        """Returns the counters of all subclasses, see LustreAudit.counters."""
+        counters = {}
+        for cls in self.audit_classes():
+            counters.update(cls(context=self.context).counters())
+
+        return counters
+
     @exceptionSandBox(console_log, {})
     def properties(self):
         """Returns merged properties suitable for host validation."""
         return dict(
-            item for cls in self.audit_classes() for item in cls().properties().items()
+            item
+            for cls in self.audit_classes()
+            for item in cls(context=self.context).properties().items()
         )
@@ -4,6 +4,7 @@
 
 
 import re
+import fnmatch
 import heapq
 from collections import defaultdict
 from collections import namedtuple
@@ -13,14 +14,31 @@ from chroma_agent.device_plugins.audit.mixins import (
     FileSystemMixin,
     LustreGetParamMixin,
 )
+from chroma_agent.device_plugins.audit.lustre.job_stats import JobStatsCollector
+from chroma_agent.device_plugins.audit.lustre.brw_stats import BrwStatsCollector
+from chroma_agent.device_plugins.audit.lustre.export_stats import ExportStatsCollector
+from chroma_agent.device_plugins.audit.lustre.stats_parser import (
+    parse_stats,
+    parse_pairs,
+)
 
 
-# HYD-2307 workaround
-DISABLE_BRW_STATS = True
+# HYD-2307: brw_stats were disabled as too costly to collect and send as nested dicts, they are
+# now collected compactly by BrwStatsCollector
+DISABLE_BRW_STATS = False
 JOB_STATS_LIMIT = 20  # only return the most active jobs
+JOB_STATS_HISTORY = (
+    1000  # jobs whose totals are kept between scans, to report the change in
+)
+JOB_STATS_KEY = "ops"  # rank jobs by operations, or "bytes" read and written
+EXPORT_STATS_LIMIT = 20  # only return the most active clients
+EXPORT_STATS_HISTORY = (
+    10000  # exports whose totals are kept between scans, to report the change in
+)
+EXPORT_STATS_KEY = "ops"  # rank clients by operations, or "bytes" read and written
 
 
-def local_audit_classes():
+def local_audit_classes(context=None):
     import chroma_agent.device_plugins.audit.lustre
 
     return [
@@ -30,7 +48,7 @@ def local_audit_classes():
             for name in dir(chroma_agent.device_plugins.audit.lustre)
             if name.endswith("Audit")
         ]
-        if hasattr(cls, "is_available") and cls.is_available()
+        if hasattr(cls, "is_available") and cls.is_available(context)
     ]
 
 
@@ -42,15 +60,30 @@ class LustreAudit(BaseAudit, FileSystemMixin, LustreGetParamMixin):
 
     LustreVersion = namedtuple("LustreVersion", ["major", "minor", "patch"])
 
+    # JobStatsCollector for each job_stats path, kept from scan to scan
+    _job_stats_collectors = {}
+    # BrwStatsCollector for each brw_stats path, kept from scan to scan
+    _brw_stats_collectors = {}
+    # ExportStatsCollector for each exports stats path, kept from scan to scan
+    _export_stats_collectors = {}
+
+    # Stats params sampled between scans to work out rates, see counters().  Subclasses add those
+    # of their targets.
+    COUNTER_PARAMS = []
+
+    # Params read by each scan, fetched together before it by prefetch_params().  Subclasses
+    # extend this with those their _gather_raw_metrics() reads.
+    SCAN_PARAMS = ["version", "health_check", "devices"]
+
     @classmethod
-    def is_available(cls):
+    def is_available(cls, context=None):
         """Returns a boolean indicating whether or not this audit class should
         be instantiated.
         """
-        return cls.kmod_is_loaded() and cls.device_is_present()
+        return cls.kmod_is_loaded(context) and cls.device_is_present(context)
 
     @classmethod
-    def device_is_present(cls):
+    def device_is_present(cls, context=None):
         """Returns a boolean indicating whether or not this class
         has any corresponding Lustre device entries.
         """
@@ -63,12 +96,12 @@ class LustreAudit(BaseAudit, FileSystemMixin, LustreGetParamMixin):
         if modname in exceptions:
             return True
 
-        obj = cls()
+        obj = cls(context=context)
         entries = [dev for dev in obj.devices() if dev["type"] == modname]
         return len(entries) > 0
 
     @classmethod
-    def kmod_is_loaded(cls):
+    def kmod_is_loaded(cls, context=None):
         """Returns a boolean indicating whether or not this class'
         corresponding Lustre module is loaded.
         """
@@ -77,7 +110,7 @@ class LustreAudit(BaseAudit, FileSystemMixin, LustreGetParamMixin):
         def filter(line):
             return line.startswith(modname)
 
-        obj = cls()
+        obj = cls(context=context)
         try:
             modules = list(obj.read_lines("/proc/modules", filter))
         except IOError:
@@ -90,23 +123,8 @@ class LustreAudit(BaseAudit, FileSystemMixin, LustreGetParamMixin):
 
         self.raw_metrics["lustre"] = {}
 
-    def stats_dict_from_path(self, path):
-        """Creates a dict from Lustre stats file contents."""
-        stats_re = re.compile(
-            r"""
-        # e.g.
-        # create                    726 samples [reqs]
-        # cache_miss                21108 samples [pages] 1 1 21108
-        # obd_ping                  1108 samples [usec] 15 72 47014 2156132
-        ^
-        (?P<name>\w+)\s+(?P<count>\d+)\s+samples\s+\[(?P<units>\w+)\]
-        (?P<min_max_sum>\s+(?P<min>\d+)\s+(?P<max>\d+)\s+(?P<sum>\d+)
-        (?P<sumsq>\s+(?P<sumsquare>\d+))?)?
-        $
-        """,
-            re.VERBOSE,
-        )
-
+    def _parse_stats_path(self, path):
+        """Returns a dict of stat name to Stat from Lustre stats file contents."""
         stats = {}
 
         # There is a potential race between the time that an OBD module
@@ -115,34 +133,104 @@ class LustreAudit(BaseAudit, FileSystemMixin, LustreGetParamMixin):
         # excepting IOErrors as a general rule, but I suppose this is
         # the least-worst solution.
         try:
-            for line in self.get_param_lines(path):
-                match = re.match(stats_re, line)
-                if not match:
-                    continue
-
-                name = match.group("name")
-                stats[name] = {
-                    "count": int(match.group("count")),
-                    "units": match.group("units"),
-                }
-                if match.group("min_max_sum") is not None:
-                    stats[name].update(
-                        {
-                            "min": int(match.group("min")),
-                            "max": int(match.group("max")),
-                            "sum": int(match.group("sum")),
-                        }
-                    )
-                if match.group("sumsq") is not None:
-                    stats[name].update({"sumsquare": int(match.group("sumsquare"))})
-        except Exception:
-            return stats
+            parse_stats(self.get_param_lines(path), stats)
+        except IOError:
+            pass
 
         return stats
 
+    def stats_dict_from_path(self, path):
+        """Creates a dict from Lustre stats file contents."""
+        return dict(
+            (name, stat.as_dict())
+            for name, stat in self._parse_stats_path(path).items()
+        )
+
+    def counters(self):
+        """Returns the cumulative counters of the stats in COUNTER_PARAMS, as a dict of
+        "param/stat/count" and "param/stat/sum" to value.
+
+        Only stats are read, so this may be called between scans.
+        """
+        counters = {}
+        for pattern in self.COUNTER_PARAMS:
+            for param in self.list_params(pattern):
+                for name, stat in self._parse_stats_path(param).items():
+                    counters["%s/%s/count" % (param, name)] = stat.count
+                    if stat.sum is not None:
+                        counters["%s/%s/sum" % (param, name)] = stat.sum
+        return counters
+
+    def job_stats(self, path):
+        """Returns the most active jobs since the last scan from a job_stats param,
+        e.g. obdfilter.testfs-OST0000.job_stats, see JobStatsCollector.
+        """
+        collector = self._job_stats_collectors.get(path)
+        if collector is None:
+            collector = self._job_stats_collectors[path] = JobStatsCollector(
+                JOB_STATS_LIMIT, JOB_STATS_HISTORY, JOB_STATS_KEY
+            )
+
+        try:
+            return collector.collect(self.stream_param_lines(path))
+        except Exception:
+            # e.g. job_stats is not enabled on this target
+            return []
+
+    def brw_stats(self, path):
+        """Returns the change in the histograms of a brw_stats param since the last scan,
+        e.g. obdfilter.testfs-OST0000.brw_stats, see BrwStatsCollector.
+        """
+        if DISABLE_BRW_STATS:
+            return {}
+
+        collector = self._brw_stats_collectors.get(path)
+        if collector is None:
+            collector = self._brw_stats_collectors[path] = BrwStatsCollector()
+
+        try:
+            return collector.collect(self.stream_param_lines(path))
+        except Exception:
+            return {}
+
+    def export_stats(self, path):
+        """Returns the clients most active since the last scan from the stats of the exports
+        matching path, e.g. obdfilter.*.exports.*.stats, see ExportStatsCollector.
+        """
+        collector = self._export_stats_collectors.get(path)
+        if collector is None:
+            collector = self._export_stats_collectors[path] = ExportStatsCollector(
+                EXPORT_STATS_LIMIT, EXPORT_STATS_HISTORY, EXPORT_STATS_KEY
+            )
+
+        try:
+            return collector.collect(self.stream_params(path))
+        except Exception:
+            return []
+
+    def _prune_collectors(self):
+        """Drops the collectors kept for params of devices which are no longer local, e.g. the
+        job_stats of a target which has been unmounted, so that they do not build up from scan to
+        scan.  A collector's path is of its device's type and name, the name possibly a glob.
+        """
+        devices = [(dev["type"], dev["name"]) for dev in self.devices()]
+
+        for collectors in [
+            self._job_stats_collectors,
+            self._brw_stats_collectors,
+            self._export_stats_collectors,
+        ]:
+            for path in collectors.keys():
+                device_type, device_name = path.split(".")[:2]
+                if not any(
+                    dev_type == device_type and fnmatch.fnmatch(dev_name, device_name)
+                    for dev_type, dev_name in devices
+                ):
+                    del collectors[path]
+
     def dict_from_path(self, path):
         """Creates a dict from simple dict-like (k\s+v) file contents."""
-        return dict(re.split("\s+", line) for line in self.get_param_lines(path))
+        return parse_pairs(self.get_param_lines(path))
 
     @property
     def version(self):
@@ -179,6 +267,9 @@ class LustreAudit(BaseAudit, FileSystemMixin, LustreGetParamMixin):
 
     def devices(self):
         """Returns a list of Lustre devices local to this node."""
+        return self.context.cached("devices", self._devices)
+
+    def _devices(self):
         try:
             return [
                 dict(
@@ -197,5 +288,90 @@ class LustreAudit(BaseAudit, FileSystemMixin, LustreGetParamMixin):
 
     def metrics(self):
         """Returns a hash of metric values."""
+        self.prefetch_params(self.SCAN_PARAMS)
         self._gather_raw_metrics()
         return {"raw": self.raw_metrics}
+
+
+class TargetAudit(LustreAudit):
+    """Parent class for the audits of Lustre targets.
+
+    Reports the metrics of each local device of the type named by the
+    class, e.g. those of type mdt for MdtAudit, by the device's name.
+    """
+
+    # The param of each target with its operation counters, e.g. md_stats for
+    # mdt.testfs-MDT0000.md_stats
+    STATS_PARAM = "stats"
+
+    @classmethod
+    def target_type(cls):
+        return cls.__name__.replace("Audit", "").lower()
+
+    def targets(self):
+        """Returns the names of the local targets of this class' type."""
+        return [
+            dev["name"] for dev in self.devices() if dev["type"] == self.target_type()
+        ]
+
+    def target_param(self, target, param):
+        """Returns the path of one of a target's params."""
+        return self.join_param(self.target_type(), target, param)
+
+    def target_metrics(self, target):
+        """Returns a dict of the metrics of one target."""
+        return {
+            "stats": self.stats_dict_from_path(
+                self.target_param(target, self.STATS_PARAM)
+            ),
+            "job_stats": self.job_stats(self.target_param(target, "job_stats")),
+        }
+
+    def _gather_raw_metrics(self):
+        targets = self.targets()
+        self.prefetch_params(
+            [self.target_param(target, self.STATS_PARAM) for target in targets]
+        )
+
+        metrics = self.raw_metrics["lustre"].setdefault("target", {})
+        for target in targets:
+            metrics[target] = self.target_metrics(target)
+
+        # The most active clients of all the targets of this type together, by their nids
+        if targets:
+            self.raw_metrics["lustre"].setdefault("clients", {})[
+                self.target_type()
+            ] = self.export_stats(self.target_param("*", "exports.*.stats"))
+
+        self._prune_collectors()
+
+
+class MdtAudit(TargetAudit):
+    STATS_PARAM = "md_stats"
+    COUNTER_PARAMS = ["mdt.*.md_stats"]
+
+
+class ObdfilterAudit(TargetAudit):
+    COUNTER_PARAMS = ["obdfilter.*.stats"]
+
+    def target_metrics(self, target):
+        metrics = super(ObdfilterAudit, self).target_metrics(target)
+        metrics["brw_stats"] = self.brw_stats(self.target_param(target, "brw_stats"))
+        return metrics
+
+    @classmethod
+    def kmod_is_loaded(cls, context=None):
+        """OSTs are served by the ofd module since Lustre 2.4, though their
+        devices are still of type obdfilter.
+        """
+
+        def filter(line):
+            return line.split(" ", 1)[0] in ("ofd", "obdfilter")
+
+        obj = cls(context=context)
+        try:
+            modules = list(obj.read_lines("/proc/modules", filter))
+        except IOError:
+            modules = []
+
+        return len(modules) > 0
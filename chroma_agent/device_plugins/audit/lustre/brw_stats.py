@@ -0,0 +1,211 @@
+# Copyright (c) 2018 DDN. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+"""
+Collect the I/O histograms from an OST's brw_stats.
+
+brw_stats is a series of tables, each a histogram of read and write counts by bucket:
+
+                           read      |     write
+disk I/O size          ios   % cum % |  ios         % cum %
+4K:                      3  37  37   |    0   0   0
+8K:                      5  62 100   |   54 100 100
+
+Lustre only prints the rows from the first to the last nonzero bucket, so the rows shift as the
+range of buckets in use grows.  Each table is parsed straight into arrays of counts, one element per
+row, and reported as the change in each bucket since the previous scan, matched by bucket label:
+
+{"disk_iosize": {"units": "ios", "buckets": ["4K", "8K"], "read": [3, 5], "write": [0, 54]}}
+"""
+
+import re
+import copy
+import array
+
+
+# Lustre's histograms have at most this many buckets (OBD_HIST_MAX)
+MAX_BUCKETS = 32
+
+HISTOGRAM_NAMES = {
+    "pages per bulk r/w": "pages",
+    "discontiguous pages": "discont_pages",
+    "discontiguous blocks": "discont_blocks",
+    "disk fragmented I/Os": "dio_frags",
+    "disk I/Os in flight": "rpc_hist",
+    "I/O time (1/1000s)": "io_time",
+    "disk I/O size": "disk_iosize",
+}
+
+HEADER_RE = re.compile(
+    r"""
+# e.g.
+# disk I/O size          ios   % cum % |  ios         % cum %
+^(?P<name>.+?)\s+(?P<units>\w+)\s+%\s+cum\s+%\s*\|
+""",
+    re.VERBOSE,
+)
+
+
+def histogram_key(name):
+    return HISTOGRAM_NAMES.get(name) or re.sub(r"\W+", "_", name.lower()).strip("_")
+
+
+class Histogram(object):
+    """Read and write counts of one brw_stats histogram, with those of the previous scan"""
+
+    __slots__ = ["units", "buckets", "read", "write", "previous"]
+
+    def __init__(self, units):
+        self.units = units
+        # Labels of the rows parsed this scan, and their counts by position
+        self.buckets = []
+        self.read = array.array("L", [0] * MAX_BUCKETS)
+        self.write = array.array("L", [0] * MAX_BUCKETS)
+        # Bucket label to (read, write) counts of the previous scan
+        self.previous = {}
+
+    def start_scan(self):
+        """Make the counts just collected the previous scan's, ready to collect again"""
+        self.previous = dict(
+            (bucket, (self.read[index], self.write[index]))
+            for index, bucket in enumerate(self.buckets)
+        )
+        self.buckets = []
+        for index in range(MAX_BUCKETS):
+            self.read[index] = 0
+            self.write[index] = 0
+
+    def deltas(self):
+        """
+        :return: (read, write) lists of the change in each bucket since the previous scan, or None if
+                 there has been none
+        """
+        count = len(self.buckets)
+        read = self.read[:count]
+        write = self.write[:count]
+        previous = [self.previous.get(bucket, (0, 0)) for bucket in self.buckets]
+
+        # Counts go backwards when the stats are cleared (e.g. the target was remounted), in which
+        # case everything since is new.  A bucket no longer printed has gone back to zero.
+        cleared = any(
+            read[index] < previous[index][0] or write[index] < previous[index][1]
+            for index in range(count)
+        ) or any(
+            any(counts)
+            for bucket, counts in self.previous.items()
+            if bucket not in self.buckets
+        )
+        if not cleared:
+            for index in range(count):
+                read[index] -= previous[index][0]
+                write[index] -= previous[index][1]
+
+        if not any(read) and not any(write):
+            return None
+
+        return read.tolist(), write.tolist()
+
+
+class BrwStatsCollector(object):
+    """Reports the change in an OST's brw_stats histograms since the previous collect()"""
+
+    def __init__(self):
+        # Histogram by key
+        self._histograms = {}
+
+    def _parse(self, lines):
+        for histogram in self._histograms.values():
+            histogram.start_scan()
+
+        histogram = None
+
+        for line in lines:
+            if "|" in line:
+                match = HEADER_RE.match(line.strip())
+                if match:
+                    key = histogram_key(match.group("name"))
+                    histogram = self._histograms.get(key)
+                    if histogram is None:
+                        histogram = self._histograms[key] = Histogram(
+                            match.group("units")
+                        )
+                        histogram.start_scan()
+                    continue
+
+                if histogram is None:
+                    continue
+
+                # e.g. 4K:                      3  37  37   |    0   0   0
+                bucket, _, counts = line.partition(":")
+                fields = counts.split()
+                index = len(histogram.buckets)
+                if len(fields) < 5 or index >= MAX_BUCKETS:
+                    continue
+
+                try:
+                    histogram.read[index] = int(fields[0])
+                    histogram.write[index] = int(fields[4])
+                except ValueError:
+                    continue
+
+                histogram.buckets.append(bucket.strip())
+            elif not line.strip():
+                histogram = None
+
+    def collect(self, lines):
+        """
+        :param lines: Iterable of lines of brw_stats
+        :return: dict of histogram key to a dict of its units, bucket labels and the change in the read
+                 and write counts of each bucket since the previous collection, for each histogram
+                 which has changed
+        """
+        self._parse(lines)
+
+        histograms = {}
+        for key, histogram in self._histograms.items():
+            deltas = histogram.deltas()
+            if deltas is not None:
+                histograms[key] = {
+                    "units": histogram.units,
+                    "buckets": list(histogram.buckets),
+                    "read": deltas[0],
+                    "write": deltas[1],
+                }
+
+        return histograms
+
+
+def merge_histograms(earlier, later):
+    """
+    Add the counts of an earlier BrwStatsCollector.collect() into those of the next one, e.g. when
+    the earlier report is replaced by the later before it is sent.
+
+    :param earlier: dict of histogram key to histogram from collect()
+    :param later: dict of histogram key to histogram from the following collect(), updated in place
+    :return: later, with each bucket's read and write counts including earlier's
+    """
+    for key, histogram in earlier.items():
+        merged = later.get(key)
+        if merged is None:
+            later[key] = copy.deepcopy(histogram)
+            continue
+
+        # Matched by bucket label, as later may have rows earlier did not
+        positions = dict(
+            (bucket, index) for index, bucket in enumerate(merged["buckets"])
+        )
+        for bucket, read, write in zip(
+            histogram["buckets"], histogram["read"], histogram["write"]
+        ):
+            index = positions.get(bucket)
+            if index is None:
+                merged["buckets"].append(bucket)
+                merged["read"].append(read)
+                merged["write"].append(write)
+            else:
+                merged["read"][index] += read
+                merged["write"][index] += write
+
+    return later
@@ -0,0 +1,173 @@
+# Copyright (c) 2018 DDN. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+"""
+Find the clients most active on a server's targets from their per-export stats.
+
+A target has an export for every client connected to it, each with its own stats, e.g.
+obdfilter.testfs-OST0000.exports.192.168.0.1@tcp.stats, so a server with many clients has tens of
+thousands of them.  They are read one at a time as they are found, and only a bounded number of
+exports is kept however many there are.
+"""
+
+import copy
+import heapq
+import itertools
+
+from chroma_agent.device_plugins.audit.lustre.stats_parser import parse_stats
+
+EXPORTS = ".exports."
+STATS = ".stats"
+
+
+def export_target_nid(name):
+    """
+    :param name: An export's stats param, e.g. obdfilter.testfs-OST0000.exports.192.168.0.1@tcp.stats
+    :return: (target, nid), e.g. ("testfs-OST0000", "192.168.0.1@tcp"), or None if name is not one
+    """
+    target, sep, nid = name.partition(EXPORTS)
+    if not sep or not nid.endswith(STATS):
+        return None
+
+    return target.split(".")[-1], nid[: -len(STATS)]
+
+
+def export_totals(stats):
+    """:return: (operations, bytes read, bytes written) of an export's parse_stats()"""
+    ops = sum(stat.count for stat in stats.values())
+    read_bytes = stats["read_bytes"].sum if "read_bytes" in stats else None
+    write_bytes = stats["write_bytes"].sum if "write_bytes" in stats else None
+    return ops, read_bytes or 0, write_bytes or 0
+
+
+class ExportStatsCollector(object):
+    """
+    Reports the clients most active since the previous collect() of the same exports, with the
+    operations they performed and the bytes they read and wrote since then, summed over their
+    exports.
+
+    Totals from the previous collection are kept for at most history exports, those most active
+    since it, then the largest of the rest, so memory is bounded by history rather than by the
+    number of exports.  An export without totals from the previous collection, new or not among
+    them, is not reported until the next, when there is something to compare it with.
+    """
+
+    def __init__(self, limit, history=None, key="ops"):
+        """
+        :param limit: Number of clients to report
+        :param history: Number of exports to keep totals for, at least limit
+        :param key: Rank clients by "ops", the number of operations, or "bytes", the bytes read and
+                    written
+        """
+        self.limit = limit
+        self.history = max(limit, history or limit * 500)
+        self.key = key
+        # Export name to (ops, read_bytes, write_bytes) as at the previous collection
+        self._previous = {}
+
+    def _score(self, totals):
+        if self.key == "bytes":
+            return totals[1] + totals[2]
+
+        return totals[0]
+
+    def collect(self, exports):
+        """
+        :param exports: Iterable of (name, lines) of each export's stats param, each lines being
+                        read before the next export
+        :return: List of up to limit clients, most active first, each a dict of its nid, the targets
+                 it was active on and its ops, read_bytes and write_bytes since the previous
+                 collection
+        """
+        # Min heap of the exports to keep, (score, total score, sequence, name, totals, deltas)
+        heap = []
+        sequence = itertools.count()
+
+        for name, lines in exports:
+            if export_target_nid(name) is None:
+                continue
+
+            totals = export_totals(parse_stats(lines))
+            previous = self._previous.get(name)
+
+            if previous is None:
+                deltas = None
+            elif totals[0] < previous[0]:
+                # Counters go backwards when the client reconnects, everything since is new
+                deltas = totals
+            else:
+                deltas = tuple(total - last for total, last in zip(totals, previous))
+
+            entry = (
+                self._score(deltas) if deltas else 0,
+                self._score(totals),
+                next(sequence),
+                name,
+                totals,
+                deltas,
+            )
+            if len(heap) < self.history:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
+
+        self._previous = dict((name, totals) for _, _, _, name, totals, _ in heap)
+
+        # A client's exports on each of the targets, summed
+        clients = {}
+        for score, _, _, name, _, deltas in heap:
+            if not score:
+                continue
+
+            target, nid = export_target_nid(name)
+            client = clients.get(nid)
+            if client is None:
+                client = clients[nid] = {
+                    "nid": nid,
+                    "targets": [],
+                    "ops": 0,
+                    "read_bytes": 0,
+                    "write_bytes": 0,
+                }
+            client["targets"].append(target)
+            client["ops"] += deltas[0]
+            client["read_bytes"] += deltas[1]
+            client["write_bytes"] += deltas[2]
+
+        for client in clients.values():
+            client["targets"].sort()
+
+        return heapq.nlargest(
+            self.limit,
+            clients.values(),
+            key=lambda client: self._score(
+                (client["ops"], client["read_bytes"], client["write_bytes"])
+            ),
+        )
+
+
+def merge_clients(earlier, later):
+    """
+    Add the counts of the clients of an earlier ExportStatsCollector.collect() into those of the next
+    one, e.g. when the earlier report is replaced by the later before it is sent.
+
+    :param earlier: List of clients from collect()
+    :param later: List of clients from the following collect(), updated in place
+    :return: later, with each of its clients' ops and bytes including earlier's, followed by the
+             clients only in earlier
+    """
+    clients = dict((client["nid"], client) for client in later)
+
+    for client in earlier:
+        merged = clients.get(client["nid"])
+        if merged is None:
+            later.append(copy.deepcopy(client))
+            continue
+
+        merged["targets"] = sorted(set(merged["targets"]) | set(client["targets"]))
+        for key in ["ops", "read_bytes", "write_bytes"]:
+            merged[key] += client[key]
+
+    return later
@@ -0,0 +1,208 @@
+# Copyright (c) 2018 DDN. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+"""
+Collect the most active jobs from a target's job_stats.
+
+job_stats has an entry for every job the target has seen recently, which on a busy server can be
+megabytes of output, so it is parsed a line at a time and only a bounded number of jobs is kept
+however many there are:
+
+job_stats:
+- job_id:          dd.0
+  snapshot_time:   1537070542
+  read_bytes:      { samples:           0, unit: bytes, min:       0, max:       0, sum:               0 }
+  write_bytes:     { samples:          20, unit: bytes, min: 1048576, max: 1048576, sum:        20971520 }
+  getattr:         { samples:           0, unit:  reqs }
+"""
+
+import re
+import copy
+import heapq
+import itertools
+
+
+SAMPLES_RE = re.compile(r"samples:\s*(\d+)")
+UNIT_RE = re.compile(r"unit:\s*(\w+)")
+SUM_RE = re.compile(r"\bsum:\s*(\d+)")
+
+BYTES_OPS = ("read_bytes", "write_bytes")
+
+
+def parse_job_stats(lines):
+    """
+    Parse job_stats a line at a time.
+
+    :param lines: Iterable of lines of job_stats
+    :return: Generator of (job_id, snapshot_time, ops) for each job, where ops is a dict of
+             operation name to (samples, unit, sum), sum being None for operations without one
+    """
+    job_id = None
+    snapshot_time = 0
+    ops = {}
+
+    for line in lines:
+        line = line.strip()
+        if line.startswith("- job_id:"):
+            if job_id is not None:
+                yield job_id, snapshot_time, ops
+            job_id = line[len("- job_id:") :].strip().strip("\"'")
+            snapshot_time = 0
+            ops = {}
+        elif job_id is None:
+            continue
+        elif line.startswith("snapshot_time:"):
+            try:
+                snapshot_time = int(line.split(":", 1)[1].strip().split(".")[0])
+            except ValueError:
+                pass
+        elif "{" in line:
+            name, _, values = line.partition(":")
+            samples = SAMPLES_RE.search(values)
+            if samples is None:
+                continue
+            unit = UNIT_RE.search(values)
+            total = SUM_RE.search(values)
+            ops[name.strip()] = (
+                int(samples.group(1)),
+                unit.group(1) if unit else None,
+                int(total.group(1)) if total else None,
+            )
+
+    if job_id is not None:
+        yield job_id, snapshot_time, ops
+
+
+class JobStatsCollector(object):
+    """
+    Reports the jobs most active since the previous collect() of the same job_stats, with their
+    operation counts and sums since then.
+
+    Totals from the previous collection are kept for at most history jobs, those most active since
+    it, then the largest of the rest, so memory is bounded by history rather than by the number of
+    jobs.  A job without totals from the previous collection, new or not among them, is not
+    reported until the next, when there is something to compare it with.
+    """
+
+    def __init__(self, limit, history=None, key="ops"):
+        """
+        :param limit: Number of jobs to report
+        :param history: Number of jobs to keep totals for, at least limit
+        :param key: Rank jobs by "ops", the number of operations, or "bytes", the bytes read and
+                    written
+        """
+        self.limit = limit
+        self.history = max(limit, history or limit * 50)
+        self.key = key
+        # job_id to its ops as at the previous collection
+        self._previous = {}
+
+    def _score(self, ops):
+        if self.key == "bytes":
+            return sum(ops[op][2] or 0 for op in BYTES_OPS if op in ops)
+
+        return sum(samples for samples, _, _ in ops.values())
+
+    @staticmethod
+    def _deltas(ops, previous_ops):
+        deltas = {}
+        for name, (samples, unit, total) in ops.items():
+            previous_samples, _, previous_total = previous_ops.get(name, (0, None, 0))
+            # Counters go backwards when Lustre clears the job (e.g. job_cleanup_interval)
+            if samples < previous_samples:
+                previous_samples, previous_total = 0, 0
+            deltas[name] = (
+                samples - previous_samples,
+                unit,
+                None if total is None else total - (previous_total or 0),
+            )
+
+        return deltas
+
+    def collect(self, lines):
+        """
+        :param lines: Iterable of lines of job_stats
+        :return: List of up to limit jobs, most active first, each a dict of job_id, snapshot_time and
+                 for each operation performed since the previous collection, its samples and sum
+        """
+        # Min heap of the jobs to keep, (score, total score, sequence, job_id, snapshot_time, ops, deltas)
+        heap = []
+        sequence = itertools.count()
+
+        for job_id, snapshot_time, ops in parse_job_stats(lines):
+            previous = self._previous.get(job_id)
+
+            if previous is None:
+                score, deltas = 0, None
+            else:
+                # Compared by counts rather than snapshot_time, which only has whole seconds, so that
+                # updates in the same second as the previous collection are not lost
+                deltas = self._deltas(ops, previous)
+                score = self._score(deltas)
+
+            entry = (
+                score,
+                self._score(ops),
+                next(sequence),
+                job_id,
+                snapshot_time,
+                ops,
+                deltas,
+            )
+            if len(heap) < self.history:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
+
+        self._previous = dict((job_id, ops) for _, _, _, job_id, _, ops, _ in heap)
+
+        jobs = []
+        for score, _, _, job_id, snapshot_time, _, deltas in heapq.nlargest(
+            self.limit, heap
+        ):
+            if not score:
+                break
+
+            job = {"job_id": job_id, "snapshot_time": snapshot_time}
+            for name, (samples, unit, total) in deltas.items():
+                if samples:
+                    job[name] = {"samples": samples, "unit": unit}
+                    if total is not None:
+                        job[name]["sum"] = total
+            jobs.append(job)
+
+        return jobs
+
+
+def merge_jobs(earlier, later):
+    """
+    Add the counts of the jobs of an earlier JobStatsCollector.collect() into those of the next one,
+    e.g. when the earlier report is replaced by the later before it is sent.
+
+    :param earlier: List of jobs from collect()
+    :param later: List of jobs from the following collect(), updated in place
+    :return: later, with each of its jobs' samples and sums including earlier's, followed by the
+             jobs only in earlier
+    """
+    jobs = dict((job["job_id"], job) for job in later)
+
+    for job in earlier:
+        merged = jobs.get(job["job_id"])
+        if merged is None:
+            later.append(copy.deepcopy(job))
+            continue
+
+        for name, op in job.items():
+            if not isinstance(op, dict):
+                continue
+            if name not in merged:
+                merged[name] = dict(op)
+                continue
+
+            merged[name]["samples"] += op["samples"]
+            if "sum" in op:
+                merged[name]["sum"] = merged[name].get("sum", 0) + op["sum"]
+
+    return later
@@ -0,0 +1,169 @@
+# Copyright (c) 2018 DDN. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+"""
+Parsers for Lustre stats files, which are read for every target on every scan.
+
+Lines are split on whitespace and checked field by field.  The regular expression is only tried
+on lines which look like stats but are not in the usual form, so the usual line costs a split and a
+few int() calls.
+"""
+
+import re
+import functools
+from collections import namedtuple
+
+
+STATS_RE = re.compile(
+    r"""
+# e.g.
+# create                    726 samples [reqs]
+# cache_miss                21108 samples [pages] 1 1 21108
+# obd_ping                  1108 samples [usec] 15 72 47014 2156132
+^
+(?P<name>\w+)\s+(?P<count>\d+)\s+samples\s+\[(?P<units>\w+)\]
+(?P<min_max_sum>\s+(?P<min>\d+)\s+(?P<max>\d+)\s+(?P<sum>\d+)
+(?P<sumsq>\s+(?P<sumsquare>\d+))?)?
+$
+""",
+    re.VERBOSE,
+)
+
+
+class Stat(namedtuple("Stat", ["count", "units", "min", "max", "sum", "sumsquare"])):
+    """One line of a stats file, min, max, sum and sumsquare being None where it has none"""
+
+    __slots__ = ()
+
+    def as_dict(self):
+        """The dict reported for the stat in the audit's metrics"""
+        count, units, min_, max_, sum_, sumsquare = self
+        if min_ is None:
+            return {"count": count, "units": units}
+        if sumsquare is None:
+            return {
+                "count": count,
+                "units": units,
+                "min": min_,
+                "max": max_,
+                "sum": sum_,
+            }
+        return {
+            "count": count,
+            "units": units,
+            "min": min_,
+            "max": max_,
+            "sum": sum_,
+            "sumsquare": sumsquare,
+        }
+
+
+def _is_word(value):
+    """Equivalent to matching \\w+$, for the usual case without the regular expression"""
+    return value.replace("_", "a").isalnum()
+
+
+# Stat() without the namedtuple's argument handling, for the fast path
+_new_stat = functools.partial(tuple.__new__, Stat)
+
+
+def _parse_fields(fields):
+    """:return: (name, Stat) for the whitespace separated fields of a line, or None if they are not
+    a stat in the usual form"""
+    length = len(fields)
+    name, count, _, units = fields[:4]
+    if (
+        units[0] != "["
+        or units[-1] != "]"
+        or not count.isdigit()
+        or not _is_word(name)
+        or not _is_word(units[1:-1])
+    ):
+        return None
+
+    if length == 4:
+        return name, _new_stat((int(count), units[1:-1], None, None, None, None))
+
+    if length == 7:
+        fields.append(None)
+    elif length != 8:
+        return None
+
+    min_, max_, sum_, sumsquare = fields[4:]
+    if not (
+        min_.isdigit()
+        and max_.isdigit()
+        and sum_.isdigit()
+        and (sumsquare is None or sumsquare.isdigit())
+    ):
+        return None
+
+    return (
+        name,
+        _new_stat(
+            (
+                int(count),
+                units[1:-1],
+                int(min_),
+                int(max_),
+                int(sum_),
+                None if sumsquare is None else int(sumsquare),
+            )
+        ),
+    )
+
+
+def _int_or_none(value):
+    return None if value is None else int(value)
+
+
+def _parse_re(line):
+    match = STATS_RE.match(line)
+    if not match:
+        return None
+
+    return (
+        match.group("name"),
+        Stat(
+            int(match.group("count")),
+            match.group("units"),
+            _int_or_none(match.group("min")),
+            _int_or_none(match.group("max")),
+            _int_or_none(match.group("sum")),
+            _int_or_none(match.group("sumsquare")),
+        ),
+    )
+
+
+def parse_stats(lines, stats=None):
+    """
+    :param lines: Iterable of lines of a stats file
+    :param stats: dict to add the stats to as they are parsed, so that those parsed before lines
+                  raises are kept, a new one if not given
+    :return: dict of stat name to Stat, lines which are not stats (e.g. snapshot_time) are skipped
+    """
+    if stats is None:
+        stats = {}
+
+    for line in lines:
+        fields = line.split()
+        # Anything else, e.g. snapshot_time, is not a stat
+        if len(fields) < 4 or fields[2] != "samples":
+            continue
+
+        parsed = _parse_fields(fields) or _parse_re(line.strip())
+        if parsed is not None:
+            stats[parsed[0]] = parsed[1]
+
+    return stats
+
+
+def parse_pairs(lines):
+    """
+    :param lines: Iterable of lines of a file of "key value" lines
+    :return: dict of key to value
+    :raises ValueError: If a line is not exactly a key and a value
+    """
+    return dict(line.split() for line in lines)
@@ -5,12 +5,21 @@
 
 import os
 from chroma_agent.lib.shell import AgentShell
+from chroma_agent.lib.lustre_params import (
+    LustreParams,
+    iter_get_param_output,
+    split_get_param_output,
+)
 
 
 class LustreGetParamMixin(object):
     """Mixin for Audit subclasses.  Classes that inherit from
     this mixin will get some convenience methods for interacting with a
     lctl get_param.
+
+    Parameters are read directly from /sys and /proc where they can be found there, lctl is only run
+    for those that cannot.  prefetch_params() reads all of those a caller is going to need with one
+    lctl, rather than one each.
     """
 
     def _get_param(self, *args):
@@ -19,13 +28,61 @@ class LustreGetParamMixin(object):
             ["lctl", "get_param"] + [x.replace("/", ".") for x in args]
         )
 
+    @property
+    def _native_params(self):
+        return LustreParams(getattr(self, "fscontext", "/"))
+
+    @property
+    def _param_snapshot(self):
+        """Values read so far, by path, shared with the other audits in a scan where there is one"""
+        context = getattr(self, "context", None)
+        if context is not None:
+            return context.params
+
+        return self.__dict__.setdefault("_prefetched_params", {})
+
+    def prefetch_params(self, paths):
+        """
+        Fetch those of paths which cannot be read natively with a single lctl get_param, so that
+        reading them afterwards does not run lctl for each.  The values are kept for the life of this
+        object's scan context, or of this object if it has none.
+
+        Paths matching nothing are left to be read (and fail) as they would have been.
+        """
+        native = self._native_params
+        paths = [
+            path
+            for path in paths
+            if path not in self._param_snapshot and not native.resolve(path)
+        ]
+        if not paths:
+            return
+
+        # lctl returns nonzero if any path is missing, but still outputs the others
+        result = AgentShell.run(
+            ["lctl", "get_param"] + [path.replace("/", ".") for path in paths]
+        )
+        self._param_snapshot.update(split_get_param_output(result.stdout, paths))
+
+    def _read_param(self, path):
+        """The value(s) of the param, as lctl get_param -n would output them"""
+        snapshot = self._param_snapshot
+        if path in snapshot:
+            return snapshot[path]
+
+        value = self._native_params.read(path)
+        if value is None:
+            value = self._get_param("-n", path)
+        snapshot[path] = value
+        return value
+
     def get_param_lines(self, path, filter_f=None):
         """Return a generator for stripped lines read from the param.
 
         If the optional filter_f argument is supplied, it will be applied
         prior to stripping each line.
         """
-        stdout = self._get_param("-n", path).strip()
+        stdout = self._read_param(path).strip()
 
         if stdout:
             for line in stdout.split("\n"):
@@ -35,8 +92,57 @@ class LustreGetParamMixin(object):
                 else:
                     yield line
 
+    def stream_param_lines(self, path):
+        """Return a generator for the lines of the param, for params too large to hold in memory.
+
+        Where the param can be read natively the lines are read from it as they are used, and not
+        kept in the scan context as other reads are.  Otherwise they come from lctl.
+        """
+        matches = self._native_params.resolve(path)
+        if not matches:
+            for line in self.get_param_lines(path):
+                yield line
+            return
+
+        for _, match in matches:
+            for line in self._stream_file(match):
+                yield line
+
+    @staticmethod
+    def _stream_file(filename):
+        try:
+            with open(filename) as f:
+                for line in f:
+                    yield line.rstrip("\n")
+        except IOError:
+            # Gone since it was resolved, e.g. the target was unmounted
+            pass
+
+    def stream_params(self, path):
+        """Return a generator of (name, lines) for each param matching path, for paths matching too
+        many params to list (e.g. every export of a target).  Each param's lines are a generator as
+        from stream_param_lines(), to be used before moving on to the next param.
+
+        Where path can be read natively the params are found as they are used, otherwise their
+        values all come from one lctl.
+        """
+        found = False
+        for name, match in self._native_params.iterate(path):
+            found = True
+            yield name, self._stream_file(match)
+        if found:
+            return
+
+        try:
+            output = self._get_param(path)
+        except AgentShell.CommandExecutionError:
+            return
+
+        for name, _, lines in iter_get_param_output(output, [path]):
+            yield name, iter(lines)
+
     def get_param_raw(self, path):
-        return self._get_param("-n", path)
+        return self._read_param(path)
 
     def get_param_string(self, path):
         """Read the first line from a param and return it as a string."""
@@ -57,6 +163,10 @@ class LustreGetParamMixin(object):
 
     def list_params(self, path):
         """Return list of parameters found in path.  Or [] if none, or get_param fails."""
+        names = self._native_params.list(path)
+        if names is not None:
+            return names
+
         try:
             return self._get_param("-N", path).strip().split("\n")
         except AgentShell.CommandExecutionError:
@@ -88,7 +198,16 @@ class FileSystemMixin(object):
 
         filename = self.abs(filename)
 
-        for line in open(filename):
+        context = getattr(self, "context", None)
+        if context is not None:
+            if filename not in context.files:
+                with open(filename) as f:
+                    context.files[filename] = f.readlines()
+            lines = context.files[filename]
+        else:
+            lines = open(filename)
+
+        for line in lines:
             if filter_f:
                 if filter_f(line):
                     yield line.rstrip("\n")
@@ -5,9 +5,17 @@
 
 import re
 import os
+import errno
+import select
+import socket
+import threading
 from collections import defaultdict
 from collections import namedtuple
 
+from chroma_agent import config, DEFAULT_AGENT_CONFIG
+from chroma_agent.lib import netlink
+from chroma_agent.lib.lustre_params import LustreParams
+from chroma_agent.lib.monotonic import monotonic
 from chroma_agent.lib.shell import AgentShell
 from chroma_agent.log import daemon_log
 from chroma_agent.plugin_manager import DevicePlugin
@@ -15,6 +23,40 @@ from chroma_agent.plugin_manager import DevicePlugin
 
 EXCLUDE_INTERFACES = ["lo"]
 
+SYS_CLASS_NET = "sys/class/net"
+SYS_MODULE = "sys/module"
+LNET_MODULE = "sys/module/lnet"
+
+# Link types from /sys/class/net/*/type (ARPHRD_* in <linux/if_arp.h>) by the name ip addr gives them
+ARPHRD_TYPES = {1: "ether", 32: "infiniband", 772: "loopback"}
+
+# Link flags from /sys/class/net/*/flags (<linux/if.h>)
+IFF_UP = 0x1
+IFF_SLAVE = 0x800
+
+# Fields of an interface which are counters, reported apart from the rest of the interface so that
+# their constant change does not cause the topology to be resent
+COUNTER_FIELDS = ["rx_bytes", "tx_bytes"]
+
+
+def _agent_setting(name):
+    try:
+        agent_settings = config.get("settings", "agent")
+    except KeyError:
+        agent_settings = {}
+
+    return agent_settings.get(name, DEFAULT_AGENT_CONFIG[name])
+
+
+def counter_period():
+    """:return: Seconds between reports of the interface counters, 0 if they are not reported"""
+    return _agent_setting("network_counter_period")
+
+
+def change_listener_enabled():
+    """:return: True if NetworkChangeListener should be used where it can be"""
+    return _agent_setting("network_change_listener")
+
 
 class NetworkInterface(object):
     """Created with an array of lines that are the output from ifconfig, this class will
@@ -26,6 +68,9 @@ class NetworkInterface(object):
 
     RXTXStats = namedtuple("RXTXStats", ["rx_bytes", "tx_bytes"])
 
+    # Every address of the interface, primary, secondary and IPv6, in the order ip addr lists them
+    address_match = "\s*inet6? (?P<address>[^/\s]*).*"
+
     def __init__(self, ip_output_lines, rx_tx_stats):
         match_values = [
             "([0-9]*):(\s*)(?P<interface>[^:]*).*",
@@ -40,6 +85,7 @@ class NetworkInterface(object):
 
         # Set some defaults
         self._values["up"] = "DOWN"
+        self.addresses = []
 
         for line in ip_output_lines:
             for match_value in match_values:
@@ -47,6 +93,10 @@ class NetworkInterface(object):
                 if m:
                     self._values.update(m.groupdict())
 
+            m = re.match(self.address_match, line)
+            if m:
+                self.addresses.append(m.group("address"))
+
         try:
             self.rx_tx_stats = rx_tx_stats[self.interface]
         except KeyError:
@@ -120,23 +170,122 @@ class NetworkInterfaces(dict):
     class InterfaceNotFound(LookupError):
         pass
 
-    def __init__(self):
+    def __init__(self, root="/"):
         """
+        :param root: The directory containing sys, for tests
         :return: A dist of dicts that describe all of the network interfaces on the node with
         the exception of the the lo interface which is excluded from the list.
         """
+        try:
+            interfaces = self._read_native(root)
+        except (IOError, OSError, socket.error) as e:
+            daemon_log.debug(
+                "Unable to read network interfaces natively, running ip: %s" % e
+            )
+            interfaces = self._read_ip()
+
+        # Address to the name of its interface, for name()
+        self._names = {}
+
+        for name, interface, addresses in interfaces:
+            if (name not in EXCLUDE_INTERFACES) and (interface["slave"] is False):
+                interface["type"] = self.interface_to_lnet_type(interface["type"])
+                self[name] = interface
+
+                for address in addresses:
+                    self._names.setdefault(address, name)
+
+        # Each interface's primary address is its own, even if another has the same as a secondary
+        for name, interface in self.items():
+            if interface["inet4_address"]:
+                self._names[interface["inet4_address"]] = name
+
+    @classmethod
+    def interface_to_lnet_type(cls, if_type):
+        """
+        To keep everything consistant we report networks types as the lnd name not the linux name we
+        have to translate somewhere so do it at source, if the user ever needs to see it as Linux types
+        we can translate back.
+        There is a train of thought that says it if is unknown we should cause an exception which means
+        the app will not work, I prefer to try an approach that says returning just the unknown might
+        well work, and if not it causes an exception somewhere else.
+        """
+        return cls.network_translation.get(if_type.lower(), if_type.lower())
+
+    @staticmethod
+    def _read_native(root):
+        """
+        Read the links and their counters from /sys/class/net and their addresses from netlink, in
+        one pass and without running anything.
+
+        :return: List of (name, interface dict, addresses) of every interface, including those
+                 excluded
+        """
+        links = os.path.join(root, SYS_CLASS_NET)
 
-        def interface_to_lnet_type(if_type):
-            """
-            To keep everything consistant we report networks types as the lnd name not the linux name we
-            have to translate somewhere so do it at source, if the user ever needs to see it as Linux types
-            we can translate back.
-            There is a train of thought that says it if is unknown we should cause an exception which means
-            the app will not work, I prefer to try an approach that says returning just the unknown might
-            well work, and if not it causes an exception somewhere else.
-            """
-            return self.network_translation.get(if_type.lower(), if_type.lower())
+        addresses = defaultdict(list)
+        for address in netlink.dump_addresses():
+            addresses[address.index].append(address)
 
+        def read(name, attribute):
+            with open(os.path.join(links, name, attribute)) as f:
+                return f.read().strip()
+
+        interfaces = []
+        for name in sorted(os.listdir(links)):
+            try:
+                index = int(read(name, "ifindex"))
+                flags = int(read(name, "flags"), 16)
+                link_type = int(read(name, "type"))
+                mac_address = read(name, "address")
+                rx_bytes = read(name, "statistics/rx_bytes")
+                tx_bytes = read(name, "statistics/tx_bytes")
+            except (IOError, ValueError):
+                # Gone since it was listed
+                continue
+
+            # The kernel lists an interface's primary addresses before its secondary ones
+            inet4 = [
+                address
+                for address in addresses[index]
+                if address.family == socket.AF_INET
+                and not address.flags & netlink.IFA_F_SECONDARY
+            ]
+            inet6 = [
+                address
+                for address in addresses[index]
+                if address.family == socket.AF_INET6
+            ]
+
+            interfaces.append(
+                (
+                    name,
+                    {
+                        "mac_address": mac_address,
+                        "inet4_address": inet4[0].address if inet4 else "",
+                        "inet4_prefix": inet4[0].prefixlen if inet4 else 0,
+                        "inet6_address": inet6[0].address if inet6 else "",
+                        "type": ARPHRD_TYPES.get(link_type, str(link_type)),
+                        "rx_bytes": rx_bytes,
+                        "tx_bytes": tx_bytes,
+                        "up": bool(flags & IFF_UP),
+                        "slave": bool(flags & IFF_SLAVE),
+                    },
+                    [address.address for address in addresses[index]],
+                )
+            )
+
+        return interfaces
+
+    @staticmethod
+    def _read_ip():
+        """
+        Read the interfaces from the output of ip addr and their counters from /proc/net/dev, where
+        they cannot be read natively.
+
+        :return: List of (name, interface dict, addresses) of every interface, including those
+                 excluded
+        """
         try:
             ip_out = AgentShell.try_run(["ip", "addr"])
 
@@ -144,7 +293,7 @@ class NetworkInterfaces(dict):
                 dev_stats = file.readlines()
         except IOError:
             daemon_log.warning("ip: failed to run")
-            return
+            return []
 
         # Parse the ip command output and create a list of lists, where each entry is the output from one device.
         device_lines = []
@@ -184,42 +333,45 @@ class NetworkInterfaces(dict):
             )
 
         # Now create a network interface for each of the entries.
+        interfaces = []
         for device_lines in devices:
             interface = NetworkInterface(device_lines, proc_net_dev_values)
 
-            if (interface.interface not in EXCLUDE_INTERFACES) and (
-                interface.slave is False
-            ):
-                self[interface.interface] = {
-                    "mac_address": interface.mac_address,
-                    "inet4_address": interface.inet4_addr,
-                    "inet4_prefix": interface.inet4_prefix,
-                    "inet6_address": interface.inet6_addr,
-                    "type": interface_to_lnet_type(interface.type),
-                    "rx_bytes": interface.rx_tx_stats.rx_bytes,
-                    "tx_bytes": interface.rx_tx_stats.tx_bytes,
-                    "up": interface.up,
-                    "slave": interface.slave,
-                }
+            interfaces.append(
+                (
+                    interface.interface,
+                    {
+                        "mac_address": interface.mac_address,
+                        "inet4_address": interface.inet4_addr,
+                        "inet4_prefix": interface.inet4_prefix,
+                        "inet6_address": interface.inet6_addr,
+                        "type": interface.type,
+                        "rx_bytes": interface.rx_tx_stats.rx_bytes,
+                        "tx_bytes": interface.rx_tx_stats.tx_bytes,
+                        "up": interface.up,
+                        "slave": interface.slave,
+                    },
+                    interface.addresses,
+                )
+            )
 
-    def name(self, inet4_address):
-        result = None
+        return interfaces
 
-        if inet4_address == "0":
-            result = "lo"
-        else:
-            for name, interface in self.iteritems():
-                if interface["inet4_address"] == inet4_address:
-                    result = name
-                    break
+    def name(self, address):
+        """
+        :param address: Any address of an interface, primary, secondary or IPv6, or "0" for lo
+        :return: The name of the interface
+        """
+        if address == "0":
+            return "lo"
 
-        if result == None:
+        try:
+            return self._names[address]
+        except KeyError:
             raise self.InterfaceNotFound(
-                "Unable to find a name for the network address %s" % inet4_address
+                "Unable to find a name for the network address %s" % address
             )
 
-        return result
-
 
 class LNetNid:
     """Created with a single line that is the output of lctl get_param nis, this class will
@@ -265,28 +417,101 @@ class LNetNid:
         self.name = interfaces.name(self.nid_address)
 
 
+class NetworkChangeListener(threading.Thread):
+    """Tells the plugin when the kernel reports a link or address change, so it is seen at once"""
+
+    GROUPS = (
+        netlink.RTMGRP_LINK | netlink.RTMGRP_IPV4_IFADDR | netlink.RTMGRP_IPV6_IFADDR
+    )
+    CHANGES = (
+        netlink.RTM_NEWLINK,
+        netlink.RTM_DELLINK,
+        netlink.RTM_NEWADDR,
+        netlink.RTM_DELADDR,
+    )
+
+    # Seconds between checks for stop() while no changes are reported
+    STOP_CHECK_PERIOD = 1.0
+
+    def __init__(self, plugin):
+        """:raises socket.error: If netlink cannot be used"""
+        super(NetworkChangeListener, self).__init__(name="NetworkChangeListener")
+        self.daemon = True
+        self._plugin = plugin
+        self._socket = netlink.subscribe(self.GROUPS)
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _changed(self, data):
+        return any(
+            message_type in self.CHANGES
+            for message_type, _ in netlink.parse_messages(data)
+        )
+
+    def run(self):
+        try:
+            while not self._stopping.is_set():
+                if not select.select([self._socket], [], [], self.STOP_CHECK_PERIOD)[0]:
+                    continue
+
+                try:
+                    changed = self._changed(self._socket.recv(netlink.RECV_SIZE))
+                except socket.error as e:
+                    if e.errno != errno.ENOBUFS:
+                        raise
+                    # The kernel dropped messages it could not queue, some may have been changes
+                    changed = True
+
+                if changed:
+                    self._plugin.topology_changed()
+        except Exception as e:
+            daemon_log.warning("Stopped listening for network changes: %s" % e)
+            self._plugin.listener_stopped()
+        finally:
+            self._socket.close()
+
+
 class LinuxNetworkDevicePlugin(DevicePlugin):
-    # This need to be instance variables, for reasons that are really difficult to expliain.
-    # Generally changes are sent but sometimes we want to poll them. However when we poll we create a new object
-    # and so if these are instance variables we don't get the diff back, and so don't see the deletes!
-    # last_return is updated in the session_update so a poll sees any deletes but does not stop them being sent in
-    # the updates. Ask Chris about this for more info.
-    last_return = {}
+    # This need to be a class variable, because manage_lnet updates it when it configures lnet, and
+    # the plugin reports it when lctl cannot be run.
     cached_results = {}
+    # The NetworkInterfaces most recently read, for cache_results() to name the interfaces of
+    # NIDs from, or None if they may have changed since
+    interfaces = None
+
+    SNAPSHOT_UPDATES = True
+
+    # Fields of the result describing the interfaces and lnet, sent only when they change.  The
+    # interface counters are sent every counter_period() seconds as "counters", rates per second.
+    TOPOLOGY_FIELDS = ["interfaces", "lnet"]
+
+    # Seconds between polls while NetworkChangeListener reports link and address changes, the
+    # polls then being for the counters and lnet
+    LISTENING_POLL_PERIOD = 30
 
     def __init__(self, session):
         super(LinuxNetworkDevicePlugin, self).__init__(session)
 
-    def _lnet_devices(self, interfaces):
+        # (time, {interface name: counters}) as at the previous counter report
+        self._last_counters = None
+        self._listener = None
+
+    def _lnet_devices(self, interfaces, nis=None):
         """
         :param interfaces: A list of the interfaces on the current node
+        :param nis: The value of the nis param, if it has been read already
         :return: Returns a dict of dicts describing the nids on the current node.
         """
-        try:
-            lines = AgentShell.try_run(["lctl", "get_param", "-n", "nis"]).split("\n")
-        except Exception as err:
-            daemon_log.warning("get_nids: failed to open: {}".format(err.message))
-            return LinuxNetworkDevicePlugin.cached_results
+        if nis is None:
+            try:
+                nis = AgentShell.try_run(["lctl", "get_param", "-n", "nis"])
+            except Exception as err:
+                daemon_log.warning("get_nids: failed to open: {}".format(err.message))
+                return LinuxNetworkDevicePlugin.cached_results
+
+        lines = nis.split("\n")
 
         # Skip header line
         lines = lines[1:]
@@ -322,10 +547,17 @@ class LinuxNetworkDevicePlugin(DevicePlugin):
         if lnet_configuration:
             raw_result = {}
 
-            interfaces = NetworkInterfaces()
+            interfaces = cls.interfaces or NetworkInterfaces()
 
             for network_interface in lnet_configuration["network_interfaces"]:
-                raw_result[interfaces.name(network_interface[0])] = {
+                try:
+                    name = interfaces.name(network_interface[0])
+                except NetworkInterfaces.InterfaceNotFound:
+                    # The address may have been added since the interfaces were last read
+                    interfaces = cls.interfaces = NetworkInterfaces()
+                    name = interfaces.name(network_interface[0])
+
+                raw_result[name] = {
                     "nid_address": network_interface[0],
                     "lnd_type": network_interface[1],
                     "lnd_network": network_interface[2],
@@ -333,11 +565,15 @@ class LinuxNetworkDevicePlugin(DevicePlugin):
 
         cls.cached_results = raw_result
 
-    def _lnet_state(self):
+    def _lnet_state(self, lnet_loaded=None):
+        """
+        :param lnet_loaded: Whether the lnet module is loaded, if it is already known
+        """
         lnet_up = False
-        lnet_loaded = not bool(
-            AgentShell.run(["udevadm", "info", "--path", "/sys/module/lnet"]).rc
-        )
+        if lnet_loaded is None:
+            lnet_loaded = not bool(
+                AgentShell.run(["udevadm", "info", "--path", "/sys/module/lnet"]).rc
+            )
 
         if lnet_loaded:
             lnet_up = not bool(AgentShell.run(["lnetctl", "net", "show"]).rc)
@@ -349,25 +585,163 @@ class LinuxNetworkDevicePlugin(DevicePlugin):
             (True, True): "lnet_up",
         }[(lnet_loaded, lnet_up)]
 
-    def start_session(self):
+    def _lnet_probe(self, interfaces, root="/"):
+        """
+        Find the state of lnet and its NIDs together, without running anything where they can be
+        read natively.  Whether the lnet module is loaded is whether /sys/module/lnet exists, and
+        lnet is up if the nis param lists any NIs, as lnetctl net show only succeeds then.
+
+        Where /sys/module or the nis param cannot be read (e.g. debugfs is not mounted), udevadm,
+        lnetctl and lctl are run instead.
+
+        :param root: The directory containing sys and proc, for tests
+        :return: (state, nids), see _lnet_state() and _lnet_devices()
+        """
+        if not os.path.isdir(os.path.join(root, SYS_MODULE)):
+            return self._lnet_state(), self._lnet_devices(interfaces)
+
+        if not os.path.isdir(os.path.join(root, LNET_MODULE)):
+            # lctl would fail, so skip straight to what it would fall back on
+            return "lnet_unloaded", LinuxNetworkDevicePlugin.cached_results
+
+        nis = LustreParams(root).read("nis")
+        if nis is None:
+            return self._lnet_state(lnet_loaded=True), self._lnet_devices(interfaces)
+
+        # After the header line, a line per NI
+        lnet_up = any(line.strip() for line in nis.split("\n")[1:])
+
+        return (
+            "lnet_up" if lnet_up else "lnet_down",
+            self._lnet_devices(interfaces, nis),
+        )
+
+    def _scan(self):
+        """:return: (interfaces, lnet), every field of each interface and the state and nids of lnet"""
         interfaces = NetworkInterfaces()
-        nids = self._lnet_devices(interfaces)
+        LinuxNetworkDevicePlugin.interfaces = interfaces
+        lnet_state, nids = self._lnet_probe(interfaces)
 
-        result = {
-            "interfaces": interfaces,
-            "lnet": {"state": self._lnet_state(), "nids": nids},
-        }
+        return interfaces, {"state": lnet_state, "nids": nids}
+
+    def _session_result(self):
+        """
+        Where the manager has said that it takes counter rates (see Session.network_rates), the
+        interfaces and lnet, without the interface counters and set to None while unchanged, and the
+        counters as "counters", see _counter_rates().  Otherwise every field of each interface,
+        counters included, and lnet, as the manager expects in every update.
+        """
+        interfaces, lnet = self._scan()
+
+        if not (self._session is not None and self._session.network_rates):
+            return {"interfaces": dict(interfaces), "lnet": lnet}
+
+        topology = {}
+        counters = {}
+        for name, interface in interfaces.items():
+            topology[name] = dict(
+                (key, value)
+                for key, value in interface.items()
+                if key not in COUNTER_FIELDS
+            )
+            counters[name] = dict((key, int(interface[key])) for key in COUNTER_FIELDS)
+
+        result = self._delta_result(
+            {"interfaces": topology, "lnet": lnet}, self.TOPOLOGY_FIELDS
+        )
+        result["counters"] = self._counter_rates(counters)
 
         return result
 
-    def update_session(self):
-        this_return = self.start_session()
-
-        # THIS DOESN'T WORK BECAUSE RX/TX change in the network and so the data is sent back everytime. So it does work
-        # but the data is always sent to if (true) is really what we have.
-        if (this_return != self.last_return) or (self.trigger_plugin_update is True):
-            LinuxNetworkDevicePlugin.last_return = this_return
-            self.trigger_plugin_update = False
-            return self.last_return
-        else:
+    def _counter_rates(self, counters):
+        """
+        :param counters: dict of interface name to its counters now
+        :return: dict of interface name to the rate per second of each of its counters since the
+                 previous report, or None if no report is due.  Interfaces whose counters have gone
+                 backwards (e.g. the driver was reloaded) are left out.
+        """
+        period = counter_period()
+        if not period:
+            return None
+
+        now = monotonic()
+        if self._last_counters is None:
+            self._last_counters = (now, counters)
+            return None
+
+        last_time, last_counters = self._last_counters
+        elapsed = now - last_time
+        # Report at the poll nearest to period having passed, not the first one after it
+        if elapsed < period - self.POLL_PERIOD / 2.0:
+            return None
+
+        rates = {}
+        for name, values in counters.items():
+            previous = last_counters.get(name)
+            if previous is None or any(
+                values[key] < previous[key] for key in COUNTER_FIELDS
+            ):
+                continue
+
+            rates[name] = dict(
+                (key, (values[key] - previous[key]) / elapsed) for key in COUNTER_FIELDS
+            )
+
+        self._last_counters = (now, counters)
+        return rates
+
+    def _start_listener(self):
+        if (
+            self._listener is not None
+            or self._session is None
+            or not change_listener_enabled()
+        ):
             return
+
+        try:
+            self._listener = NetworkChangeListener(self)
+        except socket.error as e:
+            daemon_log.warning(
+                "Unable to listen for network changes, polling for them: %s" % e
+            )
+            return
+
+        self._listener.start()
+        self.POLL_PERIOD = self.LISTENING_POLL_PERIOD
+
+    def topology_changed(self):
+        """Called by NetworkChangeListener when a link or address has changed"""
+        LinuxNetworkDevicePlugin.interfaces = None
+        self.poll_now()
+
+    def listener_stopped(self):
+        """
+        Called by NetworkChangeListener if it can no longer report changes.  Changes are polled for
+        until the next start_session/update_session starts another.
+        """
+        self._listener = None
+        self.POLL_PERIOD = LinuxNetworkDevicePlugin.POLL_PERIOD
+
+    def teardown(self):
+        # The listener may clear _listener itself as it stops, see listener_stopped()
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.stop()
+            listener.join()
+
+    def start_session(self):
+        self._reset_delta()
+        self._last_counters = None
+        self._start_listener()
+
+        return self._session_result()
+
+    def update_session(self):
+        self._start_listener()
+
+        result = self._session_result()
+
+        if all(value is None for value in result.values()):
+            return None
+
+        return result
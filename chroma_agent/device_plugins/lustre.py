@@ -3,8 +3,14 @@
 # license that can be found in the LICENSE file.
 
 
+import copy
+import time
+import threading
 from collections import namedtuple
+from chroma_agent import config, DEFAULT_AGENT_CONFIG
+from chroma_agent.lib import tree_delta
 from chroma_agent.lib.shell import AgentShell
+from chroma_agent.lib.time_series import TimeSeriesSet
 from chroma_agent.log import daemon_log
 from chroma_agent.log import console_log
 from chroma_agent import version as agent_version
@@ -15,26 +21,139 @@ from iml_common.lib.date_time import IMLDateTime
 
 # FIXME: weird naming, 'LocalAudit' is the class that fetches stats
 from chroma_agent.device_plugins.audit import local
+from chroma_agent.device_plugins.audit.lustre.brw_stats import merge_histograms
+from chroma_agent.device_plugins.audit.lustre.export_stats import merge_clients
+from chroma_agent.device_plugins.audit.lustre.job_stats import merge_jobs
 
 
 VersionInfo = namedtuple("VersionInfo", ["epoch", "version", "release", "arch"])
 
 
+def sample_period():
+    """:return: Seconds between samples of the Lustre counters, 0 to sample them at each scan only"""
+    try:
+        agent_settings = config.get("settings", "agent")
+    except KeyError:
+        agent_settings = {}
+
+    return agent_settings.get(
+        "lustre_sample_period", DEFAULT_AGENT_CONFIG["lustre_sample_period"]
+    )
+
+
+def merge_counts(earlier, later):
+    """
+    Add the counts since the previous scan in an earlier scan's metrics (job_stats, brw_stats and
+    the clients' export stats) into those of a later scan.
+
+    :param earlier: Whole metrics of a scan, see LocalAudit.metrics
+    :param later: Whole metrics of a later scan
+    :return: A copy of later, with earlier's counts added
+    """
+    merged = copy.deepcopy(later)
+    earlier_lustre = earlier.get("raw", {}).get("lustre", {})
+    lustre = merged.get("raw", {}).get("lustre")
+    if not earlier_lustre or lustre is None:
+        return merged
+
+    for name, target in earlier_lustre.get("target", {}).items():
+        merged_target = lustre.get("target", {}).get(name)
+        if merged_target is None:
+            continue
+        if target.get("job_stats") and "job_stats" in merged_target:
+            merge_jobs(target["job_stats"], merged_target["job_stats"])
+        if target.get("brw_stats") and "brw_stats" in merged_target:
+            merge_histograms(target["brw_stats"], merged_target["brw_stats"])
+
+    for target_type, clients in earlier_lustre.get("clients", {}).items():
+        merged_clients = lustre.get("clients", {}).get(target_type)
+        if clients and merged_clients is not None:
+            merge_clients(clients, merged_clients)
+
+    return merged
+
+
+def _is_whole(value):
+    """True if value is a whole tree, rather than a tree delta or None for no change"""
+    return isinstance(value, dict) and not tree_delta.is_delta(value)
+
+
+class CounterSampler(threading.Thread):
+    """Samples the plugin's counters every period seconds between its scans"""
+
+    def __init__(self, plugin, period):
+        super(CounterSampler, self).__init__(name="CounterSampler")
+        self.daemon = True
+        self._plugin = plugin
+        self._period = period
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.wait(self._period):
+            try:
+                self._plugin.sample()
+            except Exception as e:
+                daemon_log.warning("Error sampling Lustre counters: %s" % e)
+
+
 class LustrePlugin(DevicePlugin):
     delta_fields = ["capabilities", "properties"]
+    tree_delta_fields = ["metrics", "series"]
+    SNAPSHOT_UPDATES = True
+
+    # Samples kept of each counter, a scan reports on at most this many of the latest
+    SERIES_CAPACITY = 64
 
     def __init__(self, session):
+        self._sampler = None
+        self._series_lock = threading.Lock()
         self.reset_state()
         super(LustrePlugin, self).__init__(session)
 
     def reset_state(self):
-        pass
+        with self._series_lock:
+            self._series = TimeSeriesSet(self.SERIES_CAPACITY)
+            # Time of the last sample included in the previous scan's series
+            self._summarized_through = None
+            # Start of the window of the latest scan's series, and of the one before it
+            self._window_start = None
+            self._previous_window_start = None
+
+    def sample(self, audit=None):
+        """Record the current value of each counter, see LustreAudit.counters"""
+        counters = (audit or local.LocalAudit()).counters()
+        with self._series_lock:
+            self._series.add(time.time(), counters)
+
+    def _series_summary(self, audit):
+        """Rates of each counter since the previous scan, see TimeSeriesSet.summary"""
+        self.sample(audit)
+        with self._series_lock:
+            summary = self._series.summary(self._summarized_through)
+            self._previous_window_start = self._window_start
+            self._window_start = self._summarized_through
+            self._summarized_through = self._series.latest_time
+        return summary
+
+    def _start_sampler(self):
+        period = sample_period()
+        if self._sampler is None and period and period < self.POLL_PERIOD:
+            self._sampler = CounterSampler(self, period)
+            self._sampler.start()
+
+    def teardown(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler.join()
+            self._sampler = None
 
     def _scan(self, initial=False):
         started_at = IMLDateTime.utcnow().isoformat()
         audit = local.LocalAudit()
 
-        # FIXME: HYD-1095 we should be sending a delta instead of a full dump every time
         # FIXME: At this time the 'capabilities' attribute is unused on the manager
         return {
             "started_at": started_at,
@@ -42,12 +161,48 @@ class LustrePlugin(DevicePlugin):
             "capabilities": plugin_manager.ActionPluginManager().capabilities,
             "metrics": audit.metrics(),
             "properties": audit.properties(),
+            "series": self._series_summary(audit),
         }
 
+    def merge_updates(self, earlier, later):
+        """
+        Counts since the previous scan in the metrics of a result replaced before it is sent are
+        added to those of the newer one, and its series are summarized again over both windows, so
+        that activity is not undercounted.  That needs both results' metrics and series whole.  As
+        a tree delta is only sent once the manager has acknowledged the result before it, the newer
+        one always is, and an earlier delta is sent on its own.
+        """
+        if not all(
+            _is_whole(result.get(key))
+            for result in [earlier, later]
+            for key in self.tree_delta_fields
+        ):
+            return None
+
+        merged = super(LustrePlugin, self).merge_updates(earlier, later)
+        merged["metrics"] = merge_counts(earlier["metrics"], later["metrics"])
+
+        # earlier is always the result before later, or those merged into it, so its window is the
+        # one before later's
+        with self._series_lock:
+            merged["series"] = self._series.summary(self._previous_window_start)
+            self._window_start = self._previous_window_start
+
+        # The manager will hold the merged result, so later deltas must be against it
+        for key in self.tree_delta_fields:
+            self.last_result[key] = merged[key]
+
+        return merged
+
     def start_session(self):
         self.reset_state()
+        self._start_sampler()
         self._reset_delta()
-        return self._delta_result(self._scan(initial=True), self.delta_fields)
+        return self._delta_result(
+            self._scan(initial=True), self.delta_fields, self.tree_delta_fields
+        )
 
     def update_session(self):
-        return self._delta_result(self._scan(), self.delta_fields)
+        return self._delta_result(
+            self._scan(), self.delta_fields, self.tree_delta_fields
+        )
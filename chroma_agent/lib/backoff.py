@@ -0,0 +1,80 @@
+# Copyright (c) 2018 DDN. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+"""
+Retry timing which spreads a fleet of agents out, rather than having them all hit the manager at the
+same instants (e.g. when it comes back after a restart).
+"""
+
+import time
+import random
+import hashlib
+import email.utils
+
+
+class DecorrelatedJitter(object):
+    """
+    Delays between retries, each drawn at random between base and three times the previous delay
+    and capped.  Clients which fail at the same moment retry at different moments, and drift further
+    apart with each attempt, while the delays still grow roughly exponentially.
+    """
+
+    def __init__(self, base, cap):
+        """
+        :param base: Minimum delay in seconds
+        :param cap: Maximum delay in seconds
+        """
+        self.base = base
+        self.cap = cap
+        self.reset()
+
+    def reset(self):
+        """Call after a success, so the next failure starts again from base"""
+        # The last delay returned by next(), 0 if there have been no failures
+        self.delay = 0.0
+
+    def next(self):
+        """:return: Seconds to wait before the next attempt"""
+        self.delay = min(
+            self.cap, random.uniform(self.base, max(self.base, self.delay) * 3)
+        )
+        return self.delay
+
+
+def phase_offset(key, period):
+    """
+    A fixed offset in [0, period) derived from key (e.g. the FQDN), so that agents doing the same thing
+    every period seconds do it at different points in the period, and each does so at the same point
+    every time.
+    """
+    digest = hashlib.md5(key).hexdigest()
+    return (int(digest[:8], 16) / float(0x100000000)) * period
+
+
+def next_phase(key, period, now=None):
+    """:return: Seconds from now until the next time that is phase_offset(key, period) into a period"""
+    now = time.time() if now is None else now
+    return period - (now - phase_offset(key, period)) % period
+
+
+def parse_retry_after(value):
+    """
+    Parse an HTTP Retry-After value, either a number of seconds or an HTTP date
+
+    :return: Seconds to wait, or None if value is missing or invalid
+    """
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+
+    date = email.utils.parsedate_tz(str(value))
+    if date is None:
+        return None
+
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
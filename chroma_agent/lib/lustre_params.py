@@ -0,0 +1,194 @@
+# Copyright (c) 2018 DDN. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+"""
+Read Lustre parameters in-process, rather than by running lctl get_param.
+
+lctl finds a parameter such as obdfilter.*.stats by globbing it against a set of directories in /sys
+and /proc, and this does the same.  The dots in a parameter path separate directory levels, except
+that a name may itself contain dots (e.g. the NID in exports.192.168.0.1@tcp.stats), so at each level
+the longest run of components that names an entry is tried first.
+"""
+
+import os
+import errno
+import fnmatch
+
+from chroma_agent.log import daemon_log
+
+# Searched in this order, as lctl does.  A parameter is taken from the first root in which it matches.
+PARAM_ROOTS = [
+    "sys/fs/lustre",
+    "sys/fs/lnet",
+    "sys/kernel/debug/lustre",
+    "sys/kernel/debug/lnet",
+    "proc/fs/lustre",
+    "proc/fs/lnet",
+    "proc/sys/lustre",
+    "proc/sys/lnet",
+]
+
+WILDCARD_CHARS = "*?["
+
+
+class LustreParams(object):
+    def __init__(self, root="/"):
+        """
+        :param root: The directory containing sys and proc, for tests
+        """
+        self.root = root
+
+    def _roots(self):
+        for param_root in PARAM_ROOTS:
+            path = os.path.join(self.root, param_root)
+            if os.path.isdir(path):
+                yield path
+
+    def _match(self, directory, tokens, name):
+        """Yield (name, path) for entries under directory matching the dotted tokens"""
+        try:
+            entries = None
+            for count in range(len(tokens), 0, -1):
+                pattern = ".".join(tokens[:count])
+                if any(c in pattern for c in WILDCARD_CHARS):
+                    if entries is None:
+                        entries = sorted(os.listdir(directory))
+                    matches = fnmatch.filter(entries, pattern)
+                elif os.path.lexists(os.path.join(directory, pattern)):
+                    matches = [pattern]
+                else:
+                    matches = []
+
+                for entry in matches:
+                    path = os.path.join(directory, entry)
+                    entry_name = "%s.%s" % (name, entry) if name else entry
+                    if count == len(tokens):
+                        yield entry_name, path
+                    elif os.path.isdir(path):
+                        for match in self._match(path, tokens[count:], entry_name):
+                            yield match
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                raise
+
+    def resolve(self, path):
+        """
+        :param path: A parameter path as given to lctl get_param, '/' may be used instead of '.'
+        :return: List of (parameter name, filesystem path) for each match
+        """
+        tokens = path.replace("/", ".").split(".")
+
+        for root in self._roots():
+            seen = set()
+            matches = []
+            for name, match in self._match(root, tokens, ""):
+                if match not in seen:
+                    seen.add(match)
+                    matches.append((name, match))
+
+            if matches:
+                return matches
+
+        return []
+
+    def iterate(self, path):
+        """
+        Like resolve(), but yields each match as it is found rather than listing them all first, for
+        paths matching very many parameters (e.g. obdfilter.*.exports.*.stats).  Matches are not
+        checked for duplicates, as resolve() does.
+
+        :return: Generator of (parameter name, filesystem path) for each match
+        """
+        tokens = path.replace("/", ".").split(".")
+
+        for root in self._roots():
+            found = False
+            for match in self._match(root, tokens, ""):
+                found = True
+                yield match
+
+            if found:
+                return
+
+    def read(self, path):
+        """
+        :return: The concatenated values of the parameters matching path, as lctl get_param -n would
+                 give, or None if path matches no readable parameter
+        """
+        values = []
+        for name, match in self.resolve(path):
+            if os.path.isdir(match):
+                continue
+
+            try:
+                with open(match) as f:
+                    values.append(f.read())
+            except IOError as e:
+                # Write only and transiently unavailable parameters, lctl skips them too
+                daemon_log.debug("Unable to read Lustre parameter %s: %s" % (name, e))
+
+        return "".join(values) if values else None
+
+    def list(self, path):
+        """:return: The names of the parameters matching path as lctl get_param -N would, or None if none do"""
+        names = [name for name, _ in self.resolve(path)]
+        return names or None
+
+
+def iter_get_param_output(output, paths):
+    """
+    Split the output of one lctl get_param (without -n) of several paths into its parameters.
+
+    Each parameter's output starts with name=, followed by its value, which for multi line values
+    starts on the next line.  A line only starts a new parameter if what precedes its = matches one
+    of the paths, so values containing = (e.g. snapshot_time=...) are not mistaken for names.
+
+    :param paths: The parameter paths given to lctl get_param, '/' may be used instead of '.'
+    :return: Generator of (name, matched paths, value lines) for each parameter in the output
+    """
+    patterns = [path.replace("/", ".") for path in paths]
+    name = matched = lines = None
+
+    for line in output.splitlines():
+        param, sep, value = line.partition("=")
+        starts = (
+            [
+                path
+                for path, pattern in zip(paths, patterns)
+                if fnmatch.fnmatchcase(param, pattern)
+            ]
+            if sep
+            else []
+        )
+
+        if starts:
+            if lines is not None:
+                yield name, matched, lines
+            name, matched, lines = param, starts, [value] if value else []
+        elif lines is not None:
+            lines.append(line)
+
+    if lines is not None:
+        yield name, matched, lines
+
+
+def split_get_param_output(output, paths):
+    """
+    Split the output of one lctl get_param (without -n) of several paths back into each path's value,
+    see iter_get_param_output().
+
+    :param paths: The parameter paths given to lctl get_param, '/' may be used instead of '.'
+    :return: dict of path to its value(s), as lctl get_param -n would output them, for each path
+             which matched at least one parameter
+    """
+    values = {}
+    for _, matched, lines in iter_get_param_output(output, paths):
+        for path in matched:
+            values.setdefault(path, []).append(lines)
+
+    return dict(
+        (path, "".join("".join(line + "\n" for line in lines) for lines in params))
+        for path, params in values.items()
+    )
@@ -0,0 +1,49 @@
+# Copyright (c) 2018 DDN. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+"""
+A clock that never goes backwards, for measuring intervals.
+
+time.time() jumps whenever the system clock is stepped (ntpdate, manual changes, VM resume) which upsets
+anything scheduled against it.  Python 2 has no time.monotonic() so call clock_gettime() directly.
+"""
+
+import os
+import time
+import ctypes
+import ctypes.util
+
+CLOCK_MONOTONIC = 1  # from <linux/time.h>
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _clock_gettime_monotonic():
+    librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1", use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def monotonic():
+        """Return the value in fractional seconds of a clock which never goes backwards"""
+        timespec = _Timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+    return monotonic
+
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    try:
+        monotonic = _clock_gettime_monotonic()
+    except (OSError, AttributeError):
+        # No librt, the best we can do is the wall clock
+        monotonic = time.time
@@ -0,0 +1,138 @@
+# Copyright (c) 2018 DDN. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+"""
+Just enough rtnetlink to read the addresses of the network interfaces without running ip addr.
+
+Links and their counters are in /sys/class/net, but IPv4 addresses are not anywhere in /sys or
+/proc, so they are dumped from the kernel with RTM_GETADDR, as ip addr does.  subscribe() gives a
+socket on which the kernel reports changes to them as they happen, as ip monitor uses.
+"""
+
+import os
+import socket
+import struct
+from collections import namedtuple
+
+# From <linux/netlink.h> and <linux/rtnetlink.h>
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_F_SECONDARY = 0x01
+
+NLMSGHDR = struct.Struct("=IHHII")  # length, type, flags, sequence, pid
+IFADDRMSG = struct.Struct("=BBBBI")  # family, prefixlen, flags, scope, index
+RTATTR = struct.Struct("=HH")  # length, type
+NLMSGERR = struct.Struct("=i")  # error
+
+RECV_SIZE = 65536
+
+Address = namedtuple("Address", ["index", "family", "address", "prefixlen", "flags"])
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def parse_messages(data):
+    """:return: Generator of (type, payload) for each netlink message in data"""
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, message_type, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            break
+        yield message_type, data[offset + NLMSGHDR.size : offset + length]
+        offset += _align(length)
+
+
+def parse_attributes(data):
+    """:return: dict of attribute type to value of the rtattrs in data"""
+    attributes = {}
+    offset = 0
+    while offset + RTATTR.size <= len(data):
+        length, attribute_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attributes[attribute_type] = data[offset + RTATTR.size : offset + length]
+        offset += _align(length)
+    return attributes
+
+
+def parse_address(payload):
+    """:return: The Address of an RTM_NEWADDR message, or None if it has no address"""
+    family, prefixlen, flags, _, index = IFADDRMSG.unpack_from(payload)
+    attributes = parse_attributes(payload[IFADDRMSG.size :])
+
+    # IFA_LOCAL is the interface's own address, IFA_ADDRESS the far end's on point to point links
+    address = attributes.get(IFA_LOCAL) or attributes.get(IFA_ADDRESS)
+    if address is None:
+        return None
+
+    return Address(index, family, socket.inet_ntop(family, address), prefixlen, flags)
+
+
+def dump_addresses():
+    """
+    :return: List of the Address of every interface, in the kernel's order (primary addresses
+             before secondary ones)
+    :raises socket.error: If netlink cannot be used
+    :raises OSError: If the kernel refuses the request
+    """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        request = IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        sock.send(
+            NLMSGHDR.pack(
+                NLMSGHDR.size + len(request),
+                RTM_GETADDR,
+                NLM_F_REQUEST | NLM_F_DUMP,
+                1,
+                0,
+            )
+            + request
+        )
+
+        addresses = []
+        while True:
+            for message_type, payload in parse_messages(sock.recv(RECV_SIZE)):
+                if message_type == NLMSG_DONE:
+                    return addresses
+                elif message_type == NLMSG_ERROR:
+                    error = -NLMSGERR.unpack_from(payload)[0]
+                    raise OSError(error, os.strerror(error))
+                elif message_type == RTM_NEWADDR:
+                    address = parse_address(payload)
+                    if address is not None:
+                        addresses.append(address)
+    finally:
+        sock.close()
+
+
+def subscribe(groups):
+    """
+    :param groups: The RTMGRP_* multicast groups to receive, or'd together
+    :return: A netlink socket on which the kernel sends a message for each change in groups
+    :raises socket.error: If netlink cannot be used
+    """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, groups))
+    except socket.error:
+        sock.close()
+        raise
+    return sock
@@ -0,0 +1,107 @@
+# Copyright (c) 2018 DDN. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+import Queue
+import threading
+from collections import deque
+
+from chroma_agent.lib.monotonic import monotonic
+
+
+class AgingPriorityQueue(object):
+    """
+    A thread safe queue with a fixed number of priority levels, 0 being the highest.
+
+    Items of the same priority come out in the order they were put in.  Higher priorities go first,
+    except that an item which has waited longer than max_wait goes ahead of everything that has not,
+    so a steady stream of high priority items cannot starve the lower levels.  put() and get_nowait()
+    take constant time.
+
+    get_nowait() raises Queue.Empty like the standard library queues, there is no blocking get().
+    """
+
+    def __init__(self, levels, max_wait):
+        """
+        :param levels: The number of priority levels
+        :param max_wait: Seconds after which an item is promoted ahead of higher priorities
+        """
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        # Each level holds (time enqueued, item) tuples, oldest on the left
+        self._levels = [deque() for _ in range(levels)]
+        self._enqueued = [0] * levels
+        self._dequeued = [0] * levels
+        self._promoted = [0] * levels
+        self._total_wait = [0.0] * levels
+        self._max_wait_seen = [0.0] * levels
+
+    def put(self, item, priority):
+        with self._lock:
+            self._levels[priority].append((monotonic(), item))
+            self._enqueued[priority] += 1
+
+    def get_nowait(self):
+        with self._lock:
+            now = monotonic()
+            chosen = None
+            promoted = None
+
+            for priority, level in enumerate(self._levels):
+                if not level:
+                    continue
+
+                if chosen is None:
+                    chosen = priority
+
+                # The oldest overdue item goes first, whatever its priority
+                if now - level[0][0] > self.max_wait and (
+                    promoted is None or level[0][0] < self._levels[promoted][0][0]
+                ):
+                    promoted = priority
+
+            if chosen is None:
+                raise Queue.Empty()
+
+            if promoted is not None and promoted != chosen:
+                chosen = promoted
+                self._promoted[chosen] += 1
+
+            enqueued_at, item = self._levels[chosen].popleft()
+            wait = now - enqueued_at
+            self._dequeued[chosen] += 1
+            self._total_wait[chosen] += wait
+            self._max_wait_seen[chosen] = max(self._max_wait_seen[chosen], wait)
+
+            return item
+
+    def qsize(self):
+        with self._lock:
+            return sum(len(level) for level in self._levels)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    @property
+    def stats(self):
+        """
+        A list with a dict of counters for each level: items waiting (depth), totals put and got,
+        how many were promoted by aging, and the mean and maximum seconds items waited.
+        """
+        with self._lock:
+            return [
+                {
+                    "depth": len(self._levels[priority]),
+                    "enqueued": self._enqueued[priority],
+                    "dequeued": self._dequeued[priority],
+                    "promoted": self._promoted[priority],
+                    "mean_wait": (
+                        self._total_wait[priority] / self._dequeued[priority]
+                        if self._dequeued[priority]
+                        else 0.0
+                    ),
+                    "max_wait": self._max_wait_seen[priority],
+                }
+                for priority in range(len(self._levels))
+            ]
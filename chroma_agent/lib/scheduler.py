@@ -0,0 +1,221 @@
+# Copyright (c) 2018 DDN. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+import os
+import sys
+import errno
+import fcntl
+import heapq
+import Queue
+import select
+import itertools
+import threading
+import traceback
+
+from chroma_agent.lib.monotonic import monotonic
+from chroma_agent.log import daemon_log
+
+
+class Scheduler(object):
+    """
+    Call functions repeatedly, each at its own interval, from a single timer thread.
+
+    The timer thread only decides when work is due, the work itself is handed to a fixed number of
+    worker threads.  A function is never called again until its previous call has returned; if it
+    returns a number that is the delay in seconds until it is next called, otherwise the interval it
+    was added with is used.  Times are taken from a monotonic clock and each call is scheduled
+    relative to when the previous one was due, so intervals do not drift.  A job that works out its
+    own schedule (e.g. to be called at fixed points on the clock) can instead have the delays it
+    returns counted from when it returned.
+    """
+
+    class Job(object):
+        def __init__(self, key, function, interval, delay_from_return=False):
+            self.key = key
+            self.function = function
+            self.interval = interval
+            self.delay_from_return = delay_from_return
+            self.due = None
+            # Incremented whenever the job is rescheduled, heap entries with an old generation are ignored
+            self.generation = 0
+            self.running = False
+            self.wake = False
+
+    def __init__(self, workers, name="Scheduler"):
+        """
+        :param workers: The number of threads to run jobs in
+        :param name: Used to name the threads
+        """
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._work = Queue.Queue()
+        self._stopping = threading.Event()
+        # Self pipe used to interrupt the timer thread's select() when the schedule changes. Created by
+        # start() so that a scheduler which is never started holds no file descriptors.
+        self._wake_pipe = None
+
+        self._threads = [threading.Thread(target=self._run_timer, name=name)]
+        for index in range(workers):
+            self._threads.append(
+                threading.Thread(
+                    target=self._run_worker, name="%s-worker-%s" % (name, index)
+                )
+            )
+
+    def _push(self, job, due):
+        """Must be called with _lock held"""
+        job.generation += 1
+        job.due = due
+        heapq.heappush(self._heap, (due, next(self._sequence), job.key, job.generation))
+
+    def _notify(self):
+        with self._lock:
+            if self._wake_pipe is not None:
+                try:
+                    os.write(self._wake_pipe[1], "x")
+                except OSError as e:
+                    # Pipe full means the timer thread has wakeups pending anyway
+                    if e.errno != errno.EAGAIN:
+                        raise
+
+    def add(self, key, function, interval, delay=0.0, delay_from_return=False):
+        """
+        Call function every interval seconds, starting after delay seconds.
+
+        :param key: Unique name for the job, used to wake or remove it
+        :param delay_from_return: Count the delay function returns from when it returned, rather than
+                                  from when the call was due
+        """
+        with self._lock:
+            job = self.Job(key, function, interval, delay_from_return)
+            self._jobs[key] = job
+            self._push(job, monotonic() + delay)
+
+        self._notify()
+
+    def remove(self, key):
+        """Stop calling the job, a call already in progress is allowed to finish"""
+        with self._lock:
+            self._jobs.pop(key, None)
+
+    def wake(self, key):
+        """Call the job as soon as possible rather than waiting for it to become due"""
+        with self._lock:
+            try:
+                job = self._jobs[key]
+            except KeyError:
+                return
+
+            if job.running:
+                job.wake = True
+            else:
+                self._push(job, monotonic())
+
+        self._notify()
+
+    def _dispatch_due(self, now):
+        """
+        Hand every job that is due to the workers.  Must be called with _lock held.
+
+        :return: Seconds until the next job is due, or None if there are none
+        """
+        while self._heap:
+            due, _, key, generation = self._heap[0]
+            job = self._jobs.get(key)
+
+            if job is None or job.generation != generation or job.running:
+                heapq.heappop(self._heap)
+            elif due > now:
+                return due - now
+            else:
+                heapq.heappop(self._heap)
+                job.running = True
+                self._work.put(job)
+
+        return None
+
+    def _run_timer(self):
+        while not self._stopping.is_set():
+            with self._lock:
+                timeout = self._dispatch_due(monotonic())
+
+            # select() rather than Event.wait(timeout) because on Python 2 the latter polls every few ms
+            try:
+                readable, _, _ = select.select([self._wake_pipe[0]], [], [], timeout)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+
+            if readable:
+                os.read(self._wake_pipe[0], 4096)
+
+    def _run_worker(self):
+        while True:
+            job = self._work.get()
+            if job is None:
+                return
+
+            try:
+                delay = job.function()
+                delay = job.interval if delay is None else float(delay)
+            except Exception:
+                backtrace = "\n".join(traceback.format_exception(*(sys.exc_info())))
+                daemon_log.error("Error in scheduled job %s: %s" % (job.key, backtrace))
+                delay = job.interval
+
+            with self._lock:
+                job.running = False
+
+                if self._jobs.get(job.key) is not job:
+                    continue
+
+                now = monotonic()
+                if job.wake:
+                    job.wake = False
+                    due = now
+                elif job.delay_from_return:
+                    due = now + delay
+                else:
+                    # If the job overran then run it again straight away, but don't try to catch up on missed calls
+                    due = max(job.due + delay, now)
+
+                self._push(job, due)
+
+            self._notify()
+
+    def start(self):
+        read_fd, write_fd = os.pipe()
+        for fd in (read_fd, write_fd):
+            fcntl.fcntl(
+                fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK
+            )
+
+        with self._lock:
+            self._wake_pipe = (read_fd, write_fd)
+
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stop dispatching jobs, jobs already running are allowed to finish"""
+        self._stopping.set()
+        for _ in self._threads[1:]:
+            self._work.put(None)
+
+        self._notify()
+
+    def join(self):
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join()
+
+        with self._lock:
+            if self._wake_pipe is not None:
+                for fd in self._wake_pipe:
+                    os.close(fd)
+                self._wake_pipe = None
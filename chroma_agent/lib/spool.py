@@ -0,0 +1,238 @@
+# Copyright (c) 2018 DDN. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+import os
+import re
+import errno
+import struct
+import zlib
+
+from chroma_agent.log import daemon_log
+
+
+class Spool(object):
+    """
+    A bounded, append-only FIFO of string records kept on disk.
+
+    Records are appended to numbered segment files, each record framed with its length and crc32 so
+    that a record torn by a crash is detected and discarded.  Records are read back oldest first
+    with peek() and removed with commit(); a segment file is deleted once every record in it has been
+    committed.  When the spool grows past max_bytes whole segments are deleted oldest first, so it is
+    the oldest records that are lost, and append() returns them so that the owner can deal with the gap.
+
+    Not thread safe, the owner must serialize access.
+    """
+
+    HEADER = struct.Struct("!II")
+    SEGMENT_RE = re.compile(r"^(\d+)\.seg$")
+    CURSOR_FILE = "cursor"
+
+    def __init__(self, path, max_bytes, segment_bytes=None):
+        """
+        :param path: Directory to keep the spool in, created if it does not exist
+        :param max_bytes: Maximum size of all segments together
+        :param segment_bytes: Size at which to start a new segment, defaults to an eighth of max_bytes
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes or max(1, max_bytes // 8)
+
+        try:
+            os.makedirs(self.path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Sizes of the segment files, by segment number
+        self._segments = {}
+        for entry in os.listdir(self.path):
+            match = self.SEGMENT_RE.match(entry)
+            if match:
+                index = int(match.group(1))
+                self._segments[index] = os.path.getsize(self._segment_path(index))
+
+        if self._segments:
+            self._repair(max(self._segments))
+        else:
+            self._segments[0] = 0
+            open(self._segment_path(0), "ab").close()
+
+        self._cursor = self._read_cursor()
+        self._writer = None
+
+    def _segment_path(self, index):
+        return os.path.join(self.path, "%020d.seg" % index)
+
+    @property
+    def _write_segment(self):
+        return max(self._segments)
+
+    def _read_cursor(self):
+        """The (segment, offset) of the oldest uncommitted record"""
+        first = min(self._segments)
+
+        try:
+            with open(os.path.join(self.path, self.CURSOR_FILE)) as f:
+                segment, offset = [int(value) for value in f.read().split()]
+        except (IOError, ValueError):
+            return (first, 0)
+
+        if segment not in self._segments or offset > self._segments[segment]:
+            return (first, 0)
+
+        return (segment, offset)
+
+    def _write_cursor(self):
+        cursor_path = os.path.join(self.path, self.CURSOR_FILE)
+        with open(cursor_path + ".tmp", "w") as f:
+            f.write("%d %d\n" % self._cursor)
+        os.rename(cursor_path + ".tmp", cursor_path)
+
+    def _records(self, index, offset):
+        """Yield (offset after record, record) for the intact records in a segment, starting at offset"""
+        with open(self._segment_path(index), "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(self.HEADER.size)
+                if len(header) < self.HEADER.size:
+                    return
+
+                length, crc = self.HEADER.unpack(header)
+                record = f.read(length)
+                if len(record) < length or zlib.crc32(record) & 0xFFFFFFFF != crc:
+                    daemon_log.warning(
+                        "Spool %s: damaged record in segment %s at %s, skipping rest of segment"
+                        % (self.path, index, offset)
+                    )
+                    return
+
+                offset += self.HEADER.size + length
+                yield offset, record
+
+    def _repair(self, index):
+        """Truncate a segment after its last intact record, removing anything torn by a crash"""
+        good_offset = 0
+        for good_offset, _ in self._records(index, 0):
+            pass
+
+        if good_offset != self._segments[index]:
+            with open(self._segment_path(index), "r+b") as f:
+                f.truncate(good_offset)
+            self._segments[index] = good_offset
+
+    @property
+    def size(self):
+        return sum(self._segments.values())
+
+    @property
+    def empty(self):
+        return self._cursor == (
+            self._write_segment,
+            self._segments[self._write_segment],
+        )
+
+    def append(self, records):
+        """
+        Append records (strs) to the spool, and sync them to disk
+
+        :return: List of the uncommitted records dropped to keep the spool within max_bytes, oldest first
+        """
+        if not records:
+            return []
+
+        for record in records:
+            if self._segments[self._write_segment] >= self.segment_bytes:
+                self._close_writer()
+                self._segments[self._write_segment + 1] = 0
+
+            if self._writer is None:
+                self._writer = open(self._segment_path(self._write_segment), "ab")
+
+            self._writer.write(
+                self.HEADER.pack(len(record), zlib.crc32(record) & 0xFFFFFFFF)
+            )
+            self._writer.write(record)
+            self._segments[self._write_segment] += self.HEADER.size + len(record)
+
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+
+        return self._enforce_limit()
+
+    def _enforce_limit(self):
+        """:return: List of the uncommitted records dropped"""
+        dropped = []
+        while self.size > self.max_bytes and len(self._segments) > 1:
+            oldest = min(self._segments)
+            if oldest >= self._cursor[0]:
+                offset = self._cursor[1] if self._cursor[0] == oldest else 0
+                dropped.extend(record for _, record in self._records(oldest, offset))
+            self._delete_segment(oldest)
+
+        if self._cursor[0] not in self._segments:
+            self._cursor = (min(self._segments), 0)
+            self._write_cursor()
+
+        if dropped:
+            daemon_log.warning(
+                "Spool %s full, dropped %s oldest records" % (self.path, len(dropped))
+            )
+
+        return dropped
+
+    def _delete_segment(self, index):
+        del self._segments[index]
+        try:
+            os.unlink(self._segment_path(index))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def peek(self):
+        """
+        Yield (cursor, record) for each uncommitted record, oldest first.  Pass a cursor to commit()
+        to remove that record and every record before it.
+        """
+        segment, offset = self._cursor
+        for index in sorted(self._segments):
+            if index < segment:
+                continue
+
+            if index == self._write_segment and self._writer is not None:
+                self._writer.flush()
+
+            for end_offset, record in self._records(
+                index, offset if index == segment else 0
+            ):
+                yield (index, end_offset), record
+
+    def commit(self, cursor):
+        """Remove every record up to and including the one that cursor was returned with"""
+        if cursor is None or cursor <= self._cursor:
+            return
+
+        self._cursor = cursor
+        segment, offset = cursor
+
+        for index in sorted(self._segments):
+            if index < segment or (
+                index == segment
+                and offset >= self._segments[index]
+                and index != self._write_segment
+            ):
+                self._delete_segment(index)
+
+        if self._cursor[0] not in self._segments:
+            self._cursor = (min(self._segments), 0)
+
+        self._write_cursor()
+
+    def close(self):
+        self._close_writer()
@@ -0,0 +1,127 @@
+# Copyright (c) 2018 DDN. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+"""
+Recent samples of cumulative counters, from which rates and their spread are worked out on the
+agent rather than by the manager.
+"""
+
+import array
+
+# Percentiles of the rate between successive samples reported by summarize()
+PERCENTILES = (50, 90, 99)
+
+
+class RingBuffer(object):
+    """The last capacity (time, value) samples of one series, in two fixed size arrays of doubles"""
+
+    __slots__ = ["_times", "_values", "_next", "_count"]
+
+    def __init__(self, capacity):
+        self._times = array.array("d", [0.0] * capacity)
+        self._values = array.array("d", [0.0] * capacity)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, time, value):
+        self._times[self._next] = time
+        self._values[self._next] = value
+        self._next = (self._next + 1) % len(self._times)
+        self._count = min(self._count + 1, len(self._times))
+
+    def samples(self, since=None):
+        """:return: List of (time, value), oldest first, of the samples taken at or after since"""
+        capacity = len(self._times)
+        start = (self._next - self._count) % capacity
+
+        samples = []
+        for offset in range(self._count):
+            index = (start + offset) % capacity
+            if since is None or self._times[index] >= since:
+                samples.append((self._times[index], self._values[index]))
+        return samples
+
+    @property
+    def latest_time(self):
+        return self._times[(self._next - 1) % len(self._times)] if self._count else None
+
+
+def _percentile(ordered, point):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * point / 100.0))]
+
+
+def summarize(samples):
+    """
+    :param samples: List of (time, value) of a cumulative counter, oldest first
+    :return: dict of the mean rate per second over the samples, and the min, max and percentiles
+             of the rates between successive samples, or None if there are too few samples.
+             Intervals over which the counter went backwards (it was reset) are left out.
+    """
+    rates = []
+    elapsed = 0.0
+    increase = 0.0
+    for (time, value), (next_time, next_value) in zip(samples, samples[1:]):
+        if next_time <= time or next_value < value:
+            continue
+        rates.append((next_value - value) / (next_time - time))
+        elapsed += next_time - time
+        increase += next_value - value
+
+    if not rates:
+        return None
+
+    ordered = sorted(rates)
+    summary = {
+        "rate": increase / elapsed,
+        "min": ordered[0],
+        "max": ordered[-1],
+        "samples": len(samples),
+    }
+    for point in PERCENTILES:
+        summary["p%s" % point] = _percentile(ordered, point)
+    return summary
+
+
+class TimeSeriesSet(object):
+    """A RingBuffer for each of a changing set of counters"""
+
+    def __init__(self, capacity):
+        """:param capacity: Samples kept of each counter"""
+        self.capacity = capacity
+        self._series = {}
+
+    def add(self, time, values):
+        """
+        Record a sample of every counter.  Counters missing from values (e.g. their target has been
+        unmounted) are forgotten.
+
+        :param values: dict of counter name to value
+        """
+        for name in list(self._series):
+            if name not in values:
+                del self._series[name]
+
+        for name, value in values.items():
+            series = self._series.get(name)
+            if series is None:
+                series = self._series[name] = RingBuffer(self.capacity)
+            series.append(time, value)
+
+    def summary(self, since=None):
+        """:return: dict of counter name to summarize() of its samples at or after since"""
+        summaries = {}
+        for name, series in self._series.items():
+            summary = summarize(series.samples(since))
+            if summary is not None:
+                summaries[name] = summary
+        return summaries
+
+    @property
+    def latest_time(self):
+        times = [series.latest_time for series in self._series.values()]
+        return max(times) if times else None
@@ -0,0 +1,119 @@
+# Copyright (c) 2018 DDN. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+"""
+Structural deltas between trees of nested dicts, such as the Lustre metrics, so that only what has
+changed since the previous scan need be sent.
+
+A delta is {"changed": {...}, "removed": [path, ...]}.  changed is a tree of just the leaves which
+are new or have changed, and removed lists the paths (lists of keys) of leaves and subtrees which
+are gone.  A delta is applied by deleting the removed paths, then merging in changed.
+
+Where a field of a message may hold either a whole tree or a delta, the delta is sent as
+{"delta": delta}, see is_delta().
+"""
+
+import copy
+
+DELTA_KEY = "delta"
+
+_MISSING = object()
+
+
+def _diff(old, new, path, removed):
+    changed = {}
+
+    for key in old:
+        if key not in new:
+            removed.append(path + [key])
+
+    for key, value in new.items():
+        previous = old.get(key, _MISSING)
+        if isinstance(value, dict) and isinstance(previous, dict):
+            subtree = _diff(previous, value, path + [key], removed)
+            if subtree:
+                changed[key] = subtree
+        elif previous is _MISSING or previous != value:
+            # A subtree replaced by a leaf or the reverse is removed first, so that applying (or
+            # composing) the delta does not merge the new value with the old
+            if isinstance(previous, dict) or isinstance(value, dict):
+                if previous is not _MISSING:
+                    removed.append(path + [key])
+            changed[key] = value
+
+    return changed
+
+
+def diff(old, new):
+    """:return: The delta which turns old into new, or None if they are the same"""
+    removed = []
+    changed = _diff(old, new, [], removed)
+
+    if not changed and not removed:
+        return None
+
+    return {"changed": changed, "removed": removed}
+
+
+def _merge(target, changes):
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+def _remove(tree, path):
+    for key in path[:-1]:
+        tree = tree.get(key)
+        if not isinstance(tree, dict):
+            return
+
+    tree.pop(path[-1], None)
+
+
+def apply(tree, delta):
+    """:return: A copy of tree with delta applied"""
+    tree = copy.deepcopy(tree)
+
+    for path in delta["removed"]:
+        _remove(tree, path)
+    _merge(tree, delta["changed"])
+
+    return tree
+
+
+def is_delta(value):
+    """True if value is a delta as sent in place of a whole tree, i.e. {"delta": delta}"""
+    return isinstance(value, dict) and value.keys() == [DELTA_KEY]
+
+
+def compose(earlier, later):
+    """
+    Combine two successive values of a field, each a whole tree or a delta, into one with the same
+    effect as applying both in turn, e.g. to replace an unsent message with a newer one.
+
+    :return: A whole tree if either is one (later's, or earlier's with later's delta applied),
+             otherwise a delta
+    """
+    if not is_delta(later):
+        return later
+
+    if not is_delta(earlier):
+        return apply(earlier, later[DELTA_KEY])
+
+    earlier, later = earlier[DELTA_KEY], later[DELTA_KEY]
+
+    # What later removes, it removes whatever earlier changed there.  Removals are applied before
+    # changes, so earlier's removals still apply beneath anything later changes.
+    changed = copy.deepcopy(earlier["changed"])
+    for path in later["removed"]:
+        _remove(changed, path)
+    _merge(changed, later["changed"])
+
+    removed = list(earlier["removed"])
+    removed.extend(path for path in later["removed"] if path not in removed)
+
+    return {DELTA_KEY: {"changed": changed, "removed": removed}}
@@ -9,6 +9,7 @@ import traceback
 import collections
 
 from chroma_agent.log import daemon_log
+from chroma_agent.lib import tree_delta
 from iml_common.lib.agent_rpc import agent_error
 
 EXCLUDED_PLUGINS = []
@@ -99,6 +100,12 @@ class DevicePlugin(object):
         60  # We always send an update every 60 cycles (60*10)seconds - 10 minutes.
     )
 
+    POLL_PERIOD = 10  # Seconds between calls to start_session/update_session, override per plugin.
+
+    # Set True if each start_session/update_session result describes the whole state of the plugin, so
+    # that an undelivered result can be replaced by a newer one, see merge_updates().
+    SNAPSHOT_UPDATES = False
+
     def __init__(self, session):
         self._session = session
         self._reset_delta()
@@ -137,6 +144,16 @@ class DevicePlugin(object):
         """
         pass
 
+    def merge_updates(self, earlier, later):
+        """
+        Combine an undelivered start_session/update_session result with a newer one which replaces
+        it, see SNAPSHOT_UPDATES.  Override to keep anything of earlier which later does not repeat,
+        e.g. counts since the previous result.
+
+        :return: The result to send in place of both, or None if both must be sent
+        """
+        return merge_snapshots(earlier, later)
+
     def on_message(self, body):
         """
         Handle a message sent from the manager (may be called concurrently with respect to
@@ -156,9 +173,33 @@ class DevicePlugin(object):
         else:
             self._session.send_message(DevicePluginMessage(body), callback)
 
-    def _delta_result(self, result, delta_fields=None):
+    def poll_now(self):
+        """
+        Have start_session/update_session called as soon as possible rather than at the next
+        POLL_PERIOD, e.g. when the plugin has been told something has changed.  May be called from
+        any thread.
+        """
+        if self._session is not None:
+            self._session.poll_now()
+
+    def _delta_result(self, result, delta_fields=None, tree_delta_fields=None):
+        """
+        Remove what has not changed since the previous result from result, except every
+        FAILSAFEDUPDATE results or when trigger_plugin_update is set.
+
+        :param delta_fields: Fields set to None if unchanged, all fields if not given
+        :param tree_delta_fields: Fields holding trees of dicts, sent as a tree_delta of what has
+                                  changed within them since the previous result, or None if nothing
+                                  has.  They are sent whole unless the session says the manager
+                                  applies deltas and holds the previous result, see
+                                  Session.tree_deltas.
+        """
         if not delta_fields:
             delta_fields = result.keys()
+        tree_delta_fields = tree_delta_fields or []
+        send_tree_deltas = bool(tree_delta_fields) and (
+            self._session is not None and self._session.tree_deltas
+        )
 
         if (self._safety_send < DevicePlugin.FAILSAFEDUPDATE) and (
             self.trigger_plugin_update is False
@@ -172,10 +213,25 @@ class DevicePlugin(object):
                     result[key] = None
                 else:
                     self.last_result[key] = result[key]
+
+            for key in tree_delta_fields:
+                previous, self.last_result[key] = self.last_result[key], result[key]
+                if (
+                    send_tree_deltas
+                    and isinstance(previous, dict)
+                    and isinstance(result[key], dict)
+                ):
+                    delta = tree_delta.diff(previous, result[key])
+                    result[key] = (
+                        None if delta is None else {tree_delta.DELTA_KEY: delta}
+                    )
         else:
             self._safety_send = 0
             self.trigger_plugin_update = False
 
+            for key in tree_delta_fields:
+                self.last_result[key] = result[key]
+
         return (
             result if result else None
         )  # Turn {} into None, None will mean no message sent.
@@ -185,7 +241,7 @@ class DevicePlugin(object):
         self._safety_send = 0
 
 
-# For use with Queue.PriorityQueue (lower number is higher priority)
+# For use with AgingPriorityQueue (lower number is higher priority)
 PRIO_LOW = 2
 PRIO_NORMAL = 1
 PRIO_HIGH = 0
@@ -209,20 +265,51 @@ class DevicePluginMessageCollection(list):
         self.priority = priority
 
 
+def merge_snapshots(earlier, later):
+    """
+    Combine two snapshots of the same state, later replacing earlier before it is sent.  Fields
+    which later sets to None (unchanged, see DevicePlugin._delta_result) keep their value from
+    earlier, and tree deltas are composed with earlier's value.
+
+    :return: The snapshot to send in place of both
+    """
+    if not (isinstance(earlier, dict) and isinstance(later, dict)):
+        return later
+
+    merged = dict(earlier)
+    for key, value in later.items():
+        if value is None and key in merged:
+            continue
+        if tree_delta.is_delta(value) and merged.get(key) is not None:
+            value = tree_delta.compose(merged[key], value)
+        merged[key] = value
+
+    return merged
+
+
 class DevicePluginMessage(object):
     """
     A single message from a device plugin, to be consumed by a service on the manager server.
 
-    Return this instead of a naked {} if you need to set the priority.
+    Return this instead of a naked {} if you need to set the priority, or to mark the message
+    as a snapshot.
     """
 
-    def __init__(self, message, priority=PRIO_NORMAL):
+    def __init__(self, message, priority=PRIO_NORMAL, snapshot=False, merge=None):
         """
         :param message: A JSON-serializable object
         :param priority: One of PRIO_LOW, PRIO_NORMAL, PRIO_HIGH
+        :param snapshot: True if the message describes the whole state of the plugin, in which
+                         case it replaces any earlier snapshot from the same session which has not
+                         yet been sent.
+        :param merge: Function of (earlier, later) messages of snapshots, returning the message to
+                      send in place of both, or None if both must be sent.  merge_snapshots() by
+                      default.
         """
         self.message = message
         self.priority = priority
+        self.snapshot = snapshot
+        self.merge = merge or merge_snapshots
 
 
 class DevicePluginManager(PluginManager):
@@ -1,8 +1,111 @@
 import os
 import mock
+import shutil
+import tempfile
+import unittest
 
 import chroma_agent.device_plugins.audit
 from chroma_agent.device_plugins.audit.local import LocalAudit
+from chroma_agent.device_plugins.audit.lustre import LustreAudit
 
 from tests.test_utils import PatchedContextTestCase
+from tests.lib.audit_results import synthetic_results, rebuild
 from iml_common.test.command_capture_testcase import CommandCaptureTestCase
+
+
+# Stand-ins for target audits, under names of their own so that they do not shadow the real ones.  Their
+# module and device type is their name without "Audit", e.g. fakemdt.
+class FakeMdtAudit(LustreAudit):
+    def _gather_raw_metrics(self):
+        self.raw_metrics["lustre"]["target"] = {
+            "healthy": self.is_healthy(),
+            "version": self.version,
+        }
+
+
+class FakeOstAudit(LustreAudit):
+    def _gather_raw_metrics(self):
+        self.raw_metrics["lustre"]["ost"] = len(self.devices())
+
+
+class TestScanContext(CommandCaptureTestCase):
+    def setUp(self):
+        super(TestScanContext, self).setUp()
+
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for path, content in [
+            ("proc/modules", "lustre 1 0\nfakemdt 1 0\nfakeost 1 0\n"),
+            ("proc/fs/lustre/health_check", "healthy\n"),
+        ]:
+            path = os.path.join(self.root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(content)
+
+        mock.patch.object(LustreAudit, "fscontext", self.root).start()
+        for audit in [FakeMdtAudit, FakeOstAudit]:
+            mock.patch.object(
+                chroma_agent.device_plugins.audit.lustre,
+                audit.__name__,
+                audit,
+                create=True,
+            ).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_scan_reads_once(self):
+        """Test that a scan reads each param and file once, however many audits use it"""
+        self.add_command(
+            ("lctl", "get_param", "-n", "devices"),
+            stdout="  0 UP fakemdt MDS MDS_uuid 3\n  1 UP fakeost OSS OSS_uuid 3\n",
+        )
+        self.add_command(("lctl", "get_param", "version"), stdout="version=2.10.4\n")
+
+        real_open = open
+        with mock.patch("__builtin__.open", side_effect=real_open) as mock_open:
+            audit = LocalAudit()
+            self.assertEqual(
+                audit.metrics(),
+                {
+                    "raw": {
+                        "lustre": {
+                            "target": {"healthy": True, "version": "2.10.4"},
+                            "ost": 2,
+                        }
+                    }
+                },
+            )
+            audit.properties()
+
+        self.assertRanAllCommandsInOrder()
+        self.assertEqual(
+            [call[0][0] for call in mock_open.call_args_list].count(
+                os.path.join(self.root, "proc/modules")
+            ),
+            1,
+        )
+
+
+class TestLocalAuditMerge(unittest.TestCase):
+    def _metrics(self, results):
+        audit = LocalAudit()
+        audit.audit_classes_list = [
+            mock.Mock(return_value=mock.Mock(metrics=mock.Mock(return_value=result)))
+            for result in results
+        ]
+        return audit.metrics()
+
+    def test_merge(self):
+        """Test that audit metrics are merged as the recursive merge did"""
+        self.assertEqual(
+            self._metrics(synthetic_results(100, 7)),
+            {"raw": rebuild(synthetic_results(100, 7))},
+        )
+
+    def test_conflict(self):
+        """Test that two audits reporting the same value is an error"""
+        with self.assertRaises(TypeError):
+            self._metrics(
+                [{"raw": {"lustre": {"a": 1}}}, {"raw": {"lustre": {"a": 1}}}]
+            )
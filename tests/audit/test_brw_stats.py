@@ -0,0 +1,198 @@
+import os
+import mock
+import unittest
+
+from chroma_agent.device_plugins.audit.lustre import LustreAudit, ObdfilterAudit
+from chroma_agent.device_plugins.audit.lustre.brw_stats import BrwStatsCollector
+from tests.test_utils import PatchedContextTestCase
+
+
+def fixture_lines(version, node, param):
+    path = os.path.join(
+        os.path.dirname(__file__), "..", "data/lustre_versions", version, node, param
+    )
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+class TestBrwStatsCollector(unittest.TestCase):
+    def test_parse(self):
+        """Test that every histogram of an OST's brw_stats is parsed"""
+        histograms = BrwStatsCollector().collect(
+            fixture_lines("2.10.5", "oss", "obdfilter.testfs-OST0000.brw_stats")
+        )
+
+        self.assertEqual(
+            sorted(histograms),
+            [
+                "dio_frags",
+                "discont_blocks",
+                "discont_pages",
+                "disk_iosize",
+                "io_time",
+                "pages",
+                "rpc_hist",
+            ],
+        )
+        self.assertEqual(
+            histograms["pages"],
+            {
+                "units": "rpcs",
+                "buckets": ["1", "2", "4", "8", "16", "32", "64", "128", "256"],
+                "read": [42, 0, 0, 0, 0, 0, 0, 0, 1822],
+                "write": [25, 0, 3, 0, 0, 0, 0, 0, 2377],
+            },
+        )
+        self.assertEqual(
+            histograms["disk_iosize"]["buckets"],
+            ["4K", "8K", "16K", "32K", "64K", "128K", "256K", "512K", "1M"],
+        )
+        self.assertEqual(sum(histograms["disk_iosize"]["write"]), 2412)
+        self.assertEqual(
+            histograms["discont_blocks"],
+            {
+                "units": "blocks",
+                "buckets": ["0", "1"],
+                "read": [1864, 0],
+                "write": [2398, 7],
+            },
+        )
+
+    def test_parse_empty(self):
+        """Test the brw_stats of a target that has done no I/O"""
+        self.assertEqual(
+            BrwStatsCollector().collect(
+                fixture_lines(
+                    "2.9.58_86_g2383a62",
+                    "mds_mgs",
+                    "osd-ldiskfs.testfs-MDT0000.brw_stats",
+                )
+            ),
+            {},
+        )
+
+    def test_deltas(self):
+        """Test that the change since the previous scan is reported, unchanged histograms omitted"""
+        lines = fixture_lines("2.10.5", "oss", "obdfilter.testfs-OST0000.brw_stats")
+        later = [
+            line.replace("4K:\t\t        42", "4K:\t\t        50") for line in lines
+        ]
+        collector = BrwStatsCollector()
+        collector.collect(lines)
+
+        self.assertEqual(
+            collector.collect(later),
+            {
+                "disk_iosize": {
+                    "units": "ios",
+                    "buckets": [
+                        "4K",
+                        "8K",
+                        "16K",
+                        "32K",
+                        "64K",
+                        "128K",
+                        "256K",
+                        "512K",
+                        "1M",
+                    ],
+                    "read": [8, 0, 0, 0, 0, 0, 0, 0, 0],
+                    "write": [0, 0, 0, 0, 0, 0, 0, 0, 0],
+                }
+            },
+        )
+        self.assertEqual(collector.collect(later), {})
+
+    def test_cleared(self):
+        """Test that after the counts are cleared, they are reported from zero"""
+        lines = fixture_lines("2.10.5", "oss", "obdfilter.testfs-OST0000.brw_stats")
+        cleared = [
+            line.replace("1M:\t\t      1822", "1M:\t\t         2") for line in lines
+        ]
+        collector = BrwStatsCollector()
+        collector.collect(lines)
+
+        self.assertEqual(
+            collector.collect(cleared),
+            {
+                "disk_iosize": {
+                    "units": "ios",
+                    "buckets": [
+                        "4K",
+                        "8K",
+                        "16K",
+                        "32K",
+                        "64K",
+                        "128K",
+                        "256K",
+                        "512K",
+                        "1M",
+                    ],
+                    "read": [42, 0, 0, 0, 0, 0, 0, 0, 2],
+                    "write": [25, 0, 3, 0, 0, 0, 0, 7, 2377],
+                }
+            },
+        )
+
+    def test_buckets_grow(self):
+        """Test that counts are matched by bucket when rows are added below the previous first one"""
+        header = "disk I/O size          ios   % cum % |  ios         % cum %"
+        collector = BrwStatsCollector()
+        collector.collect(
+            [
+                header,
+                "8K:                      4  50  50   |    0   0   0",
+                "16K:                     4  50 100   |    2 100 100",
+            ]
+        )
+
+        self.assertEqual(
+            collector.collect(
+                [
+                    header,
+                    "4K:                      1  11  11   |    0   0   0",
+                    "8K:                      4  44  55   |    0   0   0",
+                    "16K:                     4  44 100   |    2 100 100",
+                ]
+            ),
+            {
+                "disk_iosize": {
+                    "units": "ios",
+                    "buckets": ["4K", "8K", "16K"],
+                    "read": [1, 0, 0],
+                    "write": [0, 0, 0],
+                }
+            },
+        )
+
+
+class TestLustreAuditBrwStats(unittest.TestCase):
+    def test_brw_stats(self):
+        """Test that the audit keeps each target's collector from scan to scan"""
+        path = "obdfilter.testfs-OST0000.brw_stats"
+        self.addCleanup(LustreAudit._brw_stats_collectors.pop, path, None)
+
+        with mock.patch.object(
+            LustreAudit,
+            "stream_param_lines",
+            return_value=fixture_lines("2.10.5", "oss", path),
+        ):
+            self.assertEqual(len(LustreAudit().brw_stats(path)), 7)
+            self.assertEqual(LustreAudit().brw_stats(path), {})
+
+
+class TestObdfilterAuditBrwStats(PatchedContextTestCase):
+    def setUp(self):
+        self.test_root = os.path.join(
+            os.path.dirname(__file__), "..", "data/lustre_versions/2.10.5/oss"
+        )
+        super(TestObdfilterAuditBrwStats, self).setUp()
+
+    def test_metrics(self):
+        """Test that each OST's brw_stats are reported, then only the change in them"""
+        target = ObdfilterAudit().metrics()["raw"]["lustre"]["target"]["testfs-OST0000"]
+        self.assertEqual(len(target["brw_stats"]), 7)
+        self.assertEqual(target["brw_stats"]["io_time"]["read"], [900, 600, 300, 64, 0])
+
+        target = ObdfilterAudit().metrics()["raw"]["lustre"]["target"]["testfs-OST0000"]
+        self.assertEqual(target["brw_stats"], {})
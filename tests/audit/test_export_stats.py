@@ -0,0 +1,205 @@
+import os
+import shutil
+import tempfile
+import unittest
+from glob import glob
+
+from chroma_agent.device_plugins.audit.lustre import LustreAudit, ObdfilterAudit
+from chroma_agent.device_plugins.audit.lustre.export_stats import (
+    ExportStatsCollector,
+    export_target_nid,
+)
+from tests.test_utils import PatchedContextTestCase
+
+OSS = os.path.join(os.path.dirname(__file__), "..", "data/lustre_versions/2.10.5/oss")
+
+# The stats of two of the OSS fixture's clients a little before they were captured
+EARLIER = {
+    "10.14.83.68@tcp": (
+        "read_bytes                1042 samples [bytes] 4096 1048576 964689920",
+        "read_bytes                1032 samples [bytes] 4096 1048576 954204160",
+    ),
+    "10.14.83.69@tcp": (
+        "statfs                    8 samples [reqs]",
+        "statfs                    3 samples [reqs]",
+    ),
+}
+
+
+def fixture_exports(edits=None):
+    """
+    (name, lines) of each export of the OSS fixture, edits mapping the nid of any to change to the
+    (line, replacement) to make in its stats
+    """
+    exports = []
+    for path in sorted(glob(os.path.join(OSS, "obdfilter.*.exports.*.stats"))):
+        name = os.path.basename(path)
+        with open(path) as f:
+            lines = f.read().splitlines()
+
+        edit = (edits or {}).get(export_target_nid(name)[1])
+        if edit is not None:
+            lines = [edit[1] if line == edit[0] else line for line in lines]
+        exports.append((name, lines))
+    return exports
+
+
+def on_targets(exports, targets):
+    """The exports as they would be on each of targets instead of testfs-OST0000"""
+    return [
+        (name.replace("testfs-OST0000", target), lines)
+        for target in targets
+        for name, lines in exports
+    ]
+
+
+class TestExportTargetNid(unittest.TestCase):
+    def test_names(self):
+        self.assertEqual(
+            export_target_nid("obdfilter.testfs-OST0000.exports.192.168.0.1@tcp.stats"),
+            ("testfs-OST0000", "192.168.0.1@tcp"),
+        )
+        self.assertEqual(export_target_nid("obdfilter.testfs-OST0000.stats"), None)
+
+
+class TestExportStatsCollector(unittest.TestCase):
+    def test_deltas(self):
+        """Test that clients are reported by their activity since the previous collection"""
+        collector = ExportStatsCollector(2)
+
+        # Nothing to compare with yet
+        self.assertEqual(collector.collect(fixture_exports(EARLIER)), [])
+
+        self.assertEqual(
+            collector.collect(fixture_exports()),
+            [
+                {
+                    "nid": "10.14.83.68@tcp",
+                    "targets": ["testfs-OST0000"],
+                    "ops": 10,
+                    "read_bytes": 10485760,
+                    "write_bytes": 0,
+                },
+                {
+                    "nid": "10.14.83.69@tcp",
+                    "targets": ["testfs-OST0000"],
+                    "ops": 5,
+                    "read_bytes": 0,
+                    "write_bytes": 0,
+                },
+            ],
+        )
+        self.assertEqual(collector.collect(fixture_exports()), [])
+
+    def test_aggregate(self):
+        """Test that a client's activity on each target is summed, and the busiest reported"""
+        targets = ["testfs-OST0000", "testfs-OST0001"]
+        collector = ExportStatsCollector(1, key="bytes")
+        collector.collect(on_targets(fixture_exports(EARLIER), targets))
+
+        self.assertEqual(
+            collector.collect(on_targets(fixture_exports(), targets)),
+            [
+                {
+                    "nid": "10.14.83.68@tcp",
+                    "targets": targets,
+                    "ops": 20,
+                    "read_bytes": 20971520,
+                    "write_bytes": 0,
+                }
+            ],
+        )
+
+    def test_reconnect(self):
+        """Test that an export whose counters went backwards is counted from zero"""
+        collector = ExportStatsCollector(1)
+        collector.collect(
+            fixture_exports(
+                {
+                    "10.14.83.68@tcp": (
+                        "setattr                   1 samples [reqs]",
+                        "setattr                   5000 samples [reqs]",
+                    )
+                }
+            )
+        )
+
+        self.assertEqual(
+            collector.collect(fixture_exports()),
+            [
+                {
+                    "nid": "10.14.83.68@tcp",
+                    "targets": ["testfs-OST0000"],
+                    "ops": 2369,
+                    "read_bytes": 964689920,
+                    "write_bytes": 1362100224,
+                }
+            ],
+        )
+
+    def test_bounded_history(self):
+        """Test that totals are only kept for a bounded number of exports, the busiest"""
+        collector = ExportStatsCollector(1, history=2)
+        collector.collect(fixture_exports())
+
+        self.assertEqual(
+            sorted(collector._previous),
+            [
+                "obdfilter.testfs-OST0000.exports.10.14.83.65@tcp.stats",
+                "obdfilter.testfs-OST0000.exports.10.14.83.68@tcp.stats",
+            ],
+        )
+
+
+class TestLustreAuditExportStats(unittest.TestCase):
+    def test_export_stats(self):
+        """Test that the audit walks the exports natively and keeps the collector between scans"""
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = "obdfilter.*.exports.*.stats"
+        self.addCleanup(LustreAudit._export_stats_collectors.pop, path, None)
+
+        def write_stats(exports):
+            for name, lines in exports:
+                target, nid = export_target_nid(name)
+                directory = os.path.join(
+                    root, "proc/fs/lustre/obdfilter", target, "exports", nid
+                )
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                with open(os.path.join(directory, "stats"), "w") as f:
+                    f.write("\n".join(lines) + "\n")
+
+        audit = LustreAudit()
+        audit.fscontext = root
+
+        write_stats(fixture_exports(EARLIER))
+        self.assertEqual(audit.export_stats(path), [])
+
+        write_stats(fixture_exports())
+        audit = LustreAudit()
+        audit.fscontext = root
+        self.assertEqual(
+            [(client["nid"], client["ops"]) for client in audit.export_stats(path)],
+            [("10.14.83.68@tcp", 10), ("10.14.83.69@tcp", 5)],
+        )
+
+
+class TestObdfilterAuditExportStats(PatchedContextTestCase):
+    def setUp(self):
+        self.test_root = OSS
+        super(TestObdfilterAuditExportStats, self).setUp()
+
+    def test_metrics(self):
+        """Test that the OSTs' exports are followed from scan to scan"""
+        self.assertEqual(
+            ObdfilterAudit().metrics()["raw"]["lustre"]["clients"], {"obdfilter": []}
+        )
+        self.assertEqual(
+            len(
+                LustreAudit._export_stats_collectors[
+                    "obdfilter.*.exports.*.stats"
+                ]._previous
+            ),
+            3,
+        )
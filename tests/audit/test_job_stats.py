@@ -0,0 +1,275 @@
+import os
+import mock
+import unittest
+
+from chroma_agent.device_plugins.audit.lustre import (
+    LustreAudit,
+    MdtAudit,
+    ObdfilterAudit,
+)
+from chroma_agent.device_plugins.audit.lustre.job_stats import (
+    JobStatsCollector,
+    parse_job_stats,
+)
+from tests.test_utils import PatchedContextTestCase
+
+
+def job_stats(jobs):
+    """job_stats output for jobs, a list of (job_id, snapshot_time, write samples, write bytes)"""
+    lines = ["job_stats:"]
+    for job_id, snapshot_time, samples, total in jobs:
+        lines.extend(
+            [
+                "- job_id:          %s" % job_id,
+                "  snapshot_time:   %s" % snapshot_time,
+                "  write_bytes:     { samples: %11d, unit: bytes, min: 4096, max: 4096, sum: %15d }"
+                % (samples, total),
+                "  punch:           { samples: %11d, unit:  reqs }" % 0,
+            ]
+        )
+    return lines
+
+
+def fixture_lines(version, node, param):
+    path = os.path.join(
+        os.path.dirname(__file__), "..", "data/lustre_versions", version, node, param
+    )
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+class TestParseJobStats(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(
+            list(
+                parse_job_stats(
+                    job_stats([("dd.0", 100, 2, 8192), ("cp.0", 101, 1, 4096)])
+                )
+            ),
+            [
+                (
+                    "dd.0",
+                    100,
+                    {"write_bytes": (2, "bytes", 8192), "punch": (0, "reqs", None)},
+                ),
+                (
+                    "cp.0",
+                    101,
+                    {"write_bytes": (1, "bytes", 4096), "punch": (0, "reqs", None)},
+                ),
+            ],
+        )
+
+    def test_parse_ost(self):
+        jobs = list(
+            parse_job_stats(
+                fixture_lines("2.10.5", "oss", "obdfilter.testfs-OST0000.job_stats")
+            )
+        )
+
+        self.assertEqual(
+            [(job_id, snapshot_time) for job_id, snapshot_time, _ in jobs],
+            [("dd.0", 1537070542), ("cp.0", 1537070571), ("rm.0", 1537070589)],
+        )
+        ops = jobs[1][2]
+        self.assertEqual(len(ops), 12)
+        self.assertEqual(ops["read_bytes"], (1864, "bytes", 1725825024))
+        self.assertEqual(ops["write_bytes"], (357, "bytes", 351309824))
+        self.assertEqual(ops["punch"], (7, "reqs", None))
+
+    def test_parse_mdt(self):
+        jobs = list(
+            parse_job_stats(
+                fixture_lines("2.10.5", "mds_mgs", "mdt.testfs-MDT0000.job_stats")
+            )
+        )
+
+        self.assertEqual([job_id for job_id, _, _ in jobs], ["touch.0", "rm.0"])
+        self.assertEqual(len(jobs[0][2]), 16)
+        self.assertEqual(jobs[0][2]["mknod"], (100, "reqs", None))
+        self.assertEqual(jobs[1][2]["unlink"], (100, "reqs", None))
+
+    def test_parse_empty(self):
+        """Test the job_stats of a target with no recent jobs"""
+        self.assertEqual(
+            list(
+                parse_job_stats(
+                    fixture_lines(
+                        "2.9.58_86_g2383a62", "mds_mgs", "mdt.testfs-MDT0000.job_stats"
+                    )
+                )
+            ),
+            [],
+        )
+
+
+class TestJobStatsCollector(unittest.TestCase):
+    def test_top_jobs(self):
+        """Test that only the most active jobs are reported, most active first"""
+        collector = JobStatsCollector(2)
+        self.assertEqual(
+            collector.collect(
+                job_stats([("a", 90, 0, 0), ("b", 90, 0, 0), ("c", 90, 0, 0)])
+            ),
+            [],
+        )
+        jobs = collector.collect(
+            job_stats([("a", 100, 1, 10), ("b", 100, 5, 50), ("c", 100, 3, 30)])
+        )
+
+        self.assertEqual(
+            jobs,
+            [
+                {
+                    "job_id": "b",
+                    "snapshot_time": 100,
+                    "write_bytes": {"samples": 5, "unit": "bytes", "sum": 50},
+                },
+                {
+                    "job_id": "c",
+                    "snapshot_time": 100,
+                    "write_bytes": {"samples": 3, "unit": "bytes", "sum": 30},
+                },
+            ],
+        )
+
+    def test_deltas(self):
+        """Test that jobs are ranked and reported by their activity since the previous scan"""
+        collector = JobStatsCollector(2)
+        collector.collect(job_stats([("a", 100, 1, 10), ("b", 100, 50, 500)]))
+
+        jobs = collector.collect(
+            job_stats([("a", 110, 4, 40), ("b", 110, 51, 510), ("c", 110, 2, 20)])
+        )
+
+        # c has nothing to compare with yet
+        self.assertEqual([job["job_id"] for job in jobs], ["a", "b"])
+        self.assertEqual(
+            jobs[0]["write_bytes"], {"samples": 3, "unit": "bytes", "sum": 30}
+        )
+
+        # Nothing updated since, nothing to report
+        self.assertEqual(
+            collector.collect(
+                job_stats([("a", 110, 4, 40), ("b", 110, 51, 510), ("c", 110, 2, 20)])
+            ),
+            [],
+        )
+
+    def test_same_second(self):
+        """Test that a job updated again in the same second as the previous scan is reported"""
+        collector = JobStatsCollector(2)
+        collector.collect(job_stats([("a", 100, 1, 10)]))
+
+        jobs = collector.collect(job_stats([("a", 100, 3, 30)]))
+
+        self.assertEqual(
+            jobs[0]["write_bytes"], {"samples": 2, "unit": "bytes", "sum": 20}
+        )
+
+    def test_reappearing_job(self):
+        """Test that a job whose totals were not kept is not reported as if it had just started"""
+        collector = JobStatsCollector(1, history=1)
+        collector.collect(job_stats([("a", 100, 10, 100), ("b", 100, 1, 10)]))
+        self.assertEqual(list(collector._previous), ["a"])
+
+        self.assertEqual(
+            collector.collect(job_stats([("a", 100, 10, 100), ("b", 110, 50, 500)])),
+            [],
+        )
+        self.assertEqual(list(collector._previous), ["b"])
+
+        jobs = collector.collect(job_stats([("a", 120, 11, 110), ("b", 120, 60, 600)]))
+        self.assertEqual([job["job_id"] for job in jobs], ["b"])
+        self.assertEqual(
+            jobs[0]["write_bytes"], {"samples": 10, "unit": "bytes", "sum": 100}
+        )
+
+    def test_rank_by_bytes(self):
+        collector = JobStatsCollector(1, key="bytes")
+        collector.collect(
+            job_stats([("few large", 90, 0, 0), ("many small", 90, 0, 0)])
+        )
+        jobs = collector.collect(
+            job_stats([("few large", 100, 1, 1000), ("many small", 100, 9, 9)])
+        )
+
+        self.assertEqual([job["job_id"] for job in jobs], ["few large"])
+
+    def test_bounded_history(self):
+        """Test that totals are only kept for the most active jobs"""
+        collector = JobStatsCollector(2, history=3)
+        collector.collect(job_stats([(str(n), 100, n, n) for n in range(1, 1001)]))
+
+        self.assertEqual(sorted(collector._previous), ["1000", "998", "999"])
+
+
+class TestLustreAuditJobStats(unittest.TestCase):
+    def test_job_stats(self):
+        """Test that the audit keeps each target's collector from scan to scan"""
+        path = "obdfilter.testfs-OST0000.job_stats"
+        self.addCleanup(LustreAudit._job_stats_collectors.pop, path, None)
+
+        with mock.patch.object(
+            LustreAudit,
+            "stream_param_lines",
+            side_effect=lambda path: job_stats([("a", 100, 1, 10)]),
+        ):
+            self.assertEqual(LustreAudit().job_stats(path), [])
+        with mock.patch.object(
+            LustreAudit,
+            "stream_param_lines",
+            side_effect=lambda path: job_stats([("a", 110, 2, 20)]),
+        ):
+            self.assertEqual(len(LustreAudit().job_stats(path)), 1)
+
+        with mock.patch.object(
+            LustreAudit,
+            "stream_param_lines",
+            side_effect=IOError("job_stats not enabled"),
+        ):
+            self.assertEqual(LustreAudit().job_stats(path), [])
+
+
+class TestTargetAuditJobStats(PatchedContextTestCase):
+    def setUp(self):
+        self.test_root = os.path.join(
+            os.path.dirname(__file__), "..", "data/lustre_versions/2.10.5/oss"
+        )
+        super(TestTargetAuditJobStats, self).setUp()
+
+    def test_available(self):
+        self.assertTrue(ObdfilterAudit.is_available())
+        self.assertFalse(MdtAudit.is_available())
+
+    def test_metrics(self):
+        """Test that each target's most active jobs are reported from the second scan"""
+        targets = ObdfilterAudit().metrics()["raw"]["lustre"]["target"]
+        self.assertEqual(targets.keys(), ["testfs-OST0000"])
+        self.assertEqual(targets["testfs-OST0000"]["job_stats"], [])
+        self.assertEqual(
+            targets["testfs-OST0000"]["stats"]["write_bytes"]["sum"], 2498793472
+        )
+
+        lines = fixture_lines("2.10.5", "oss", "obdfilter.testfs-OST0000.job_stats")
+        lines[
+            lines.index("- job_id:          rm.0") + 1
+        ] = "  snapshot_time:   1537070600"
+        lines[
+            lines.index("- job_id:          rm.0") + 8
+        ] = "  destroy:         { samples:         512, unit:  reqs }"
+        with mock.patch.object(
+            ObdfilterAudit, "stream_param_lines", return_value=iter(lines)
+        ):
+            targets = ObdfilterAudit().metrics()["raw"]["lustre"]["target"]
+
+        self.assertEqual(
+            targets["testfs-OST0000"]["job_stats"],
+            [
+                {
+                    "job_id": "rm.0",
+                    "snapshot_time": 1537070600,
+                    "destroy": {"samples": 300, "unit": "reqs"},
+                }
+            ],
+        )
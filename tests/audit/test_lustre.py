@@ -1,8 +1,14 @@
+import mock
+import unittest
 import tempfile
 import os
 import shutil
 import chroma_agent.device_plugins.audit.lustre
-from chroma_agent.device_plugins.audit.lustre import LustreAudit
+from chroma_agent.device_plugins.audit.lustre import (
+    LustreAudit,
+    MdtAudit,
+    ObdfilterAudit,
+)
 
 from iml_common.test.command_capture_testcase import CommandCaptureTestCase
 from tests.test_utils import PatchedContextTestCase
@@ -24,6 +30,88 @@ class TestLustreAudit(PatchedContextTestCase):
         self.assertEqual(self.audit.version_info, self.audit.LustreVersion(2, 9, 58))
 
 
+class TestMdtAudit(PatchedContextTestCase):
+    def setUp(self):
+        tests = os.path.join(os.path.dirname(__file__), "..")
+        self.test_root = os.path.join(
+            tests, "data/lustre_versions/2.9.58_86_g2383a62/mds_mgs"
+        )
+        super(TestMdtAudit, self).setUp()
+
+    def test_available(self):
+        self.assertTrue(MdtAudit.is_available())
+        self.assertFalse(ObdfilterAudit.is_available())
+
+    def test_metrics(self):
+        targets = MdtAudit().metrics()["raw"]["lustre"]["target"]
+
+        self.assertEqual(targets.keys(), ["testfs-MDT0000"])
+        self.assertEqual(
+            targets["testfs-MDT0000"]["stats"]["open"],
+            {"count": 8, "units": "reqs"},
+        )
+        self.assertEqual(targets["testfs-MDT0000"]["job_stats"], [])
+
+    def test_counters(self):
+        """Test that each MDT's md_stats are sampled"""
+        counters = MdtAudit().counters()
+
+        self.assertEqual(counters["mdt.testfs-MDT0000.md_stats/open/count"], 8)
+        self.assertEqual(counters["mdt.testfs-MDT0000.md_stats/statfs/count"], 1)
+        self.assertNotIn("mdt.testfs-MDT0000.md_stats/open/sum", counters)
+
+
+class TestObdfilterAudit(PatchedContextTestCase):
+    def setUp(self):
+        tests = os.path.join(os.path.dirname(__file__), "..")
+        self.test_root = os.path.join(tests, "data/lustre_versions/2.10.5/oss")
+        super(TestObdfilterAudit, self).setUp()
+
+    def test_available(self):
+        self.assertTrue(ObdfilterAudit.is_available())
+        self.assertFalse(MdtAudit.is_available())
+
+    def test_prune_collectors(self):
+        """Test that the collectors of targets which are no longer local are dropped"""
+        for path in [
+            "obdfilter.testfs-OST0001.job_stats",
+            "obdfilter.testfs-OST0001.brw_stats",
+            "mdt.testfs-MDT0000.job_stats",
+        ]:
+            ObdfilterAudit().brw_stats(path)
+            ObdfilterAudit().job_stats(path)
+        ObdfilterAudit().export_stats("mdt.*.exports.*.stats")
+
+        ObdfilterAudit().metrics()
+
+        self.assertEqual(
+            LustreAudit._job_stats_collectors.keys(),
+            ["obdfilter.testfs-OST0000.job_stats"],
+        )
+        self.assertEqual(
+            LustreAudit._brw_stats_collectors.keys(),
+            ["obdfilter.testfs-OST0000.brw_stats"],
+        )
+        self.assertEqual(
+            LustreAudit._export_stats_collectors.keys(),
+            ["obdfilter.*.exports.*.stats"],
+        )
+
+    def test_counters(self):
+        """Test that each OST's stats are sampled"""
+        counters = ObdfilterAudit().counters()
+
+        self.assertEqual(
+            counters["obdfilter.testfs-OST0000.stats/read_bytes/count"], 1864
+        )
+        self.assertEqual(
+            counters["obdfilter.testfs-OST0000.stats/read_bytes/sum"], 1725825024
+        )
+        self.assertEqual(
+            counters["obdfilter.testfs-OST0000.stats/write_bytes/sum"], 2498793472
+        )
+
+
 class TestGitLustreVersion(PatchedContextTestCase):
     def setUp(self):
         tests = os.path.join(os.path.dirname(__file__), "..")
@@ -101,3 +189,65 @@ class TestLustreAuditBadHealth(CommandCaptureTestCase):
 
     def test_healthy_false(self):
         assert not self.audit.is_healthy()
+
+
+class TestLustreAuditCounters(CommandCaptureTestCase):
+    def test_counters(self):
+        """Test that the count and sum of each stat in COUNTER_PARAMS are sampled"""
+        self.add_command(
+            ("lctl", "get_param", "-N", "obdfilter.*.stats"),
+            stdout="obdfilter.testfs-OST0000.stats\n",
+        )
+        self.add_command(
+            ("lctl", "get_param", "-n", "obdfilter.testfs-OST0000.stats"),
+            stdout="snapshot_time             1497631413.744622331 secs.nsecs\n"
+            "read_bytes                10 samples [bytes] 4096 4096 40960\n"
+            "statfs                    3 samples [reqs]\n",
+        )
+
+        with mock.patch.object(LustreAudit, "COUNTER_PARAMS", ["obdfilter.*.stats"]):
+            self.assertEqual(
+                LustreAudit().counters(),
+                {
+                    "obdfilter.testfs-OST0000.stats/read_bytes/count": 10,
+                    "obdfilter.testfs-OST0000.stats/read_bytes/sum": 40960,
+                    "obdfilter.testfs-OST0000.stats/statfs/count": 3,
+                },
+            )
+        self.assertRanAllCommandsInOrder()
+
+
+class TestLustreAuditStats(unittest.TestCase):
+    def _lines(self, error):
+        yield "snapshot_time             1497631413.744622331 secs.nsecs"
+        yield "read_bytes                10 samples [bytes] 4096 4096 40960"
+        raise error
+
+    def test_io_error(self):
+        """Test that the stats parsed before an IOError are kept (HYD-389)"""
+        with mock.patch.object(
+            LustreAudit, "get_param_lines", return_value=self._lines(IOError())
+        ):
+            self.assertEqual(
+                LustreAudit().stats_dict_from_path("obdfilter.testfs-OST0000.stats"),
+                {
+                    "read_bytes": {
+                        "count": 10,
+                        "units": "bytes",
+                        "min": 4096,
+                        "max": 4096,
+                        "sum": 40960,
+                    }
+                },
+            )
+
+    def test_other_error(self):
+        """Test that errors other than an IOError are not hidden"""
+        with mock.patch.object(
+            LustreAudit, "get_param_lines", return_value=self._lines(ValueError())
+        ):
+            self.assertRaises(
+                ValueError,
+                LustreAudit().stats_dict_from_path,
+                "obdfilter.testfs-OST0000.stats",
+            )
@@ -0,0 +1,51 @@
+import unittest
+
+from chroma_agent.device_plugins.audit.lustre.stats_parser import (
+    Stat,
+    parse_stats,
+    parse_pairs,
+)
+from tests.benchmark_stats_parser import fixture_stats, regex_stats
+
+
+class TestStatsParser(unittest.TestCase):
+    def test_parse(self):
+        stats = parse_stats(
+            [
+                "snapshot_time             1497631413.744622331 secs.nsecs",
+                "create                    726 samples [reqs]",
+                "cache_miss                21108 samples [pages] 1 1 21108",
+                "obd_ping                  1108 samples [usec] 15 72 47014 2156132",
+                "req_waittime              9 samples [usec] -45 0 -293 9991",
+            ]
+        )
+
+        self.assertEqual(
+            stats,
+            {
+                "create": Stat(726, "reqs", None, None, None, None),
+                "cache_miss": Stat(21108, "pages", 1, 1, 21108, None),
+                "obd_ping": Stat(1108, "usec", 15, 72, 47014, 2156132),
+            },
+        )
+        self.assertEqual(
+            stats["cache_miss"].as_dict(),
+            {"count": 21108, "units": "pages", "min": 1, "max": 1, "sum": 21108},
+        )
+
+    def test_fixtures(self):
+        """Test that every fixture parses as the regular expression it replaced parsed it"""
+        files = fixture_stats()
+        self.assertTrue(files)
+
+        for lines in files:
+            self.assertEqual(
+                dict(
+                    (name, stat.as_dict()) for name, stat in parse_stats(lines).items()
+                ),
+                regex_stats(lines),
+            )
+
+    def test_pairs(self):
+        self.assertEqual(parse_pairs(["a 1", "b  2"]), {"a": "1", "b": "2"})
+        self.assertRaises(ValueError, parse_pairs, ["a 1 2"])
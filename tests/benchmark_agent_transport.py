@@ -0,0 +1,256 @@
+"""
+Measure agent transport throughput against a FakeManager, with no network or real manager needed.
+
+Runs N AgentClients in this process, each with synthetic device plugins sending messages of a
+given size, and reports messages per second, POST and end to end latency percentiles, outgoing
+queue depth and CPU.
+
+    python -m tests.benchmark_agent_transport --agents 20 --duration 30
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import datetime
+import argparse
+import threading
+
+import mock
+
+from chroma_agent import agent_client
+from chroma_agent.agent_client import AgentClient
+from chroma_agent.plugin_manager import DevicePlugin
+from tests.lib.fake_manager import FakeManager
+
+
+def synthetic_plugin(poll_period, message_bytes):
+    class SyntheticPlugin(DevicePlugin):
+        """Sends a fresh message of about message_bytes every poll"""
+
+        POLL_PERIOD = poll_period
+
+        def start_session(self):
+            return self.update_session()
+
+        def update_session(self):
+            # Varying numbers, so that compression sees something like real metrics
+            values = []
+            size = 0
+            while size < message_bytes:
+                value = random.randint(0, 1 << 32)
+                values.append(value)
+                size += len(str(value)) + 2
+
+            return {"generated_at": time.time(), "values": values}
+
+    return SyntheticPlugin
+
+
+class SyntheticPluginManager(object):
+    def __init__(self, plugins, poll_period, message_bytes):
+        self._plugins = dict(
+            ("synthetic_%s" % index, synthetic_plugin(poll_period, message_bytes))
+            for index in range(plugins)
+        )
+
+    def get_plugins(self):
+        return self._plugins
+
+    def get(self, plugin_name):
+        return self._plugins[plugin_name]
+
+
+class SyntheticServerProperties(object):
+    def __init__(self, fqdn):
+        self.fqdn = fqdn
+        self.nodename = fqdn.split(".")[0]
+        self.boot_time = datetime.datetime.utcnow()
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return dict((point, None) for point in points)
+
+    values = sorted(values)
+    return dict(
+        (point, values[min(len(values) - 1, int(len(values) * point / 100.0))])
+        for point in points
+    )
+
+
+def timed(function, latencies):
+    def wrapper(*args, **kwargs):
+        started_at = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            latencies.append(time.time() - started_at)
+
+    return wrapper
+
+
+def run_benchmark(
+    agents=10,
+    plugins=4,
+    duration=10.0,
+    poll_period=1.0,
+    message_bytes=4096,
+    acks=True,
+    session_timeout=30.0,
+):
+    """
+    :return: dict of results, see main() for their meaning
+    """
+    running = set(threading.enumerate())
+    manager = FakeManager(acks=acks)
+    manager.start()
+
+    crypto = mock.Mock(certificate_file=None, private_key_file=None)
+    post_latencies = []
+    clients = []
+
+    # Synthetic agents all start together, don't wait for the phase offset before requesting sessions
+    with mock.patch.object(agent_client, "phase_offset", return_value=0.0):
+        for index in range(agents):
+            fqdn = "agent%04d.example.com" % index
+            client = AgentClient(
+                manager.url(fqdn),
+                mock.Mock(),
+                SyntheticPluginManager(plugins, poll_period, message_bytes),
+                SyntheticServerProperties(fqdn),
+                crypto,
+            )
+            client.post_encoded = timed(client.post_encoded, post_latencies)
+            client.start()
+            clients.append(client)
+
+        # Measure from when every session is up
+        deadline = time.time() + session_timeout
+        while manager.session_count() < agents * plugins:
+            if time.time() > deadline:
+                raise RuntimeError(
+                    "Only %s of %s sessions created"
+                    % (manager.session_count(), agents * plugins)
+                )
+            time.sleep(0.1)
+
+    depths = []
+    stopping = threading.Event()
+
+    def sample_queues():
+        while not stopping.wait(0.1):
+            depths.append(
+                sum(
+                    level["depth"]
+                    for client in clients
+                    for level in client.writer.queue_stats
+                )
+            )
+
+    sampler = threading.Thread(target=sample_queues)
+    sampler.start()
+
+    delivered_before = manager.stats["delivered"]
+    del manager.latencies[:]
+    del post_latencies[:]
+    cpu_before = sum(os.times()[:2])
+    started_at = time.time()
+
+    time.sleep(duration)
+
+    elapsed = time.time() - started_at
+    cpu = sum(os.times()[:2]) - cpu_before
+    delivered = manager.stats["delivered"] - delivered_before
+    post_latency = percentiles(post_latencies)
+    message_latency = percentiles(manager.latencies)
+
+    stopping.set()
+    sampler.join()
+
+    for client in clients:
+        client.stop()
+    for client in clients:
+        client.join()
+    # Readers return once their outstanding long poll does
+    for client in clients:
+        client.reader.join()
+    manager.stop()
+    # Threads still running at exit print tracebacks as the interpreter tears down
+    leftover = [t.name for t in threading.enumerate() if t not in running]
+    assert not leftover, "Threads still running: %s" % ", ".join(leftover)
+
+    return {
+        "agents": agents,
+        "plugins": plugins,
+        "message_bytes": message_bytes,
+        "messages_per_second": delivered / elapsed,
+        "posts": len(post_latencies),
+        "post_latency": post_latency,
+        "message_latency": message_latency,
+        "queue_depth_mean": (sum(depths) / float(len(depths))) if depths else 0,
+        "queue_depth_max": max(depths) if depths else 0,
+        # Includes the fake manager, which runs in the same process
+        "cpu_percent_per_agent": 100.0 * cpu / elapsed / agents,
+        "manager_stats": dict(manager.stats),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--agents", type=int, default=10)
+    parser.add_argument("--plugins", type=int, default=4, help="Plugins per agent")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds")
+    parser.add_argument(
+        "--poll-period", type=float, default=1.0, help="Seconds between plugin polls"
+    )
+    parser.add_argument("--message-bytes", type=int, default=4096)
+    parser.add_argument(
+        "--no-acks", action="store_true", help="Fake manager does not acknowledge"
+    )
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        agents=args.agents,
+        plugins=args.plugins,
+        duration=args.duration,
+        poll_period=args.poll_period,
+        message_bytes=args.message_bytes,
+        acks=not args.no_acks,
+    )
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    def ms(value):
+        return "-" if value is None else "%.1fms" % (value * 1000)
+
+    print(
+        "%(agents)s agents x %(plugins)s plugins, %(message_bytes)s byte messages"
+        % results
+    )
+    print("  messages/s:        %.1f" % results["messages_per_second"])
+    print("  POSTs:             %s" % results["posts"])
+    for name in ["post_latency", "message_latency"]:
+        print(
+            "  %-18s %s"
+            % (
+                name.replace("_", " ") + ":",
+                "  ".join(
+                    "p%s %s" % (point, ms(value))
+                    for point, value in sorted(results[name].items())
+                ),
+            )
+        )
+    print(
+        "  queue depth:       mean %.1f  max %s"
+        % (results["queue_depth_mean"], results["queue_depth_max"])
+    )
+    print("  CPU per agent:     %.2f%%" % results["cpu_percent_per_agent"])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
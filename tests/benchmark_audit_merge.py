@@ -0,0 +1,68 @@
+"""
+Measure how the time LocalAudit.metrics() spends merging audit results grows with the number of
+audits and targets, against the recursive rebuild it replaced.
+
+Each synthetic audit reports stats for its share of the targets, as the Lustre target audits do,
+and all are merged into one tree.  Time per target should stay flat as targets grow.
+
+    python -m tests.benchmark_audit_merge --targets 1000 2000 4000 8000 --audits 8
+"""
+
+import sys
+import time
+import argparse
+
+import mock
+
+from chroma_agent.device_plugins.audit.local import LocalAudit
+from tests.lib.audit_results import synthetic_results, rebuild
+
+
+def time_merge(merge, results):
+    started_at = time.time()
+    merge(results)
+    return time.time() - started_at
+
+
+def in_place(results):
+    classes = [
+        mock.Mock(return_value=mock.Mock(metrics=mock.Mock(return_value=result)))
+        for result in results
+    ]
+    audit = LocalAudit()
+    audit.audit_classes_list = classes
+    return audit.metrics()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--targets", type=int, nargs="+", default=[1000, 2000, 4000, 8000]
+    )
+    parser.add_argument("--audits", type=int, nargs="+", default=[2, 8, 32])
+    args = parser.parse_args()
+
+    print(
+        "%8s %8s %14s %14s %16s"
+        % ("audits", "targets", "rebuild", "in place", "in place/target")
+    )
+    for audits in args.audits:
+        for targets in args.targets:
+            # The in place merge takes the results' dicts, so each merge gets its own
+            results = synthetic_results(targets, audits)
+            rebuild_time = time_merge(rebuild, results)
+            in_place_time = time_merge(in_place, synthetic_results(targets, audits))
+            print(
+                "%8s %8s %13.1fms %13.1fms %15.2fus"
+                % (
+                    audits,
+                    targets,
+                    rebuild_time * 1000,
+                    in_place_time * 1000,
+                    in_place_time * 1000000 / targets,
+                )
+            )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
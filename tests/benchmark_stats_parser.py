@@ -0,0 +1,109 @@
+"""
+Compare the Lustre stats parsers with the per call regular expressions they replaced, over the
+stats files in tests/data/lustre_versions.
+
+    python -m tests.benchmark_stats_parser --repeat 2000
+"""
+
+import os
+import re
+import sys
+import glob
+import time
+import argparse
+
+from chroma_agent.device_plugins.audit.lustre.stats_parser import (
+    parse_stats,
+    parse_pairs,
+)
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "data", "lustre_versions")
+
+
+def fixture_stats():
+    """:return: List of the lines of each stats file in the fixtures"""
+    files = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, "*", "*", "*stats"))):
+        with open(path) as f:
+            lines = f.read().strip().split("\n")
+        if any(" samples [" in line for line in lines):
+            files.append(lines)
+    return files
+
+
+def regex_stats(lines):
+    """LustreAudit.stats_dict_from_path as it was, compiling its expression on each call"""
+    stats_re = re.compile(
+        r"""
+    ^
+    (?P<name>\w+)\s+(?P<count>\d+)\s+samples\s+\[(?P<units>\w+)\]
+    (?P<min_max_sum>\s+(?P<min>\d+)\s+(?P<max>\d+)\s+(?P<sum>\d+)
+    (?P<sumsq>\s+(?P<sumsquare>\d+))?)?
+    $
+    """,
+        re.VERBOSE,
+    )
+
+    stats = {}
+    for line in lines:
+        match = re.match(stats_re, line)
+        if not match:
+            continue
+
+        name = match.group("name")
+        stats[name] = {
+            "count": int(match.group("count")),
+            "units": match.group("units"),
+        }
+        if match.group("min_max_sum") is not None:
+            stats[name].update(
+                {
+                    "min": int(match.group("min")),
+                    "max": int(match.group("max")),
+                    "sum": int(match.group("sum")),
+                }
+            )
+        if match.group("sumsq") is not None:
+            stats[name].update({"sumsquare": int(match.group("sumsquare"))})
+    return stats
+
+
+def parser_stats(lines):
+    return dict((name, stat.as_dict()) for name, stat in parse_stats(lines).items())
+
+
+def regex_pairs(lines):
+    return dict(re.split(r"\s+", line) for line in lines)
+
+
+def timed(function, inputs, repeat):
+    started_at = time.time()
+    for _ in range(repeat):
+        for lines in inputs:
+            function(lines)
+    return (time.time() - started_at) / (repeat * len(inputs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+
+    stats = fixture_stats()
+    pairs = [["%s_%s %s" % ("key", index, index * 7) for index in range(40)]]
+
+    for name, old, new, inputs in [
+        ("stats", regex_stats, parser_stats, stats),
+        ("stats (records only)", regex_stats, parse_stats, stats),
+        ("key value pairs", regex_pairs, parse_pairs, pairs),
+    ]:
+        old_time = timed(old, inputs, args.repeat)
+        new_time = timed(new, inputs, args.repeat)
+        print(
+            "%-22s regex %7.1fus  parser %7.1fus  %.1fx"
+            % (name, old_time * 1e6, new_time * 1e6, old_time / new_time)
+        )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
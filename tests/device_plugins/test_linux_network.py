@@ -1,8 +1,16 @@
 from collections import namedtuple
+import os
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
 import mock
+from chroma_agent.lib import netlink
+from chroma_agent.lib.shell import AgentShell
 from chroma_agent.device_plugins.linux_network import (
     LinuxNetworkDevicePlugin,
+    NetworkChangeListener,
     NetworkInterfaces,
 )
 
@@ -86,7 +94,11 @@ class TestLinuxNetwork(unittest.TestCase):
             with mock.patch(
                 "chroma_agent.lib.shell.AgentShell.try_run", self.mock_try_run
             ):
-                interfaces = NetworkInterfaces()
+                with mock.patch(
+                    "chroma_agent.lib.netlink.dump_addresses",
+                    side_effect=socket.error("netlink unavailable"),
+                ):
+                    interfaces = NetworkInterfaces()
 
         ResultCheck = namedtuple(
             "ResultCheck",
@@ -160,6 +172,9 @@ class TestLinuxNetwork(unittest.TestCase):
             self.assertEqual(interface["up"], result_check.up)
             self.assertEqual(interface["slave"], result_check.slave)
 
+        self.assertEqual(interfaces.name("10.0.0.101"), "eth4")
+        self.assertEqual(interfaces.name("fe80::200:ff:fe00:2"), "eth4")
+
         return interfaces
 
     def test_lnet_interface(self):
@@ -263,3 +278,433 @@ class TestLinuxNetwork(unittest.TestCase):
             self.assertEqual(nid["nid_address"], result_check.lnd_address)
             self.assertEqual(nid["lnd_network"], result_check.lnd_network)
             self.assertEqual(nid["lnd_type"], result_check.lnd_type)
+
+
+class TestNativeNetworkInterfaces(unittest.TestCase):
+    LINKS = {
+        "lo": (1, "0x9", 772, "00:00:00:00:00:00", 8305400, 8305401),
+        "bond0": (2, "0x1403", 1, "52:54:00:33:d9:15", 314203, 129834),
+        "eth1": (3, "0x1803", 1, "52:54:00:33:d9:15", 100, 200),
+        "eth2": (4, "0x1002", 1, "52:54:00:33:a7:11", 0, 0),
+        "ib0": (5, "0x1043", 32, "80:00:00:48:fe:80", 3286081, 4753096),
+    }
+
+    ADDRESSES = [
+        netlink.Address(1, socket.AF_INET, "127.0.0.1", 8, 0x80),
+        netlink.Address(2, socket.AF_INET, "192.168.10.79", 21, 0x80),
+        netlink.Address(2, socket.AF_INET, "192.168.10.80", 21, 0x81),
+        netlink.Address(2, socket.AF_INET6, "fe80::4e00:10ff:feac:61e0", 64, 0x80),
+        netlink.Address(5, socket.AF_INET, "192.168.4.23", 23, 0x80),
+    ]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+        for name, values in self.LINKS.items():
+            path = os.path.join(self.root, "sys/class/net", name)
+            os.makedirs(os.path.join(path, "statistics"))
+            for attribute, value in zip(
+                [
+                    "ifindex",
+                    "flags",
+                    "type",
+                    "address",
+                    "statistics/rx_bytes",
+                    "statistics/tx_bytes",
+                ],
+                values,
+            ):
+                with open(os.path.join(path, attribute), "w") as f:
+                    f.write("%s\n" % value)
+
+    def test_native(self):
+        """Test that interfaces are read from sysfs and netlink without running anything"""
+        with mock.patch(
+            "chroma_agent.lib.netlink.dump_addresses", return_value=self.ADDRESSES
+        ):
+            with mock.patch("chroma_agent.lib.shell.AgentShell.try_run") as try_run:
+                interfaces = NetworkInterfaces(root=self.root)
+
+        self.assertFalse(try_run.called)
+        self.assertEqual(sorted(interfaces), ["bond0", "eth2", "ib0"])
+        self.assertEqual(
+            interfaces["bond0"],
+            {
+                "mac_address": "52:54:00:33:d9:15",
+                "inet4_address": "192.168.10.79",
+                "inet4_prefix": 21,
+                "inet6_address": "fe80::4e00:10ff:feac:61e0",
+                "type": "tcp",
+                "rx_bytes": "314203",
+                "tx_bytes": "129834",
+                "up": True,
+                "slave": False,
+            },
+        )
+        self.assertEqual(interfaces["eth2"]["up"], False)
+        self.assertEqual(interfaces["eth2"]["inet4_address"], "")
+        self.assertEqual(interfaces["ib0"]["type"], "o2ib")
+        self.assertEqual(interfaces["ib0"]["inet4_prefix"], 23)
+
+    def test_names(self):
+        """Test that interfaces are named by any of their addresses"""
+        with mock.patch(
+            "chroma_agent.lib.netlink.dump_addresses", return_value=self.ADDRESSES
+        ):
+            interfaces = NetworkInterfaces(root=self.root)
+
+        self.assertEqual(interfaces.name("192.168.10.79"), "bond0")
+        self.assertEqual(interfaces.name("192.168.10.80"), "bond0")
+        self.assertEqual(interfaces.name("fe80::4e00:10ff:feac:61e0"), "bond0")
+        self.assertEqual(interfaces.name("192.168.4.23"), "ib0")
+        self.assertEqual(interfaces.name("0"), "lo")
+        self.assertRaises(
+            NetworkInterfaces.InterfaceNotFound, interfaces.name, "127.0.0.1"
+        )
+
+    def test_cache_results(self):
+        """Test that cached results name NIDs from the latest interfaces, reading them again
+        only for an address they do not have"""
+        with mock.patch(
+            "chroma_agent.lib.netlink.dump_addresses", return_value=self.ADDRESSES
+        ):
+            interfaces = NetworkInterfaces(root=self.root)
+
+        self.addCleanup(setattr, LinuxNetworkDevicePlugin, "interfaces", None)
+        self.addCleanup(setattr, LinuxNetworkDevicePlugin, "cached_results", {})
+        LinuxNetworkDevicePlugin.interfaces = interfaces
+
+        with mock.patch(
+            "chroma_agent.device_plugins.linux_network.NetworkInterfaces"
+        ) as network_interfaces:
+            network_interfaces.InterfaceNotFound = NetworkInterfaces.InterfaceNotFound
+            network_interfaces.return_value.name.return_value = "eth9"
+
+            LinuxNetworkDevicePlugin.cache_results(
+                lnet_configuration={"network_interfaces": [("192.168.10.80", "tcp", 0)]}
+            )
+            self.assertFalse(network_interfaces.called)
+            self.assertEqual(
+                LinuxNetworkDevicePlugin.cached_results,
+                {
+                    "bond0": {
+                        "nid_address": "192.168.10.80",
+                        "lnd_type": "tcp",
+                        "lnd_network": 0,
+                    }
+                },
+            )
+
+            LinuxNetworkDevicePlugin.cache_results(
+                lnet_configuration={"network_interfaces": [("10.0.0.9", "tcp", 1)]}
+            )
+            self.assertEqual(network_interfaces.call_count, 1)
+            self.assertEqual(list(LinuxNetworkDevicePlugin.cached_results), ["eth9"])
+
+
+class TestLinuxNetworkSession(unittest.TestCase):
+    def setUp(self):
+        self.interfaces = {
+            "eth0": {
+                "mac_address": "52:54:00:33:d9:15",
+                "inet4_address": "10.0.0.1",
+                "inet4_prefix": 24,
+                "inet6_address": "",
+                "type": "tcp",
+                "rx_bytes": "1000",
+                "tx_bytes": "2000",
+                "up": True,
+                "slave": False,
+            }
+        }
+        self.now = 1000.0
+
+        for target, kwargs in [
+            (
+                "chroma_agent.device_plugins.linux_network.NetworkInterfaces",
+                {"side_effect": lambda: self.interfaces},
+            ),
+            (
+                "chroma_agent.device_plugins.linux_network.monotonic",
+                {"side_effect": lambda: self.now},
+            ),
+            (
+                "chroma_agent.device_plugins.linux_network.counter_period",
+                {"return_value": 60},
+            ),
+            (
+                "chroma_agent.device_plugins.linux_network.LinuxNetworkDevicePlugin._lnet_probe",
+                {"return_value": ("lnet_up", {})},
+            ),
+            (
+                "chroma_agent.device_plugins.linux_network.change_listener_enabled",
+                {"return_value": False},
+            ),
+        ]:
+            patcher = mock.patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.plugin = LinuxNetworkDevicePlugin(mock.Mock(network_rates=True))
+
+    def set_counters(self, rx_bytes, tx_bytes):
+        self.interfaces["eth0"] = dict(
+            self.interfaces["eth0"], rx_bytes=str(rx_bytes), tx_bytes=str(tx_bytes)
+        )
+
+    def test_topology_and_counters(self):
+        """Test that the topology is sent when it changes and the counters as rates every period"""
+        result = self.plugin.start_session()
+        self.assertEqual(result["lnet"], {"state": "lnet_up", "nids": {}})
+        self.assertNotIn("rx_bytes", result["interfaces"]["eth0"])
+        self.assertEqual(result["counters"], None)
+
+        # Counters changing is not a change of topology, and their report is not yet due
+        self.now += 10
+        self.set_counters(1500, 2000)
+        self.assertEqual(self.plugin.update_session(), None)
+
+        self.now += 50
+        self.set_counters(7000, 2600)
+        self.assertEqual(
+            self.plugin.update_session(),
+            {
+                "interfaces": None,
+                "lnet": None,
+                "counters": {"eth0": {"rx_bytes": 100.0, "tx_bytes": 10.0}},
+            },
+        )
+
+        self.now += 10
+        self.interfaces["eth0"] = dict(self.interfaces["eth0"], up=False)
+        result = self.plugin.update_session()
+        self.assertEqual(result["interfaces"]["eth0"]["up"], False)
+        self.assertEqual(result["lnet"], None)
+        self.assertEqual(result["counters"], None)
+
+    def test_without_rates(self):
+        """Test that every field of each interface is sent in every update unless the manager takes rates"""
+        self.plugin._session.network_rates = False
+        result = self.plugin.start_session()
+        self.assertEqual(
+            result,
+            {"interfaces": self.interfaces, "lnet": {"state": "lnet_up", "nids": {}}},
+        )
+
+        self.now += 10
+        self.set_counters(1500, 2000)
+        self.assertEqual(
+            self.plugin.update_session()["interfaces"]["eth0"]["rx_bytes"], "1500"
+        )
+        self.assertEqual(
+            self.plugin.update_session()["lnet"], {"state": "lnet_up", "nids": {}}
+        )
+
+    def test_counters_reset(self):
+        """Test that an interface whose counters went backwards is left out of the rates"""
+        self.plugin.start_session()
+
+        self.now += 60
+        self.set_counters(10, 10)
+        self.assertEqual(self.plugin.update_session()["counters"], {})
+
+
+class TestNetworkChangeListener(unittest.TestCase):
+    def setUp(self):
+        # The kernel's end of the netlink socket
+        self.kernel, listener_socket = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM
+        )
+        self.addCleanup(self.kernel.close)
+
+        patcher = mock.patch(
+            "chroma_agent.lib.netlink.subscribe", return_value=listener_socket
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch(
+            "chroma_agent.device_plugins.linux_network.change_listener_enabled",
+            return_value=True,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def notify(self, message_type):
+        self.kernel.send(
+            netlink.NLMSGHDR.pack(netlink.NLMSGHDR.size, message_type, 0, 0, 0)
+        )
+
+    def test_listener(self):
+        """Test that link and address changes have the plugin polled at once, and less often otherwise"""
+        session = mock.Mock()
+        plugin = LinuxNetworkDevicePlugin(session)
+        self.addCleanup(plugin.teardown)
+
+        with mock.patch.object(LinuxNetworkDevicePlugin, "_scan") as scan:
+            scan.return_value = ({}, {"state": "lnet_up", "nids": {}})
+            with mock.patch(
+                "chroma_agent.device_plugins.linux_network.counter_period",
+                return_value=0,
+            ):
+                plugin.start_session()
+
+        self.assertEqual(
+            plugin.POLL_PERIOD, LinuxNetworkDevicePlugin.LISTENING_POLL_PERIOD
+        )
+
+        polled = threading.Event()
+        session.poll_now.side_effect = polled.set
+        self.notify(netlink.RTM_NEWADDR)
+        self.assertTrue(polled.wait(10))
+
+        plugin.teardown()
+        self.assertEqual(plugin._listener, None)
+
+    def test_changes_only(self):
+        """Test that only link and address changes are reported"""
+        plugin = mock.Mock()
+        listener = NetworkChangeListener(plugin)
+
+        self.assertFalse(
+            listener._changed(
+                netlink.NLMSGHDR.pack(
+                    netlink.NLMSGHDR.size, netlink.NLMSG_DONE, 0, 0, 0
+                )
+            )
+        )
+        self.assertTrue(
+            listener._changed(
+                netlink.NLMSGHDR.pack(
+                    netlink.NLMSGHDR.size, netlink.RTM_DELLINK, 0, 0, 0
+                )
+            )
+        )
+        listener._socket.close()
+
+    def test_failure(self):
+        """Test that the plugin goes back to polling often if the listener fails, until it starts another"""
+        plugin = LinuxNetworkDevicePlugin(mock.Mock())
+        self.addCleanup(plugin.teardown)
+        plugin.POLL_PERIOD = LinuxNetworkDevicePlugin.LISTENING_POLL_PERIOD
+        listener = plugin._listener = NetworkChangeListener(plugin)
+        listener._socket.close()
+
+        listener.run()
+
+        self.assertEqual(plugin.POLL_PERIOD, LinuxNetworkDevicePlugin.POLL_PERIOD)
+        self.assertEqual(plugin._listener, None)
+
+        listener_socket, kernel = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(kernel.close)
+        with mock.patch(
+            "chroma_agent.lib.netlink.subscribe", return_value=listener_socket
+        ), mock.patch(
+            "chroma_agent.device_plugins.linux_network.counter_period", return_value=0
+        ), mock.patch.object(
+            LinuxNetworkDevicePlugin, "_scan"
+        ) as scan:
+            scan.return_value = ({}, {"state": "lnet_up", "nids": {}})
+            plugin.update_session()
+
+        self.assertNotEqual(plugin._listener, None)
+        self.assertNotEqual(plugin._listener, listener)
+        self.assertEqual(
+            plugin.POLL_PERIOD, LinuxNetworkDevicePlugin.LISTENING_POLL_PERIOD
+        )
+
+
+class TestLNetProbe(unittest.TestCase):
+    NIS = "\n".join(
+        [
+            "nid                      status alive refs peer  rtr   max    tx   min",
+            "0@lo                         up     0    2    0    0     0     0     0",
+            "10.0.0.101@tcp1              up    -1    1    8    0   256   256   256",
+        ]
+    )
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(os.path.join(self.root, "sys/module"))
+
+        self.interfaces = mock.Mock()
+        self.interfaces.name.side_effect = lambda address: {
+            "0": "lo",
+            "10.0.0.101": "eth4",
+        }[address]
+
+        self.plugin = LinuxNetworkDevicePlugin(None)
+        self.addCleanup(setattr, LinuxNetworkDevicePlugin, "cached_results", {})
+
+        for target in [
+            "chroma_agent.lib.shell.AgentShell.run",
+            "chroma_agent.lib.shell.AgentShell.try_run",
+        ]:
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def load_lnet(self, nis=None):
+        os.makedirs(os.path.join(self.root, "sys/module/lnet"))
+        if nis is not None:
+            os.makedirs(os.path.join(self.root, "sys/kernel/debug/lnet"))
+            with open(os.path.join(self.root, "sys/kernel/debug/lnet/nis"), "w") as f:
+                f.write(nis + "\n")
+
+    def assertRanNothing(self):
+        self.assertFalse(AgentShell.run.called)
+        self.assertFalse(AgentShell.try_run.called)
+
+    def test_unloaded(self):
+        """Test that unloaded lnet is reported with the cached NIDs, without running anything"""
+        LinuxNetworkDevicePlugin.cached_results = {"eth4": {}}
+
+        self.assertEqual(
+            self.plugin._lnet_probe(self.interfaces, root=self.root),
+            ("lnet_unloaded", {"eth4": {}}),
+        )
+        self.assertRanNothing()
+
+    def test_up(self):
+        """Test that the state and NIDs come from one read of nis"""
+        self.load_lnet(self.NIS)
+
+        self.assertEqual(
+            self.plugin._lnet_probe(self.interfaces, root=self.root),
+            (
+                "lnet_up",
+                {
+                    "eth4": {
+                        "nid_address": "10.0.0.101",
+                        "lnd_type": "tcp",
+                        "lnd_network": "1",
+                    }
+                },
+            ),
+        )
+        self.assertRanNothing()
+
+    def test_down(self):
+        """Test that lnet with no NIs is down"""
+        self.load_lnet(self.NIS.split("\n")[0])
+
+        self.assertEqual(
+            self.plugin._lnet_probe(self.interfaces, root=self.root),
+            ("lnet_down", {}),
+        )
+        self.assertRanNothing()
+
+    def test_fallback(self):
+        """Test that lnetctl and lctl are run where nis cannot be read natively"""
+        self.load_lnet()
+        AgentShell.run.return_value = mock.Mock(rc=0)
+        AgentShell.try_run.return_value = self.NIS
+
+        state, nids = self.plugin._lnet_probe(self.interfaces, root=self.root)
+
+        self.assertEqual(state, "lnet_up")
+        self.assertEqual(list(nids), ["eth4"])
+        AgentShell.run.assert_called_once_with(["lnetctl", "net", "show"])
+        AgentShell.try_run.assert_called_once_with(["lctl", "get_param", "-n", "nis"])
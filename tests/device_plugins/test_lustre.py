@@ -1,9 +1,12 @@
 import os
+import json
 import mock
+import time
 
 from iml_common.test.command_capture_testcase import CommandCaptureTestCase
 from tests.lib.agent_unit_testcase import AgentUnitTestCase
 from chroma_agent.device_plugins.lustre import LustrePlugin
+from iml_common.lib.date_time import IMLDateTime
 
 
 class MockLocalAudit:
@@ -13,6 +16,9 @@ class MockLocalAudit:
     def properties(self):
         return {"properties": TestLustreAudit.values["properties"]}
 
+    def counters(self):
+        return {}
+
 
 class MockActionPluginManager:
     capabilities = 0
@@ -47,6 +53,10 @@ class TestLustreAudit(AgentUnitTestCase):
             "chroma_agent.device_plugins.audit.local.LocalAudit", MockLocalAudit
         ).start()
 
+        mock.patch(
+            "chroma_agent.device_plugins.lustre.sample_period", return_value=0
+        ).start()
+
         self.lustre_plugin = LustrePlugin(None)
 
     def test_audit_delta_match(self):
@@ -83,7 +93,7 @@ class TestLustreAudit(AgentUnitTestCase):
             # Time and version and packages are a special case.
             if key == "started_at":
                 self.assertGreater(result_match[key], result_all[key])
-            elif key not in ["agent_version", "packages"]:
+            elif key not in ["agent_version", "packages", "series"]:
                 self.assertNotEqual(result_all[key], result_match[key])
 
     def test_audit_failsafe(self):
@@ -98,3 +108,337 @@ class TestLustreAudit(AgentUnitTestCase):
                 self.assertGreater(result_none[key], result_all[key])
             else:
                 self.assertEqual(result_all[key], result_none[key])
+
+    def test_metrics_whole(self):
+        """Test that metrics are sent whole unless the session allows tree deltas"""
+        TestLustreAudit.values["metrics"] = {"raw": {"a": 1}}
+        self.lustre_plugin._session = mock.Mock(tree_deltas=False)
+
+        self.assertEqual(
+            self.lustre_plugin.start_session()["metrics"],
+            {"metrics": {"raw": {"a": 1}}},
+        )
+        self.assertEqual(
+            self.lustre_plugin.update_session()["metrics"],
+            {"metrics": {"raw": {"a": 1}}},
+        )
+
+        # The manager holds the last result now, so later results are sent as deltas against it
+        self.lustre_plugin._session.tree_deltas = True
+        TestLustreAudit.values["metrics"] = {"raw": {"a": 2}}
+        self.assertEqual(
+            self.lustre_plugin.update_session()["metrics"],
+            {"delta": {"changed": {"metrics": {"raw": {"a": 2}}}, "removed": []}},
+        )
+
+    def test_metrics_delta(self):
+        """Test that metrics are sent as a delta of what has changed, and whole every FAILSAFEDUPDATE"""
+        self.lustre_plugin._session = mock.Mock(tree_deltas=True)
+        TestLustreAudit.values["metrics"] = {"raw": {"a": 1, "b": {"c": 1, "d": 1}}}
+        self.assertEqual(
+            self.lustre_plugin.start_session()["metrics"],
+            {"metrics": {"raw": {"a": 1, "b": {"c": 1, "d": 1}}}},
+        )
+
+        TestLustreAudit.values["metrics"] = {"raw": {"a": 1, "b": {"c": 2}}}
+        self.assertEqual(
+            self.lustre_plugin.update_session()["metrics"],
+            {
+                "delta": {
+                    "changed": {"metrics": {"raw": {"b": {"c": 2}}}},
+                    "removed": [["metrics", "raw", "b", "d"]],
+                }
+            },
+        )
+        self.assertEqual(self.lustre_plugin.update_session()["metrics"], None)
+
+        for x in range(0, LustrePlugin.FAILSAFEDUPDATE - 3):
+            self.lustre_plugin.update_session()
+        self.assertEqual(
+            self.lustre_plugin.update_session()["metrics"],
+            {"metrics": {"raw": {"a": 1, "b": {"c": 2}}}},
+        )
+
+
+class TestLustreSeries(AgentUnitTestCase):
+    def setUp(self):
+        super(TestLustreSeries, self).setUp()
+
+        self.now = 1000.0
+        self.value = 0
+        mock.patch(
+            "chroma_agent.device_plugins.lustre.time"
+        ).start().time.side_effect = lambda: self.now
+        mock.patch(
+            "chroma_agent.plugin_manager.ActionPluginManager", MockActionPluginManager
+        ).start()
+
+        audit = mock.Mock()
+        audit.metrics.return_value = {"raw": {}}
+        audit.properties.return_value = {}
+        audit.counters.side_effect = lambda: {"ost/stats/read_bytes/sum": self.value}
+        mock.patch(
+            "chroma_agent.device_plugins.audit.local.LocalAudit", return_value=audit
+        ).start()
+
+        self.lustre_plugin = LustrePlugin(None)
+
+    def test_series(self):
+        """Test that each scan reports rates from the samples taken since the previous one"""
+        with mock.patch(
+            "chroma_agent.device_plugins.lustre.sample_period", return_value=0
+        ):
+            self.assertEqual(self.lustre_plugin.start_session()["series"], {})
+
+        for increase in [10, 30, 20]:
+            self.now += 1
+            self.value += increase
+            self.lustre_plugin.sample()
+
+        self.now += 1
+        series = self.lustre_plugin.update_session()["series"]
+        self.assertEqual(
+            series["ost/stats/read_bytes/sum"],
+            {
+                "rate": 15.0,
+                "min": 0.0,
+                "max": 30.0,
+                "p50": 20.0,
+                "p90": 30.0,
+                "p99": 30.0,
+                "samples": 5,
+            },
+        )
+
+        # The next scan starts from the last sample of this one
+        self.now += 2
+        self.value += 10
+        series = self.lustre_plugin.update_session()["series"]
+        self.assertEqual(series["ost/stats/read_bytes/sum"]["rate"], 5.0)
+        self.assertEqual(series["ost/stats/read_bytes/sum"]["samples"], 2)
+
+    def test_series_delta(self):
+        """Test that series are sent as a delta of what has changed when the session allows it"""
+        with mock.patch(
+            "chroma_agent.device_plugins.lustre.sample_period", return_value=0
+        ):
+            self.lustre_plugin.start_session()
+        self.lustre_plugin._session = mock.Mock(tree_deltas=True)
+
+        self.now += 1
+        self.value += 10
+        self.lustre_plugin.update_session()
+
+        self.now += 1
+        self.value += 20
+        self.assertEqual(
+            self.lustre_plugin.update_session()["series"],
+            {
+                "delta": {
+                    "changed": {
+                        "ost/stats/read_bytes/sum": {
+                            "rate": 20.0,
+                            "min": 20.0,
+                            "max": 20.0,
+                            "p50": 20.0,
+                            "p90": 20.0,
+                            "p99": 20.0,
+                        }
+                    },
+                    "removed": [],
+                }
+            },
+        )
+
+    def test_coalesced_series(self):
+        """Test that a scan replaced before it is sent has its series window kept"""
+        with mock.patch(
+            "chroma_agent.device_plugins.lustre.sample_period", return_value=0
+        ):
+            self.lustre_plugin.start_session()
+
+        # The second and third scans replace the first before it is sent
+        merged = None
+        for increase in [10, 30, 20]:
+            self.now += 1
+            self.value += increase
+            result = self.lustre_plugin.update_session()
+            merged = (
+                result
+                if merged is None
+                else self.lustre_plugin.merge_updates(merged, result)
+            )
+
+        self.assertEqual(
+            merged["series"]["ost/stats/read_bytes/sum"],
+            {
+                "rate": 20.0,
+                "min": 10.0,
+                "max": 30.0,
+                "p50": 20.0,
+                "p90": 30.0,
+                "p99": 30.0,
+                "samples": 4,
+            },
+        )
+        self.assertEqual(self.lustre_plugin.last_result["series"], merged["series"])
+
+        # The next scan's window starts after the merged one
+        self.now += 1
+        self.value += 40
+        series = self.lustre_plugin.update_session()["series"]
+        self.assertEqual(series["ost/stats/read_bytes/sum"]["rate"], 40.0)
+        self.assertEqual(series["ost/stats/read_bytes/sum"]["samples"], 2)
+
+    def test_sampler(self):
+        """Test that a sampler thread runs between scans when configured, and stops at teardown"""
+        with mock.patch(
+            "chroma_agent.device_plugins.lustre.sample_period", return_value=0.01
+        ):
+            self.lustre_plugin.start_session()
+
+        try:
+            for _ in range(1000):
+                if self.lustre_plugin._series.summary():
+                    break
+                self.value += 1
+                self.now += 1
+                time.sleep(0.01)
+            else:
+                self.fail("No samples taken")
+        finally:
+            self.lustre_plugin.teardown()
+
+        self.assertEqual(self.lustre_plugin._sampler, None)
+
+
+class TestLustreCoalescing(AgentUnitTestCase):
+    def setUp(self):
+        super(TestLustreCoalescing, self).setUp()
+
+        self.addCleanup(mock.patch.stopall)
+        mock.patch(
+            "chroma_agent.plugin_manager.ActionPluginManager", MockActionPluginManager
+        ).start()
+        mock.patch(
+            "chroma_agent.device_plugins.lustre.sample_period", return_value=0
+        ).start()
+
+        self.audit = mock.Mock()
+        self.audit.properties.return_value = {}
+        self.audit.counters.return_value = {}
+        mock.patch(
+            "chroma_agent.device_plugins.audit.local.LocalAudit",
+            return_value=self.audit,
+        ).start()
+
+        self.lustre_plugin = LustrePlugin(None)
+
+    def scan_metrics(self, jobs, histogram, clients):
+        return {
+            "raw": {
+                "lustre": {
+                    "target": {
+                        "testfs-OST0000": {
+                            "stats": {},
+                            "job_stats": jobs,
+                            "brw_stats": {"disk_iosize": histogram},
+                        }
+                    },
+                    "clients": {"obdfilter": clients},
+                }
+            }
+        }
+
+    def test_coalesced_counts(self):
+        """Test that the counts since the previous scan of a scan replaced before it is sent are kept"""
+        from chroma_agent.agent_client import HttpWriter, Message
+        from chroma_agent.plugin_manager import DevicePluginMessage
+
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = client.start_time = IMLDateTime.utcnow()
+        writer = HttpWriter(client)
+
+        scans = [
+            self.scan_metrics(
+                [{"job_id": "dd.0", "snapshot_time": 1, "read": {"samples": 2}}],
+                {"units": "ios", "buckets": ["8K"], "read": [3], "write": [0]},
+                [
+                    {
+                        "nid": "0@lo",
+                        "targets": ["testfs-OST0000"],
+                        "ops": 5,
+                        "read_bytes": 10,
+                        "write_bytes": 0,
+                    }
+                ],
+            ),
+            self.scan_metrics(
+                [
+                    {"job_id": "dd.0", "snapshot_time": 2, "read": {"samples": 1}},
+                    {"job_id": "cp.0", "snapshot_time": 2, "read": {"samples": 4}},
+                ],
+                {
+                    "units": "ios",
+                    "buckets": ["4K", "8K"],
+                    "read": [1, 1],
+                    "write": [0, 0],
+                },
+                [],
+            ),
+        ]
+        self.audit.metrics.side_effect = scans
+
+        for seq, result in enumerate(
+            [self.lustre_plugin.start_session(), self.lustre_plugin.update_session()]
+        ):
+            writer.put(
+                Message(
+                    "DATA",
+                    "lustre",
+                    DevicePluginMessage(
+                        result, snapshot=True, merge=self.lustre_plugin.merge_updates
+                    ),
+                    "id_foo",
+                    seq,
+                )
+            )
+
+        writer.send()
+        body, _ = client.post_encoded.call_args[0]
+        messages = json.loads(body)["messages"]
+        self.assertEqual([m["session_seq"] for m in messages], [1])
+
+        merged = self.scan_metrics(
+            [
+                {"job_id": "dd.0", "snapshot_time": 2, "read": {"samples": 3}},
+                {"job_id": "cp.0", "snapshot_time": 2, "read": {"samples": 4}},
+            ],
+            {"units": "ios", "buckets": ["4K", "8K"], "read": [1, 4], "write": [0, 0]},
+            [
+                {
+                    "nid": "0@lo",
+                    "targets": ["testfs-OST0000"],
+                    "ops": 5,
+                    "read_bytes": 10,
+                    "write_bytes": 0,
+                }
+            ],
+        )
+        self.assertEqual(messages[0]["body"]["metrics"], merged)
+        # Later tree deltas are against what the manager now holds
+        self.assertEqual(self.lustre_plugin.last_result["metrics"], merged)
+        # The scans themselves are left as they were
+        self.assertEqual(scans[1]["raw"]["lustre"]["clients"]["obdfilter"], [])
+
+    def test_delta_not_coalesced(self):
+        """Test that a scan sent as a tree delta is not replaced, as its counts could not be kept"""
+        delta = {"delta": {"changed": {}, "removed": []}}
+
+        self.assertEqual(
+            self.lustre_plugin.merge_updates(
+                {"metrics": delta}, {"metrics": self.scan_metrics([], {}, [])}
+            ),
+            None,
+        )
@@ -0,0 +1,51 @@
+"""
+Synthetic audit results, and the recursive merge that LocalAudit used before it merged them in place,
+for checking and measuring LocalAudit.metrics().
+"""
+
+STATS = ["read_bytes", "write_bytes", "open", "close", "getattr", "setattr", "statfs"]
+
+
+def mergedicts(*dicts):
+    """The recursive merge LocalAudit used before, which rebuilds the tree on each merge"""
+    keys = set(k for d in dicts for k in d)
+
+    def vals(key):
+        return [d[key] for d in dicts if key in d]
+
+    def recurse(*values):
+        if isinstance(values[0], dict):
+            return mergedicts(*values)
+        if len(values) == 1:
+            return values[0]
+        raise TypeError("Multiple non-dictionary values for a key.")
+
+    return dict((key, recurse(*vals(key))) for key in keys)
+
+
+def synthetic_results(targets, audits):
+    """Raw metrics of each of audits, between them covering targets"""
+    results = []
+    for audit in range(audits):
+        target_stats = {}
+        for target in range(audit, targets, audits):
+            target_stats["testfs-OST%04x" % target] = {
+                "stats": dict(
+                    (stat, {"count": target, "units": "reqs", "sum": target * 4096})
+                    for stat in STATS
+                ),
+                "filestotal": target,
+                "kbytesfree": target * 1024,
+            }
+        results.append(
+            {"raw": {"lustre": {"target": target_stats}, "audit_%s" % audit: audit}}
+        )
+    return results
+
+
+def rebuild(results):
+    """Merge results with mergedicts(), as LocalAudit.metrics() did"""
+    merged = {}
+    for result in results:
+        merged = mergedicts(merged, result["raw"])
+    return merged
@@ -0,0 +1,291 @@
+"""
+An in-process stand-in for the manager's agent/message/ endpoint, so that AgentClient, HttpReader and
+HttpWriter can be exercised end to end over loopback HTTP without a real manager.
+
+The real manager identifies an agent by its client certificate. Here the agent's FQDN is passed
+in the query string of the URL the agent is given (see FakeManager.url).
+"""
+
+import json
+import time
+import socket
+import zlib
+import threading
+import urlparse
+from collections import defaultdict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+class _AgentState(object):
+    """What the fake manager knows about one agent"""
+
+    def __init__(self):
+        # Map of plugin name to session id
+        self.sessions = {}
+        # Map of session id to the highest session_seq received
+        self.received_seq = {}
+        # Messages waiting to be returned by the agent's next GET
+        self.outbox = []
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.manager._connection_opened(self.connection)
+
+    def finish(self):
+        self.server.manager._connection_closed(self.connection)
+        BaseHTTPRequestHandler.finish(self)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _fqdn(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        return query.get("fqdn", ["unknown"])[0]
+
+    def _reply(self, status, body=None, headers=None):
+        data = json.dumps(body) if body is not None else ""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._reply(*self.server.manager.handle_get(self._fqdn()))
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        if self.headers.getheader("Content-Encoding") == "gzip":
+            if not self.server.manager.gzip:
+                self._reply(415)
+                return
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+        self._reply(*self.server.manager.handle_post(self._fqdn(), json.loads(data)))
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def process_request(self, request, client_address):
+        # As ThreadingMixIn does, keeping the thread so that stop() can wait for it
+        thread = threading.Thread(
+            target=self.process_request_thread, args=(request, client_address)
+        )
+        thread.daemon = self.daemon_threads
+        self.manager._handler_started(thread)
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # Connections are cut off when the manager stops, which their handlers may fail on
+        if not self.manager.stopping:
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class FakeManager(object):
+    """
+    Creates sessions on request, accepts DATA for them and counts what it receives.
+
+    :param acks: Include acknowledgements in responses, see SessionTable.acknowledge
+    :param long_poll: Seconds a GET waits for something to return before returning nothing
+    :param gzip: Accept gzip compressed POST bodies, and say so in responses
+    :param tree_deltas: Say in responses that tree deltas are applied (they are only counted here)
+    :param network_rates: Say in responses that network counter rates are taken
+    """
+
+    def __init__(
+        self, acks=True, long_poll=1.0, gzip=True, tree_deltas=True, network_rates=True
+    ):
+        self.acks = acks
+        self.gzip = gzip
+        self.tree_deltas = tree_deltas
+        self.network_rates = network_rates
+        self.long_poll = long_poll
+
+        self._lock = threading.Condition()
+        self._agents = defaultdict(_AgentState)
+        self._session_counter = 0
+        # Number of upcoming requests to fail, and the Retry-After to fail them with
+        self._failures = 0
+        self._failure_retry_after = None
+
+        self.stats = defaultdict(int)
+        # Seconds between a DATA message being generated (its body's "generated_at") and its receipt
+        self.latencies = []
+
+        self._server = None
+        self._thread = None
+        # Open keep-alive connections, each with a handler thread waiting on it
+        self._connections = set()
+        self._handlers = []
+        self.stopping = False
+
+    def start(self):
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        self._server.manager = self
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="FakeManager"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+        # Release any GETs still waiting, and close idle connections so their handler threads exit
+        with self._lock:
+            self._lock.notify_all()
+            for connection in self._connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            handlers, self._handlers = self._handlers, []
+
+        for thread in handlers:
+            thread.join()
+
+    def _handler_started(self, thread):
+        with self._lock:
+            self._handlers = [
+                handler for handler in self._handlers if handler.is_alive()
+            ]
+            self._handlers.append(thread)
+
+    def _connection_opened(self, connection):
+        with self._lock:
+            self._connections.add(connection)
+
+    def _connection_closed(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+
+    def url(self, fqdn):
+        return "http://127.0.0.1:%d/agent/message/?fqdn=%s" % (
+            self._server.server_address[1],
+            fqdn,
+        )
+
+    def fail_requests(self, count, retry_after=None):
+        """Answer the next count requests with 503 Service Unavailable"""
+        with self._lock:
+            self._failures = count
+            self._failure_retry_after = retry_after
+
+    def session_count(self):
+        with self._lock:
+            return sum(len(agent.sessions) for agent in self._agents.values())
+
+    def _failure(self):
+        """Must be called with _lock held, returns a reply if this request is to fail"""
+        if self._failures:
+            self._failures -= 1
+            self.stats["failed_requests"] += 1
+            headers = {}
+            if self._failure_retry_after is not None:
+                headers["Retry-After"] = str(self._failure_retry_after)
+            return 503, None, headers
+
+        return None
+
+    def _acks(self, agent):
+        if not self.acks:
+            return None
+
+        return [
+            {"plugin": plugin_name, "session_id": session_id, "session_seq": seq}
+            for plugin_name, session_id in agent.sessions.items()
+            for seq in [agent.received_seq.get(session_id)]
+            if seq is not None
+        ]
+
+    def _envelope(self, agent, body):
+        acks = self._acks(agent)
+        if acks is not None:
+            body["acks"] = acks
+        if self.gzip:
+            body["content_encodings"] = ["gzip"]
+        if self.tree_deltas:
+            body["tree_deltas"] = True
+        if self.network_rates:
+            body["network_rates"] = True
+        return body
+
+    def handle_get(self, fqdn):
+        with self._lock:
+            failure = self._failure()
+            if failure:
+                return failure
+
+            agent = self._agents[fqdn]
+            self.stats["gets"] += 1
+
+            deadline = time.time() + self.long_poll
+            while not agent.outbox and time.time() < deadline:
+                self._lock.wait(deadline - time.time())
+
+            messages, agent.outbox = agent.outbox, []
+            return 200, self._envelope(agent, {"messages": messages})
+
+    def handle_post(self, fqdn, envelope):
+        now = time.time()
+
+        with self._lock:
+            failure = self._failure()
+            if failure:
+                return failure
+
+            agent = self._agents[fqdn]
+            self.stats["posts"] += 1
+
+            for message in envelope["messages"]:
+                self.stats[message["type"]] += 1
+                handler = getattr(self, "_on_%s" % message["type"].lower(), None)
+                if handler is not None:
+                    handler(agent, message, now)
+
+            self._lock.notify_all()
+            return 200, self._envelope(agent, {})
+
+    def _on_session_create_request(self, agent, message, now):
+        self._session_counter += 1
+        session_id = "%s" % self._session_counter
+        agent.sessions[message["plugin"]] = session_id
+        agent.outbox.append(
+            {
+                "type": "SESSION_CREATE_RESPONSE",
+                "plugin": message["plugin"],
+                "session_id": session_id,
+                "session_seq": None,
+                "body": None,
+            }
+        )
+
+    def _on_data(self, agent, message, now):
+        session_id = message["session_id"]
+        if agent.sessions.get(message["plugin"]) != session_id:
+            self.stats["unknown_session"] += 1
+            return
+
+        previous = agent.received_seq.get(session_id, -1)
+        if message["session_seq"] <= previous:
+            self.stats["duplicates"] += 1
+            return
+
+        agent.received_seq[session_id] = message["session_seq"]
+        self.stats["delivered"] += 1
+
+        body = message["body"]
+        if isinstance(body, dict) and "generated_at" in body:
+            self.latencies.append(now - body["generated_at"])
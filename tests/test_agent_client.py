@@ -6,16 +6,24 @@ import mock
 
 import unittest
 
+import requests
+import zlib
+
 from chroma_agent.agent_client import (
+    CryptoClient,
+    PostBody,
     HttpWriter,
     Message,
     HttpReader,
     SessionTable,
     HttpError,
+    SESSION_REQUEST_POLL_PERIOD,
 )
+from chroma_agent.lib.backoff import phase_offset
 from chroma_agent.log import daemon_log
 from chroma_agent.plugin_manager import (
     PRIO_LOW,
+    DevicePlugin,
     DevicePluginMessage,
     PRIO_NORMAL,
     PRIO_HIGH,
@@ -23,6 +31,153 @@ from chroma_agent.plugin_manager import (
 from iml_common.lib.date_time import IMLDateTime
 
 
+def posted_envelope(client):
+    """Decode the envelope of the most recent HttpWriter POST to client"""
+    body, content_encoding = client.post_encoded.call_args[0]
+    if content_encoding == "gzip":
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    return json.loads(body)
+
+
+class TestCryptoClient(unittest.TestCase):
+    def setUp(self):
+        super(TestCryptoClient, self).setUp()
+
+        self.addCleanup(mock.patch.stopall)
+        self.mock_session_class = mock.patch(
+            "chroma_agent.agent_client.requests.Session"
+        ).start()
+        self.mock_session_class.side_effect = lambda: mock.Mock(adapters={})
+
+        crypto = mock.Mock()
+        crypto.certificate_file = None
+        self.client = CryptoClient("https://manager/", crypto, fqdn="test_server")
+
+    def test_session_reused(self):
+        """Test that consecutive requests share a single pooled session"""
+        self.client.get()
+        self.client.post({"foo": "bar"})
+
+        self.assertEqual(self.mock_session_class.call_count, 1)
+        self.assertEqual(self.client._http_session.request.call_count, 2)
+
+    def test_reconnect_after_failure(self):
+        """Test that a connection failure discards the pool so the next request reconnects"""
+        self.client.get()
+        failed_session = self.client._http_session
+        failed_session.request.side_effect = requests.exceptions.ConnectionError()
+
+        with self.assertRaises(HttpError):
+            self.client.get()
+
+        failed_session.close.assert_called_once_with()
+        self.client.get()
+        self.assertEqual(self.mock_session_class.call_count, 2)
+        self.assertEqual(self.client.connection_stats["resets"], 1)
+
+    def test_idle_session_closed(self):
+        """Test that a pool left unused for longer than HTTP_IDLE_TIMEOUT is closed before reuse"""
+        with mock.patch("chroma_agent.agent_client.time.time", return_value=0):
+            self.client.get()
+        idle_session = self.client._http_session
+
+        with mock.patch("chroma_agent.agent_client.time.time", return_value=10000):
+            self.client.get()
+
+        idle_session.close.assert_called_once_with()
+        self.assertEqual(self.mock_session_class.call_count, 2)
+
+    def test_connection_stats(self):
+        """Test that handshake and reuse counts are taken from the connection pools"""
+        self.client.get()
+        pool = mock.Mock(num_connections=2, num_requests=7)
+        adapter = mock.Mock()
+        adapter.poolmanager.pools = {"manager": pool}
+        self.client._http_session.adapters = {"https://": adapter, "http://": adapter}
+
+        self.assertEqual(
+            self.client.connection_stats,
+            {"handshakes": 2, "requests": 7, "reused": 5, "resets": 0},
+        )
+
+    def test_post_encoded_content_encoding(self):
+        """Test that a compressed body is sent with a Content-Encoding header"""
+        self.client.post_encoded("compressed", "gzip")
+
+        headers = self.client._http_session.request.call_args[1]["headers"]
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(headers["Content-Type"], "application/json")
+
+
+class TestPostBody(unittest.TestCase):
+    ENVELOPE = {"server_boot_time": "boot", "client_start_time": "start"}
+
+    def _decode(self, body, content_encoding):
+        if content_encoding == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return json.loads(body)
+
+    def test_small_body_uncompressed(self):
+        """Test that bodies below the compression threshold are sent as plain JSON"""
+        body = PostBody(self.ENVELOPE, limit=1024, threshold=512)
+        self.assertTrue(body.add(json.dumps({"foo": "bar"})))
+
+        data, content_encoding = body.finish()
+
+        self.assertEqual(content_encoding, None)
+        self.assertEqual(
+            json.loads(data), dict(self.ENVELOPE, messages=[{"foo": "bar"}])
+        )
+
+    def test_large_body_compressed(self):
+        """Test that bodies past the compression threshold are gzipped, and decode to the same envelope"""
+        messages = [{"index": i, "payload": "x" * 100} for i in range(100)]
+
+        body = PostBody(self.ENVELOPE, limit=4096, threshold=512)
+        for message in messages:
+            self.assertTrue(body.add(json.dumps(message)))
+        data, content_encoding = body.finish()
+
+        self.assertEqual(content_encoding, "gzip")
+        self.assertLessEqual(len(data), 4096)
+        self.assertEqual(
+            self._decode(data, content_encoding),
+            dict(self.ENVELOPE, messages=messages),
+        )
+
+    def test_limit_applies_to_compressed_bytes(self):
+        """Test that messages are refused once the compressed body reaches the limit"""
+        import random
+
+        random.seed(0)
+        messages = [
+            {"payload": "".join(random.choice("0123456789abcdef") for _ in range(512))}
+            for _ in range(100)
+        ]
+
+        body = PostBody(self.ENVELOPE, limit=4096, threshold=512)
+        accepted = [message for message in messages if body.add(json.dumps(message))]
+        data, content_encoding = body.finish()
+
+        # Hex digits compress to around half their size, so more than a raw 4096 bytes' worth fit
+        self.assertGreater(len(accepted) * 512, 4096)
+        self.assertLess(len(accepted), len(messages))
+        self.assertLessEqual(len(data), 4096)
+        self.assertEqual(self._decode(data, content_encoding)["messages"], accepted)
+
+    def test_compression_disabled(self):
+        """Test that a body is never compressed if compression is not allowed"""
+        messages = [{"index": i, "payload": "x" * 100} for i in range(20)]
+
+        body = PostBody(self.ENVELOPE, threshold=512, compress=False)
+        for message in messages:
+            self.assertTrue(body.add(json.dumps(message)))
+        data, content_encoding = body.finish()
+
+        self.assertEqual(content_encoding, None)
+        self.assertEqual(json.loads(data), dict(self.ENVELOPE, messages=messages))
+
+
 class TestHttpWriter(unittest.TestCase):
     def test_message_callback(self):
         """Test that when a callback is included in a Message(), it is invoked
@@ -56,7 +211,7 @@ class TestHttpWriter(unittest.TestCase):
                 TIMEOUT = 2
                 i = 0
                 while True:
-                    if client.post.call_count and callback.call_count:
+                    if client.post_encoded.call_count and callback.call_count:
                         break
                     else:
                         time.sleep(1)
@@ -64,13 +219,13 @@ class TestHttpWriter(unittest.TestCase):
                         if i > TIMEOUT:
                             raise RuntimeError(
                                 "Timeout waiting for .post() and callback (%s %s)"
-                                % (client.post.call_count, callback.call_count)
+                                % (client.post_encoded.call_count, callback.call_count)
                             )
 
                 # Should have sent back the result
-                self.assertEqual(client.post.call_count, 1)
+                self.assertEqual(client.post_encoded.call_count, 1)
                 self.assertDictEqual(
-                    client.post.call_args[0][0],
+                    posted_envelope(client),
                     {
                         "messages": [message.dump(client._fqdn)],
                         "server_boot_time": client.boot_time.isoformat() + "Z",
@@ -112,8 +267,8 @@ class TestHttpWriter(unittest.TestCase):
 
         inject_messages()
         writer.send()
-        self.assertEqual(client.post.call_count, 1)
-        messages = client.post.call_args[0][0]["messages"]
+        self.assertEqual(client.post_encoded.call_count, 1)
+        messages = posted_envelope(client)["messages"]
 
         self.assertEqual(len(messages), 4)
         # First two messages (of equal priority) arrive in order or insertion
@@ -123,9 +278,232 @@ class TestHttpWriter(unittest.TestCase):
         self.assertEqual(messages[2]["plugin"], "plugin_bar")
         self.assertEqual(messages[3]["plugin"], "plugin_foo")
 
+    def test_message_serialized_once(self):
+        """Test that a message is serialized once when enqueued, even if it overflows a POST and is requeued"""
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+
+        writer = HttpWriter(client)
+        real_dump = Message.dump
+
+        with mock.patch.object(
+            Message, "dump", autospec=True, side_effect=real_dump
+        ) as mock_dump:
+            with mock.patch("chroma_agent.agent_client.MAX_BYTES_PER_POST", 1024):
+                for seq in range(2):
+                    body = DevicePluginMessage("x" * 800, PRIO_NORMAL)
+                    writer.put(Message("DATA", "test_plugin", body, "foo", seq))
+                self.assertEqual(mock_dump.call_count, 2)
+
+                # The second message overflows the first POST and goes out in the next one
+                writer.send()
+                writer.send()
+
+        self.assertEqual(mock_dump.call_count, 2)
+        self.assertEqual(client.post_encoded.call_count, 2)
+        self.assertEqual(posted_envelope(client)["messages"][0]["session_seq"], 1)
+
+    def test_snapshot_coalescing(self):
+        """Test that an undelivered snapshot is replaced by a newer one, and that nothing else is coalesced"""
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+
+        writer = HttpWriter(client)
+
+        writer.put(
+            Message(
+                "DATA",
+                "test_plugin",
+                DevicePluginMessage({"a": 1, "b": 1}, snapshot=True),
+                "foo",
+                0,
+            )
+        )
+        writer.put(
+            Message("DATA", "test_plugin", DevicePluginMessage("done"), "foo", 1)
+        )
+        writer.put(
+            Message(
+                "DATA",
+                "test_plugin",
+                DevicePluginMessage({"a": 2, "b": None}, snapshot=True),
+                "foo",
+                2,
+            )
+        )
+        writer.put(Message("SESSION_CREATE_REQUEST", "test_plugin"))
+        writer.put(Message("SESSION_CREATE_REQUEST", "test_plugin"))
+
+        writer.send()
+
+        messages = posted_envelope(client)["messages"]
+        self.assertEqual(
+            sorted((m["type"], m["session_seq"]) for m in messages),
+            [
+                ("DATA", 1),
+                ("DATA", 2),
+                ("SESSION_CREATE_REQUEST", None),
+                ("SESSION_CREATE_REQUEST", None),
+            ],
+        )
+        # A field left as None by the newer snapshot keeps its value from the older one
+        self.assertIn({"a": 2, "b": 1}, [m["body"] for m in messages])
+
+        # Once sent a snapshot is no longer replaced, the next one is sent on its own
+        writer.put(
+            Message(
+                "DATA",
+                "test_plugin",
+                DevicePluginMessage({"a": 3}, snapshot=True),
+                "foo",
+                3,
+            )
+        )
+        writer.send()
+        self.assertEqual(
+            [m["body"] for m in posted_envelope(client)["messages"]], [{"a": 3}]
+        )
+
+    def test_snapshot_delta_coalescing(self):
+        """Test that tree deltas in coalesced snapshots are composed rather than replaced"""
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+
+        writer = HttpWriter(client)
+
+        for seq, metrics in enumerate(
+            [
+                {"delta": {"changed": {"a": 2, "b": {"c": 1}}, "removed": []}},
+                None,
+                {"delta": {"changed": {"d": 1}, "removed": [["b"]]}},
+            ]
+        ):
+            writer.put(
+                Message(
+                    "DATA",
+                    "test_plugin",
+                    DevicePluginMessage({"metrics": metrics}, snapshot=True),
+                    "foo",
+                    seq,
+                )
+            )
+
+        writer.send()
+
+        self.assertEqual(
+            [m["body"] for m in posted_envelope(client)["messages"]],
+            [{"metrics": {"delta": {"changed": {"a": 2, "d": 1}, "removed": [["b"]]}}}],
+        )
+
+    def test_message_order(self):
+        """Test that messages of equal priority are sent in the order they were put, after higher priorities"""
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+
+        writer = HttpWriter(client)
+
+        for seq in range(20):
+            writer.put(
+                Message("DATA", "test_plugin", DevicePluginMessage(seq), "foo", seq)
+            )
+        writer.put(
+            Message(
+                "DATA",
+                "test_plugin",
+                DevicePluginMessage("urgent", PRIO_HIGH),
+                "foo",
+                20,
+            )
+        )
+
+        writer.send()
+
+        self.assertEqual(
+            [m["session_seq"] for m in posted_envelope(client)["messages"]],
+            [20] + range(20),
+        )
+        self.assertEqual(writer.queue_stats[PRIO_NORMAL]["dequeued"], 20)
+
+    def test_poll_plugin_period(self):
+        """Test that plugins are polled frequently until they have a session, then at their own POLL_PERIOD"""
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.sessions = SessionTable(client)
+
+        mock_plugin_instance = mock.Mock()
+        mock_plugin_instance.POLL_PERIOD = 30
+        client.device_plugins.get = mock.Mock(
+            return_value=lambda _: mock_plugin_instance
+        )
+
+        writer = HttpWriter(client)
+
+        with mock.patch("chroma_agent.agent_client.HttpWriter.poll"):
+            self.assertEqual(
+                writer._poll_plugin("test_plugin"), SESSION_REQUEST_POLL_PERIOD
+            )
+            client.sessions.create("test_plugin", "id_foo")
+            # Polls are at a point in the period fixed by the hostname, and never closer together than half a period
+            with mock.patch(
+                "chroma_agent.lib.backoff.time.time",
+                return_value=phase_offset("test_server/test_plugin", 30) + 3000,
+            ):
+                self.assertEqual(writer._poll_plugin("test_plugin"), 30)
+            with mock.patch(
+                "chroma_agent.lib.backoff.time.time",
+                return_value=phase_offset("test_server/test_plugin", 30) + 3010,
+            ):
+                self.assertEqual(writer._poll_plugin("test_plugin"), 20)
+            with mock.patch(
+                "chroma_agent.lib.backoff.time.time",
+                return_value=phase_offset("test_server/test_plugin", 30) + 3029,
+            ):
+                self.assertEqual(writer._poll_plugin("test_plugin"), 31)
+            # A slow poll is followed by the next point in the period, not one a period later
+            with mock.patch(
+                "chroma_agent.lib.backoff.time.time",
+                side_effect=[
+                    phase_offset("test_server/test_plugin", 30) + 3000,
+                    phase_offset("test_server/test_plugin", 30) + 3020,
+                ],
+            ):
+                self.assertEqual(writer._poll_plugin("test_plugin"), 10)
+
+    def test_plugin_poll_now(self):
+        """Test that a plugin can have itself polled at once rather than at its next period"""
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.sessions = SessionTable(client)
+        client.writer = HttpWriter(client)
+        client.device_plugins.get = mock.Mock(
+            return_value=lambda session: DevicePlugin(session)
+        )
+
+        client.sessions.create("test_plugin", "id_foo")
+        session = client.sessions.get("test_plugin")
+        with mock.patch.object(client.writer._scheduler, "wake") as wake:
+            session._plugin.poll_now()
+        wake.assert_called_once_with("test_plugin")
+
     def test_session_backoff(self):
         """Test that when messages to the manager are being dropped due to POST failure,
-        sending SESSION_CREATE_REQUEST messages has a power-of-two backoff wait"""
+        sending SESSION_CREATE_REQUEST messages has a jittered, growing backoff wait"""
+        # Make the jitter predictable: take the middle of the range
+        patcher = mock.patch(
+            "chroma_agent.lib.backoff.random.uniform",
+            side_effect=lambda a, b: (a + b) / 2.0,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
         client = mock.Mock()
         client._fqdn = "test_server"
         client.boot_time = IMLDateTime.utcnow()
@@ -148,7 +526,7 @@ class TestHttpWriter(unittest.TestCase):
         )
         client.sessions = SessionTable(client)
 
-        client.post = mock.Mock(side_effect=HttpError())
+        client.post_encoded = mock.Mock(side_effect=HttpError())
 
         # Pick an arbitrary time to use as a base for simulated waits
         t_0 = datetime.datetime.now()
@@ -184,13 +562,14 @@ class TestHttpWriter(unittest.TestCase):
 
             # Send should consume the messages, and they go to nowhere because the POST fails
             writer.send()
-            client.post.assert_called_once()
-            self.assertEqual(len(client.post.call_args[0][0]["messages"]), 1)
+            client.post_encoded.assert_called_once()
+            self.assertEqual(len(posted_envelope(client)["messages"]), 1)
 
-            # First time boundary: where the first repeat should happen
+            # First time boundary: where the first repeat should happen, halfway between
+            # MIN_SESSION_BACKOFF and 3 * MIN_SESSION_BACKOFF
             from chroma_agent.agent_client import MIN_SESSION_BACKOFF
 
-            t_1 = t_0 + MIN_SESSION_BACKOFF
+            t_1 = t_0 + MIN_SESSION_BACKOFF * 2
 
             expect_message_at(t_1)
 
@@ -198,15 +577,16 @@ class TestHttpWriter(unittest.TestCase):
             writer.send()
             self.assertTrue(writer._messages.empty())
 
-            # Second time boundary: where the second repeat should happen
-            t_2 = t_1 + MIN_SESSION_BACKOFF * 2
+            # Second time boundary: where the second repeat should happen, halfway between
+            # MIN_SESSION_BACKOFF and 3 * 2 * MIN_SESSION_BACKOFF
+            t_2 = t_1 + MIN_SESSION_BACKOFF * 7 / 2
             expect_message_at(t_2)
 
             # Stage 2: success in POST, session creation
             # ==========================================
 
             # This time we'll let the message go through, and a session to begin.
-            client.post = mock.Mock()
+            client.post_encoded = mock.Mock()
             writer.send()
 
             # HttpReader receives a response from the manager, and should reset the backoff counters.
@@ -228,7 +608,7 @@ class TestHttpWriter(unittest.TestCase):
             # ===================================================
 
             # Break the POST link again
-            client.post = mock.Mock(side_effect=HttpError())
+            client.post_encoded = mock.Mock(side_effect=HttpError())
 
             # Poll will get a DATA message from initial_scan
             session.initial_scan = mock.Mock(return_value={"foo": "bar"})
@@ -252,12 +632,518 @@ class TestHttpWriter(unittest.TestCase):
             writer.send()
             self.assertEqual(writer._messages.qsize(), 0)
 
-            # Check the backoff time has gone back to MIN_SESSION_BACKOFF
-            t_4 = t_3 + MIN_SESSION_BACKOFF
+            # Check the backoff time has gone back to the start
+            t_4 = t_3 + MIN_SESSION_BACKOFF * 2
             expect_message_at(t_4)
         finally:
             datetime.datetime = old_datetime
 
+    def test_spool_on_failure(self):
+        """
+        Test that with a spool, DATA messages from a failed POST are kept and resent in order,
+        instead of their sessions being terminated
+        """
+        import shutil
+        import tempfile
+        from chroma_agent.lib.spool import Spool
+
+        spool_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_path)
+
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.sessions = SessionTable(client)
+        client.device_plugins.get = mock.Mock(return_value=lambda _: mock.Mock())
+
+        writer = client.writer = HttpWriter(client, Spool(spool_path, 1024 * 1024))
+        client.sessions.create("test_plugin", "id_foo")
+        client.sessions.create("other_plugin", "id_bar")
+
+        client.post_encoded = mock.Mock(side_effect=HttpError())
+        writer.put(
+            Message("DATA", "test_plugin", DevicePluginMessage("first"), "id_foo", 0)
+        )
+        writer.put(
+            Message("DATA", "other_plugin", DevicePluginMessage("stale"), "id_bar", 0)
+        )
+        writer.put(Message("SESSION_CREATE_REQUEST", "new_plugin"))
+        self.assertFalse(writer.send())
+
+        # Nothing is torn down
+        self.assertEqual(len(client.sessions._sessions), 2)
+
+        # A session that ends while its messages are spooled has them discarded
+        client.sessions.terminate("other_plugin")
+
+        client.post_encoded = mock.Mock()
+        writer.put(
+            Message("DATA", "test_plugin", DevicePluginMessage("second"), "id_foo", 1)
+        )
+        self.assertTrue(writer.send())
+
+        messages = posted_envelope(client)["messages"]
+        self.assertEqual([m["body"] for m in messages], ["first", "second"])
+        self.assertTrue(writer._spool.empty)
+
+    def restart_with_spool(self, spool_path, bodies):
+        """Spool bodies from test_plugin's session in one run of the agent, and start the next run"""
+        from chroma_agent.lib.spool import Spool
+
+        def make_client():
+            client = mock.Mock()
+            client._fqdn = "test_server"
+            client.boot_time = IMLDateTime.utcnow()
+            client.start_time = IMLDateTime.utcnow()
+            client.sessions = SessionTable(client)
+            client.device_plugins.get = mock.Mock(return_value=lambda _: mock.Mock())
+            return client
+
+        client = make_client()
+        writer = client.writer = HttpWriter(client, Spool(spool_path, 1024 * 1024))
+        client.sessions.create("test_plugin", "id_old")
+        session = client.sessions.get("test_plugin")
+
+        client.post_encoded = mock.Mock(side_effect=HttpError())
+        for body in bodies:
+            session.send_message(DevicePluginMessage(body))
+        self.assertFalse(writer.send())
+        writer._spool.close()
+
+        client = make_client()
+        client.writer = HttpWriter(client, Spool(spool_path, 1024 * 1024))
+        client.post_encoded = mock.Mock(return_value=None)
+        return client
+
+    def test_spool_restart(self):
+        """
+        Test that messages spooled before the agent restarted are sent at the start of their plugin's
+        new session, ahead of its own messages
+        """
+        import shutil
+        import tempfile
+
+        spool_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_path)
+
+        client = self.restart_with_spool(
+            spool_path,
+            [
+                {"a": 1},
+                {"metrics": {"delta": {"changed": {"a": 2}, "removed": []}}},
+                {"a": 3},
+            ],
+        )
+        writer = client.writer
+
+        # They wait for the plugin's new session
+        writer.put(Message("SESSION_CREATE_REQUEST", "test_plugin"))
+        self.assertTrue(writer.send())
+        self.assertEqual(
+            [m["type"] for m in posted_envelope(client)["messages"]],
+            ["SESSION_CREATE_REQUEST"],
+        )
+
+        client.sessions.create("test_plugin", "id_new")
+        session = client.sessions.get("test_plugin")
+        session.send_message(DevicePluginMessage({"a": 4}))
+        self.assertTrue(writer.send())
+
+        # A tree delta is against what the manager held for the old session, so is dropped
+        self.assertEqual(
+            [
+                (m["session_id"], m["session_seq"], m["body"])
+                for m in posted_envelope(client)["messages"]
+            ],
+            [
+                ("id_new", 0, {"a": 1}),
+                ("id_new", 2, {"a": 3}),
+                ("id_new", 3, {"a": 4}),
+            ],
+        )
+        self.assertTrue(writer._spool.empty)
+
+    def test_spool_restart_no_session(self):
+        """Test that messages spooled before the agent restarted are dropped if no session starts in time"""
+        import shutil
+        import tempfile
+
+        spool_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_path)
+
+        with mock.patch("chroma_agent.agent_client.RESTORED_SPOOL_WAIT", 0):
+            client = self.restart_with_spool(spool_path, [{"a": 1}])
+        writer = client.writer
+
+        writer.put(Message("SESSION_CREATE_REQUEST", "test_plugin"))
+        self.assertTrue(writer.send())
+        self.assertEqual(
+            [m["type"] for m in posted_envelope(client)["messages"]],
+            ["SESSION_CREATE_REQUEST"],
+        )
+        self.assertTrue(writer._spool.empty)
+
+        client.sessions.create("test_plugin", "id_new")
+        self.assertEqual(client.sessions.get("test_plugin")._seq, 0)
+
+    def test_spool_oversized(self):
+        """
+        Test that a spooled message too large to post uncompressed, after the manager rejected a
+        compressed body, is dropped and its session terminated
+        """
+        import shutil
+        import tempfile
+        from chroma_agent.lib.spool import Spool
+
+        spool_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_path)
+
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.sessions = SessionTable(client)
+        client.device_plugins.get = mock.Mock(return_value=lambda _: mock.Mock())
+
+        writer = client.writer = HttpWriter(client, Spool(spool_path, 1024 * 1024))
+        writer.compress = True
+        client.sessions.create("test_plugin", "id_foo")
+        session = client.sessions.get("test_plugin")
+
+        with mock.patch("chroma_agent.agent_client.MAX_BYTES_PER_POST", 2048):
+            client.post_encoded = mock.Mock(side_effect=HttpError(status_code=415))
+            session.send_message(DevicePluginMessage("x" * 8192))
+            self.assertFalse(writer.send())
+            self.assertFalse(writer.compress)
+            self.assertFalse(writer._spool.empty)
+
+            client.post_encoded = mock.Mock(return_value=None)
+            self.assertTrue(writer.send())
+
+        self.assertFalse(client.post_encoded.called)
+        self.assertTrue(writer._spool.empty)
+        self.assertEqual(client.sessions._sessions, {})
+
+    def test_spool_overflow(self):
+        """Test that a session is terminated if the spool has to drop its messages to make room"""
+        import shutil
+        import tempfile
+        from chroma_agent.lib.spool import Spool
+
+        spool_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_path)
+
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.sessions = SessionTable(client)
+        client.device_plugins.get = mock.Mock(return_value=lambda _: mock.Mock())
+
+        writer = client.writer = HttpWriter(
+            client, Spool(spool_path, 1024, segment_bytes=64)
+        )
+        client.sessions.create("test_plugin", "id_foo")
+        client.sessions.create("other_plugin", "id_bar")
+        session = client.sessions.get("test_plugin")
+
+        client.post_encoded = mock.Mock(side_effect=HttpError())
+        writer.put(
+            Message("DATA", "other_plugin", DevicePluginMessage("lost"), "id_bar", 0)
+        )
+        self.assertFalse(writer.send())
+
+        for _ in range(2):
+            session.send_message(DevicePluginMessage("x" * 300))
+            self.assertFalse(writer.send())
+
+        self.assertEqual(client.sessions._sessions, {"test_plugin": session})
+        self.assertEqual(
+            set(record.split("\n")[0] for _, record in writer._spool.peek()),
+            set(["test_plugin"]),
+        )
+
+    def test_resume_on_failure(self):
+        """
+        Test that once the manager acknowledges messages, a failed POST resends what has not been
+        acknowledged instead of terminating the session
+        """
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.sessions = SessionTable(client)
+        client.device_plugins.get = mock.Mock(return_value=lambda _: mock.Mock())
+
+        writer = client.writer = HttpWriter(client)
+        # As from the first GET response
+        client.sessions.acknowledge([])
+        client.sessions.create("test_plugin", "id_foo")
+        session = client.sessions.get("test_plugin")
+
+        client.post_encoded = mock.Mock(
+            return_value={
+                "acks": [
+                    {"plugin": "test_plugin", "session_id": "id_foo", "session_seq": 0}
+                ]
+            }
+        )
+        session.send_message(DevicePluginMessage("zero"))
+        session.send_message(DevicePluginMessage("one"))
+        self.assertTrue(writer.send())
+
+        client.post_encoded = mock.Mock(side_effect=HttpError())
+        session.send_message(DevicePluginMessage("two"))
+        self.assertFalse(writer.send())
+
+        # The session survives, and everything after the acknowledged message is sent again in order
+        self.assertIs(client.sessions.get("test_plugin"), session)
+        client.post_encoded = mock.Mock(return_value=None)
+        self.assertTrue(writer.send())
+        self.assertEqual(
+            [
+                (m["session_seq"], m["body"])
+                for m in posted_envelope(client)["messages"]
+            ],
+            [(1, "one"), (2, "two")],
+        )
+
+    def test_resume_order(self):
+        """
+        Test that messages resent after a failed POST go ahead of a newer message which overflowed it,
+        so that the manager gets every session's messages in order
+        """
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.sessions = SessionTable(client)
+        client.device_plugins.get = mock.Mock(return_value=lambda _: mock.Mock())
+
+        writer = client.writer = HttpWriter(client)
+        client.sessions.acknowledge([])
+        client.sessions.create("test_plugin", "id_foo")
+        session = client.sessions.get("test_plugin")
+
+        with mock.patch("chroma_agent.agent_client.MAX_BYTES_PER_POST", 1500):
+            for _ in range(3):
+                session.send_message(DevicePluginMessage("x" * 400))
+
+            client.post_encoded = mock.Mock(side_effect=HttpError())
+            self.assertFalse(writer.send())
+
+            posted_seqs = []
+
+            def post_encoded(body, content_encoding):
+                posted_seqs.append(
+                    [m["session_seq"] for m in json.loads(body)["messages"]]
+                )
+
+            client.post_encoded = mock.Mock(side_effect=post_encoded)
+            self.assertTrue(writer.send())
+            self.assertTrue(writer.send())
+
+        self.assertEqual(posted_seqs, [[0, 1], [2]])
+
+    def test_resume_spooled_order(self):
+        """
+        Test that unacknowledged messages resent after a failed GET go ahead of newer ones spooled by
+        a failed POST
+        """
+        import shutil
+        import tempfile
+        from chroma_agent.lib.spool import Spool
+
+        spool_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_path)
+
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.sessions = SessionTable(client)
+        client.device_plugins.get = mock.Mock(return_value=lambda _: mock.Mock())
+
+        writer = client.writer = HttpWriter(client, Spool(spool_path, 1024 * 1024))
+        client.sessions.acknowledge([])
+        client.sessions.create("test_plugin", "id_foo")
+        session = client.sessions.get("test_plugin")
+
+        client.post_encoded = mock.Mock(return_value=None)
+        session.send_message(DevicePluginMessage("zero"))
+        self.assertTrue(writer.send())
+
+        client.post_encoded = mock.Mock(side_effect=HttpError())
+        session.send_message(DevicePluginMessage("one"))
+        self.assertFalse(writer.send())
+
+        # As HttpReader does when its GET fails
+        client.sessions.recover()
+
+        # A POST failing again keeps them in the same order
+        self.assertFalse(writer.send())
+
+        client.post_encoded = mock.Mock(return_value=None)
+        self.assertTrue(writer.send())
+        self.assertEqual(
+            [m["session_seq"] for m in posted_envelope(client)["messages"]], [0, 1]
+        )
+        self.assertTrue(writer._spool.empty)
+        self.assertTrue(writer._retry_empty)
+
+    def test_spool_then_get_failure(self):
+        """
+        Test that a message spooled by a failed POST is delivered once, not also resent from the
+        session's unacknowledged messages when a GET fails too
+        """
+        import shutil
+        import tempfile
+        from chroma_agent.lib.spool import Spool
+
+        spool_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_path)
+
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.sessions = SessionTable(client)
+        client.device_plugins.get = mock.Mock(return_value=lambda _: mock.Mock())
+
+        writer = client.writer = HttpWriter(client, Spool(spool_path, 1024 * 1024))
+        client.sessions.acknowledge([])
+        client.sessions.create("test_plugin", "id_foo")
+        session = client.sessions.get("test_plugin")
+
+        client.post_encoded = mock.Mock(side_effect=HttpError())
+        session.send_message(DevicePluginMessage("zero"))
+        self.assertFalse(writer.send())
+
+        # As HttpReader does when its GET fails
+        client.sessions.recover()
+
+        client.post_encoded = mock.Mock(return_value=None)
+        self.assertTrue(writer.send())
+        self.assertEqual(
+            [m["session_seq"] for m in posted_envelope(client)["messages"]], [0]
+        )
+        self.assertTrue(writer._spool.empty)
+        self.assertTrue(writer._retry_empty)
+
+        # Once posted it is kept until the manager acknowledges it, and only then forgotten
+        self.assertEqual([m.session_seq for m in session._unacknowledged], [0])
+        client.sessions.acknowledge(
+            [{"plugin": "test_plugin", "session_id": "id_foo", "session_seq": 0}]
+        )
+        client.sessions.recover()
+        self.assertTrue(writer._retry_empty)
+
+    def test_resume_overflow(self):
+        """Test that a session which had to drop unacknowledged messages is terminated on failure"""
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.sessions = SessionTable(client)
+        client.sessions.acknowledged_delivery = True
+        client.device_plugins.get = mock.Mock(return_value=lambda _: mock.Mock())
+
+        writer = client.writer = HttpWriter(client)
+        client.sessions.create("test_plugin", "id_foo")
+        session = client.sessions.get("test_plugin")
+
+        with mock.patch("chroma_agent.agent_client.REPLAY_BUFFER_BYTES", 1024):
+            for _ in range(4):
+                session.send_message(DevicePluginMessage("x" * 500))
+                self.assertTrue(writer.send())
+
+            client.post_encoded = mock.Mock(side_effect=HttpError())
+            session.send_message(DevicePluginMessage("y"))
+            self.assertFalse(writer.send())
+
+        self.assertEqual(client.sessions._sessions, {})
+
+    def test_tree_delta_negotiation(self):
+        """
+        Test that a session only allows tree deltas while the manager says it applies them, and has
+        acknowledged everything the session has sent
+        """
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.sessions = SessionTable(client)
+        client.device_plugins.get = mock.Mock(return_value=lambda _: mock.Mock())
+
+        writer = client.writer = HttpWriter(client)
+        client.sessions.create("test_plugin", "id_foo")
+        session = client.sessions.get("test_plugin")
+        self.assertFalse(session.tree_deltas)
+
+        # Without acknowledgements the manager may not hold the previous result
+        client.post_encoded = mock.Mock(return_value={"tree_deltas": True})
+        session.send_message(DevicePluginMessage("zero"))
+        self.assertTrue(writer.send())
+        self.assertTrue(client.sessions.tree_deltas)
+        self.assertFalse(session.tree_deltas)
+
+        acks = [{"plugin": "test_plugin", "session_id": "id_foo", "session_seq": 0}]
+        client.post_encoded = mock.Mock(
+            return_value={"tree_deltas": True, "acks": acks}
+        )
+        session.send_message(DevicePluginMessage("one"))
+        self.assertFalse(session.tree_deltas)
+        self.assertTrue(writer.send())
+        # "one" is posted but not yet acknowledged
+        self.assertFalse(session.tree_deltas)
+
+        acks[0]["session_seq"] = 1
+        client.sessions.acknowledge(acks)
+        self.assertTrue(session.tree_deltas)
+
+        client.post_encoded = mock.Mock(return_value={"tree_deltas": False})
+        session.send_message(DevicePluginMessage("two"))
+        self.assertTrue(writer.send())
+        acks[0]["session_seq"] = 2
+        client.sessions.acknowledge(acks)
+        self.assertFalse(session.tree_deltas)
+
+    def test_compression_negotiation(self):
+        """
+        Test that POST bodies are only compressed once the manager says it accepts them, and are sent
+        uncompressed again if it rejects one
+        """
+        client = mock.Mock()
+        client._fqdn = "test_server"
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.sessions = SessionTable(client)
+        client.device_plugins.get = mock.Mock(return_value=lambda _: mock.Mock())
+
+        writer = client.writer = HttpWriter(client)
+        client.sessions.create("test_plugin", "id_foo")
+        session = client.sessions.get("test_plugin")
+
+        def send_large():
+            session.send_message(DevicePluginMessage("x" * 8192))
+            return writer.send()
+
+        client.post_encoded = mock.Mock(return_value={"content_encodings": ["gzip"]})
+        self.assertTrue(send_large())
+        self.assertEqual(client.post_encoded.call_args[0][1], None)
+
+        self.assertTrue(send_large())
+        self.assertEqual(client.post_encoded.call_args[0][1], "gzip")
+
+        client.post_encoded = mock.Mock(side_effect=HttpError(status_code=415))
+        self.assertFalse(send_large())
+        self.assertFalse(writer.compress)
+
+        client.post_encoded = mock.Mock(return_value=None)
+        self.assertTrue(send_large())
+        self.assertEqual(client.post_encoded.call_args[0][1], None)
+
     def test_oversized_messages(self):
         """
         Test that oversized messages are dropped and the session is terminated
@@ -283,12 +1169,12 @@ class TestHttpWriter(unittest.TestCase):
 
         writer = HttpWriter(client)
 
-        def fake_post(envelope):
-            if len(json.dumps(envelope)) > MAX_BYTES_PER_POST:
+        def fake_post(body, content_encoding):
+            if len(body) > MAX_BYTES_PER_POST:
                 daemon_log.info("fake_post(): rejecting oversized message")
                 raise HttpError()
 
-        client.post = mock.Mock(side_effect=fake_post)
+        client.post_encoded = mock.Mock(side_effect=fake_post)
         TestPlugin = mock.Mock()
 
         mock_plugin_instance = mock.Mock()
@@ -313,8 +1199,8 @@ class TestHttpWriter(unittest.TestCase):
         # There should be one message to set up the session
         writer.poll("test_plugin")
         self.assertTrue(writer.send())
-        self.assertEqual(client.post.call_count, 1)
-        messages = client.post.call_args[0][0]["messages"]
+        self.assertEqual(client.post_encoded.call_count, 1)
+        messages = posted_envelope(client)["messages"]
         self.assertEqual(len(messages), 1)
         self.assertEqual(messages[0]["type"], "SESSION_CREATE_REQUEST")
         # Pretend we got a SESSION_CREATE_RESPONSE
@@ -329,23 +1215,23 @@ class TestHttpWriter(unittest.TestCase):
 
         # Only the normal message should get through
         self.assertTrue(writer.send())
-        self.assertEqual(client.post.call_count, 2)
-        messages = client.post.call_args[0][0]["messages"]
+        self.assertEqual(client.post_encoded.call_count, 2)
+        messages = posted_envelope(client)["messages"]
         self.assertEqual(len(messages), 1)
         self.assertEqual(messages[0]["type"], "DATA")
 
         # The oversized message should be dropped and the session
         # terminated
         self.assertFalse(writer.send())
-        self.assertEqual(client.post.call_count, 3)
+        self.assertEqual(client.post_encoded.call_count, 3)
         self.assertEqual(len(client.sessions._sessions), 0)
 
         # However, we should eventually get a new session for the
         # offending plugin
         writer.poll("test_plugin")
         self.assertTrue(writer.send())
-        self.assertEqual(client.post.call_count, 4)
-        messages = client.post.call_args[0][0]["messages"]
+        self.assertEqual(client.post_encoded.call_count, 4)
+        messages = posted_envelope(client)["messages"]
         self.assertEqual(len(messages), 1)
         self.assertEqual(messages[0]["type"], "SESSION_CREATE_REQUEST")
 
@@ -407,3 +1293,143 @@ class TestHttpReader(unittest.TestCase):
         session.teardown.assertCalledOnce()
         # Should have removed the session
         self.assertNotIn("test_plugin", client.sessions._sessions)
+
+    def test_get_failure(self):
+        """
+        Test that a failed GET terminates every session, unless the manager acknowledges messages
+        in which case unacknowledged messages are resent
+        """
+        for acknowledged_delivery in [False, True]:
+            client = mock.Mock()
+            client.boot_time = IMLDateTime.utcnow()
+            client.start_time = IMLDateTime.utcnow()
+            client.sessions = SessionTable(client)
+            client.sessions.acknowledged_delivery = acknowledged_delivery
+            client.writer.spooled = mock.Mock(return_value=False)
+            client.device_plugins.get = mock.Mock(return_value=lambda _: mock.Mock())
+            client.sessions.create("test_plugin", "id_foo")
+            session = client.sessions.get("test_plugin")
+
+            message = Message("DATA", "test_plugin", "body", "id_foo", 0)
+            message.encode("test_server")
+            session.sent(message)
+
+            reader = HttpReader(client)
+
+            def failed_get(**kwargs):
+                reader.stop()
+                raise HttpError()
+
+            client.get = mock.Mock(side_effect=failed_get)
+            reader._run()
+
+            if acknowledged_delivery:
+                self.assertIs(client.sessions.get("test_plugin"), session)
+                client.writer.resend.assert_called_once_with([message])
+            else:
+                self.assertEqual(client.sessions._sessions, {})
+                self.assertFalse(client.writer.resend.called)
+
+    def test_get_failure_spooled(self):
+        """Test that without acknowledgements a failed GET keeps sessions with spooled messages"""
+        client = mock.Mock()
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.sessions = SessionTable(client)
+        client.device_plugins.get = mock.Mock(return_value=lambda _: mock.Mock())
+        client.writer.spooled = lambda plugin_name, session_id: (
+            plugin_name == "test_plugin"
+        )
+        client.sessions.create("test_plugin", "id_foo")
+        client.sessions.create("other_plugin", "id_bar")
+        session = client.sessions.get("test_plugin")
+
+        reader = HttpReader(client)
+
+        def failed_get(**kwargs):
+            reader.stop()
+            raise HttpError()
+
+        client.get = mock.Mock(side_effect=failed_get)
+        reader._run()
+
+        self.assertEqual(client.sessions._sessions, {"test_plugin": session})
+
+    def test_acks(self):
+        """Test that acknowledgements in a GET response are passed to the sessions"""
+        client = mock.Mock()
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.sessions = mock.Mock()
+
+        reader = HttpReader(client)
+        acks = [{"plugin": "test_plugin", "session_id": "id_foo", "session_seq": 3}]
+
+        def get(**kwargs):
+            reader.stop()
+            return {"messages": [], "acks": acks}
+
+        client.get = mock.Mock(side_effect=get)
+        reader._run()
+
+        client.sessions.acknowledge.assert_called_once_with(acks)
+        self.assertEqual(client.get.call_args[1]["params"]["acks"], 1)
+
+    def test_content_encodings(self):
+        """Test that the writer compresses POST bodies once a GET response says the manager accepts them"""
+        client = mock.Mock()
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.writer.compress = False
+
+        reader = HttpReader(client)
+
+        def get(**kwargs):
+            reader.stop()
+            return {"messages": [], "content_encodings": ["gzip"]}
+
+        client.get = mock.Mock(side_effect=get)
+        reader._run()
+
+        self.assertTrue(client.writer.compress)
+        self.assertEqual(client.get.call_args[1]["params"]["gzip"], 1)
+
+    def test_capabilities(self):
+        """Test that optional message formats are offered, and used once a GET response says the manager takes them"""
+        client = mock.Mock()
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+        client.sessions = SessionTable(client)
+
+        reader = HttpReader(client)
+
+        def get(**kwargs):
+            reader.stop()
+            return {"messages": [], "tree_deltas": True, "network_rates": True}
+
+        client.get = mock.Mock(side_effect=get)
+        reader._run()
+
+        self.assertTrue(client.sessions.tree_deltas)
+        self.assertTrue(client.sessions.network_rates)
+        self.assertEqual(client.get.call_args[1]["params"]["tree_deltas"], 1)
+        self.assertEqual(client.get.call_args[1]["params"]["network_rates"], 1)
+
+    def test_retry_after(self):
+        """Test that a Retry-After from the manager is honoured when a GET fails"""
+        client = mock.Mock()
+        client.boot_time = IMLDateTime.utcnow()
+        client.start_time = IMLDateTime.utcnow()
+
+        reader = HttpReader(client)
+
+        def failed_get(**kwargs):
+            reader.stop()
+            raise HttpError(retry_after=300)
+
+        client.get = mock.Mock(side_effect=failed_get)
+        with mock.patch.object(reader, "_stopping") as stopping:
+            stopping.is_set = mock.Mock(side_effect=[False, True])
+            reader._run()
+
+        stopping.wait.assert_called_once_with(timeout=300)
@@ -0,0 +1,69 @@
+import email.utils
+
+import mock
+import unittest
+
+from chroma_agent.lib.backoff import (
+    DecorrelatedJitter,
+    phase_offset,
+    next_phase,
+    parse_retry_after,
+)
+
+
+class TestDecorrelatedJitter(unittest.TestCase):
+    def test_bounds(self):
+        """Test that delays stay within base and cap, and that reset starts again from base"""
+        backoff = DecorrelatedJitter(10, 60)
+
+        previous = 10
+        for _ in range(100):
+            delay = backoff.next()
+            self.assertGreaterEqual(delay, 10)
+            self.assertLessEqual(delay, min(60, previous * 3))
+            previous = delay
+
+        backoff.reset()
+        self.assertLessEqual(backoff.next(), 30)
+
+    def test_spread(self):
+        """Test that clients failing together do not retry together"""
+        delays = set(DecorrelatedJitter(10, 60).next() for _ in range(20))
+        self.assertGreater(len(delays), 1)
+
+
+class TestPhase(unittest.TestCase):
+    def test_phase_offset(self):
+        """Test that the offset is fixed for a key, within the period, and differs between keys"""
+        offsets = [
+            phase_offset("node%s.example.com" % index, 10) for index in range(50)
+        ]
+
+        self.assertEqual(offsets[0], phase_offset("node0.example.com", 10))
+        self.assertTrue(all(0 <= offset < 10 for offset in offsets))
+        self.assertGreater(len(set(offsets)), 40)
+
+    def test_next_phase(self):
+        offset = phase_offset("node0.example.com", 10)
+        self.assertAlmostEqual(
+            next_phase("node0.example.com", 10, now=1000 + offset), 10
+        )
+        self.assertAlmostEqual(
+            next_phase("node0.example.com", 10, now=1004 + offset), 6
+        )
+
+
+class TestParseRetryAfter(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after("120"), 120.0)
+        self.assertEqual(parse_retry_after(5), 5.0)
+
+    def test_date(self):
+        with mock.patch("chroma_agent.lib.backoff.time.time", return_value=1000000000):
+            self.assertEqual(
+                parse_retry_after(email.utils.formatdate(1000000030, usegmt=True)), 30.0
+            )
+
+    def test_invalid(self):
+        self.assertEqual(parse_retry_after(None), None)
+        self.assertEqual(parse_retry_after("soon"), None)
@@ -0,0 +1,63 @@
+import time
+
+import mock
+import unittest
+
+from chroma_agent.agent_client import AgentClient
+from tests.benchmark_agent_transport import (
+    SyntheticPluginManager,
+    SyntheticServerProperties,
+    run_benchmark,
+)
+from tests.lib.fake_manager import FakeManager
+
+
+class TestFakeManager(unittest.TestCase):
+    def setUp(self):
+        super(TestFakeManager, self).setUp()
+
+        self.manager = FakeManager(long_poll=0.2)
+        self.manager.start()
+        self.addCleanup(self.manager.stop)
+
+        mock.patch("chroma_agent.agent_client.phase_offset", return_value=0.0).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def wait_for(self, condition, timeout=10.0):
+        started_at = time.time()
+        while not condition():
+            if time.time() - started_at > timeout:
+                raise AssertionError("Timed out waiting for condition")
+            time.sleep(0.05)
+
+    def test_end_to_end(self):
+        """Test that an agent gets sessions from the fake manager and delivers DATA to it over HTTP"""
+        client = AgentClient(
+            self.manager.url("agent.example.com"),
+            mock.Mock(),
+            SyntheticPluginManager(2, 0.2, 1024),
+            SyntheticServerProperties("agent.example.com"),
+            mock.Mock(certificate_file=None, private_key_file=None),
+        )
+        client.start()
+        try:
+            self.wait_for(lambda: self.manager.stats["delivered"] >= 6)
+        finally:
+            client.stop()
+            client.join()
+            client.reader.join()
+
+        self.assertEqual(self.manager.session_count(), 2)
+        self.assertEqual(self.manager.stats["SESSION_CREATE_REQUEST"], 2)
+        self.assertEqual(self.manager.stats["unknown_session"], 0)
+        self.assertTrue(client.sessions.acknowledged_delivery)
+
+    def test_benchmark(self):
+        """Test that the benchmark driver runs and reports"""
+        results = run_benchmark(
+            agents=2, plugins=2, duration=1.0, poll_period=0.2, message_bytes=512
+        )
+
+        self.assertGreater(results["messages_per_second"], 0)
+        self.assertIsNotNone(results["post_latency"][50])
+        self.assertIsNotNone(results["message_latency"][99])
@@ -0,0 +1,233 @@
+import os
+import shutil
+import tempfile
+
+import unittest
+
+from chroma_agent.lib.lustre_params import LustreParams, split_get_param_output
+from chroma_agent.device_plugins.audit.lustre import LustreAudit
+from iml_common.test.command_capture_testcase import CommandCaptureTestCase
+
+
+class LustreParamTree(object):
+    def make_tree(self, files):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+
+        for path, content in files.items():
+            path = os.path.join(root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(content)
+
+        return root
+
+
+class TestLustreParams(unittest.TestCase, LustreParamTree):
+    def setUp(self):
+        super(TestLustreParams, self).setUp()
+
+        self.params = LustreParams(
+            self.make_tree(
+                {
+                    "sys/fs/lustre/version": "2.10.4\n",
+                    "proc/fs/lustre/version": "wrong root\n",
+                    "proc/fs/lustre/health_check": "healthy\n",
+                    "proc/fs/lustre/obdfilter/testfs-OST0000/stats": "ost0\n",
+                    "proc/fs/lustre/obdfilter/testfs-OST0001/stats": "ost1\n",
+                    "proc/fs/lustre/obdfilter/testfs-OST0001/exports/192.168.0.1@tcp/stats": "export\n",
+                    "sys/kernel/debug/lnet/nis": "nid status\n",
+                }
+            )
+        )
+
+    def test_read(self):
+        """Test that params are read from the first root they are found in"""
+        self.assertEqual(self.params.read("version"), "2.10.4\n")
+        self.assertEqual(self.params.read("health_check"), "healthy\n")
+        self.assertEqual(self.params.read("nis"), "nid status\n")
+
+    def test_wildcards(self):
+        """Test that wildcards match every param, in order, with values concatenated like lctl -n"""
+        self.assertEqual(self.params.read("obdfilter.*.stats"), "ost0\nost1\n")
+        self.assertEqual(
+            self.params.list("obdfilter/*/stats"),
+            ["obdfilter.testfs-OST0000.stats", "obdfilter.testfs-OST0001.stats"],
+        )
+        self.assertEqual(
+            self.params.list("obdfilter.*"),
+            ["obdfilter.testfs-OST0000", "obdfilter.testfs-OST0001"],
+        )
+
+    def test_dotted_names(self):
+        """Test that names containing dots, such as NIDs, are resolved"""
+        self.assertEqual(
+            self.params.read("obdfilter.testfs-OST0001.exports.192.168.0.1@tcp.stats"),
+            "export\n",
+        )
+        self.assertEqual(
+            self.params.list("obdfilter.*.exports.*.stats"),
+            ["obdfilter.testfs-OST0001.exports.192.168.0.1@tcp.stats"],
+        )
+
+    def test_iterate(self):
+        """Test that iterate() finds the same params as resolve(), from the first root only"""
+        for path in ["version", "obdfilter.*.stats", "obdfilter.*.exports.*.stats"]:
+            self.assertEqual(list(self.params.iterate(path)), self.params.resolve(path))
+        self.assertEqual(list(self.params.iterate("mdt.*.stats")), [])
+
+    def test_missing(self):
+        self.assertEqual(self.params.read("obdfilter.*.job_stats"), None)
+        self.assertEqual(self.params.list("mdt.*.stats"), None)
+        self.assertEqual(LustreParams("/nonexistent").read("version"), None)
+
+
+class TestLustreParamsFallback(CommandCaptureTestCase, LustreParamTree):
+    def setUp(self):
+        super(TestLustreParamsFallback, self).setUp()
+
+        self.audit = LustreAudit()
+        self.audit.fscontext = self.make_tree(
+            {"proc/fs/lustre/health_check": "healthy\n"}
+        )
+
+    def test_native(self):
+        """Test that params found in /proc are read without running lctl"""
+        self.assertEqual(self.audit.health_check(), "healthy")
+        self.assertRanAllCommandsInOrder()
+
+    def test_fallback(self):
+        """Test that lctl is run for params that cannot be found"""
+        self.add_command(("lctl", "get_param", "-n", "version"), stdout="2.10.4\n")
+
+        self.assertEqual(self.audit.version, "2.10.4")
+        self.assertRanAllCommandsInOrder()
+
+    def test_stream(self):
+        """Test that params are streamed from the file where they can be, else from lctl"""
+        self.add_command(
+            ("lctl", "get_param", "-n", "version"),
+            stdout="lustre: 2.10.4\nkernel: patchless_client\n",
+        )
+
+        self.assertEqual(
+            list(self.audit.stream_param_lines("health_check")), ["healthy"]
+        )
+        self.assertEqual(
+            list(self.audit.stream_param_lines("version")),
+            ["lustre: 2.10.4", "kernel: patchless_client"],
+        )
+        self.assertRanAllCommandsInOrder()
+
+    def test_stream_params(self):
+        """Test that each matching param is streamed natively, else split from one lctl"""
+        self.add_command(
+            ("lctl", "get_param", "obdfilter.*.exports.*.stats"),
+            stdout="obdfilter.testfs-OST0000.exports.0@lo.stats=\n"
+            "snapshot_time=1.5 secs.usecs\n"
+            "obdfilter.testfs-OST0000.exports.192.168.0.1@tcp.stats=\n"
+            "snapshot_time=1.6 secs.usecs\n",
+        )
+
+        self.assertEqual(
+            [
+                (name, list(lines))
+                for name, lines in self.audit.stream_params("health_check")
+            ],
+            [("health_check", ["healthy"])],
+        )
+        self.assertEqual(
+            [
+                (name, list(lines))
+                for name, lines in self.audit.stream_params(
+                    "obdfilter.*.exports.*.stats"
+                )
+            ],
+            [
+                (
+                    "obdfilter.testfs-OST0000.exports.0@lo.stats",
+                    ["snapshot_time=1.5 secs.usecs"],
+                ),
+                (
+                    "obdfilter.testfs-OST0000.exports.192.168.0.1@tcp.stats",
+                    ["snapshot_time=1.6 secs.usecs"],
+                ),
+            ],
+        )
+        self.assertRanAllCommandsInOrder()
+
+
+class TestSplitGetParamOutput(unittest.TestCase):
+    def test_split(self):
+        """Test that output for several paths is split back into the -n output of each"""
+        output = (
+            "version=2.10.4\n"
+            "obdfilter.testfs-OST0000.stats=\n"
+            "snapshot_time=1.5 secs.usecs\n"
+            "write_bytes 10 samples [bytes] 1 2 3\n"
+            "obdfilter.testfs-OST0001.stats=\n"
+            "snapshot_time=1.6 secs.usecs\n"
+        )
+
+        self.assertEqual(
+            split_get_param_output(
+                output, ["version", "obdfilter/*/stats", "health_check"]
+            ),
+            {
+                "version": "2.10.4\n",
+                "obdfilter/*/stats": "snapshot_time=1.5 secs.usecs\n"
+                "write_bytes 10 samples [bytes] 1 2 3\n"
+                "snapshot_time=1.6 secs.usecs\n",
+            },
+        )
+
+
+class TestPrefetchParams(CommandCaptureTestCase, LustreParamTree):
+    def setUp(self):
+        super(TestPrefetchParams, self).setUp()
+
+        self.audit = LustreAudit()
+        self.audit.fscontext = self.make_tree(
+            {"proc/fs/lustre/health_check": "healthy\n"}
+        )
+
+    def test_single_lctl(self):
+        """Test that params which cannot be read natively are fetched by one lctl, once"""
+        self.add_command(
+            ("lctl", "get_param", "version", "devices"),
+            stdout="version=2.10.4\n"
+            "devices=\n"
+            "  0 UP osd-ldiskfs testfs-MDT0000-osd testfs-MDT0000-osd_UUID 10\n"
+            "  1 UP mgs MGS MGS 7\n",
+        )
+
+        self.audit.prefetch_params(["version", "health_check", "devices"])
+        self.audit.prefetch_params(["version"])
+
+        self.assertEqual(self.audit.version, "2.10.4")
+        self.assertEqual(self.audit.health_check(), "healthy")
+        self.assertEqual(
+            [device["type"] for device in self.audit.devices()], ["osd-ldiskfs", "mgs"]
+        )
+        self.assertRanAllCommandsInOrder()
+
+    def test_missing(self):
+        """Test that a param the batch did not return is still read on its own"""
+        self.add_command(
+            ("lctl", "get_param", "version", "devices"),
+            rc=2,
+            stdout="version=2.10.4\n",
+            stderr="error: get_param: param_path 'devices': No such file or directory",
+        )
+        self.add_command(
+            ("lctl", "get_param", "-n", "devices"),
+            rc=2,
+            stderr="error: get_param: param_path 'devices': No such file or directory",
+        )
+
+        self.audit.prefetch_params(["version", "devices"])
+
+        self.assertEqual(self.audit.version, "2.10.4")
+        self.assertEqual(self.audit.devices(), [])
+        self.assertRanAllCommandsInOrder()
@@ -0,0 +1,78 @@
+import socket
+import struct
+import unittest
+
+from chroma_agent.lib import netlink
+
+
+def message(message_type, payload):
+    padding = "\0" * (-len(payload) % 4)
+    return (
+        netlink.NLMSGHDR.pack(
+            netlink.NLMSGHDR.size + len(payload), message_type, 0, 1, 0
+        )
+        + payload
+        + padding
+    )
+
+
+def attribute(attribute_type, value):
+    padding = "\0" * (-len(value) % 4)
+    return (
+        netlink.RTATTR.pack(netlink.RTATTR.size + len(value), attribute_type)
+        + value
+        + padding
+    )
+
+
+def new_address(index, family, prefixlen, flags, attributes):
+    return message(
+        netlink.RTM_NEWADDR,
+        netlink.IFADDRMSG.pack(family, prefixlen, flags, 0, index)
+        + "".join(attribute(t, v) for t, v in attributes),
+    )
+
+
+class TestNetlink(unittest.TestCase):
+    def test_parse_addresses(self):
+        """Test that addresses are parsed from a dump, preferring the local address"""
+        data = (
+            new_address(
+                2,
+                socket.AF_INET,
+                24,
+                0x80,
+                [
+                    (netlink.IFA_ADDRESS, socket.inet_aton("10.0.0.2")),
+                    (netlink.IFA_LOCAL, socket.inet_aton("10.0.0.1")),
+                ],
+            )
+            + new_address(
+                2,
+                socket.AF_INET6,
+                64,
+                0x80,
+                [
+                    (
+                        netlink.IFA_ADDRESS,
+                        socket.inet_pton(socket.AF_INET6, "fe80::1"),
+                    )
+                ],
+            )
+            + new_address(3, socket.AF_INET, 8, 0, [])
+            + message(netlink.NLMSG_DONE, struct.pack("=i", 0))
+        )
+
+        messages = list(netlink.parse_messages(data))
+        self.assertEqual(
+            [message_type for message_type, _ in messages],
+            [netlink.RTM_NEWADDR] * 3 + [netlink.NLMSG_DONE],
+        )
+        self.assertEqual(
+            [netlink.parse_address(payload) for _, payload in messages[:3]],
+            [
+                netlink.Address(2, socket.AF_INET, "10.0.0.1", 24, 0x80),
+                netlink.Address(2, socket.AF_INET6, "fe80::1", 64, 0x80),
+                None,
+            ],
+        )
@@ -0,0 +1,78 @@
+import Queue
+
+import mock
+import unittest
+
+from chroma_agent.lib.priority_queue import AgingPriorityQueue
+
+
+class TestAgingPriorityQueue(unittest.TestCase):
+    def setUp(self):
+        super(TestAgingPriorityQueue, self).setUp()
+
+        self.now = 1000.0
+        patcher = mock.patch(
+            "chroma_agent.lib.priority_queue.monotonic", side_effect=lambda: self.now
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.queue = AgingPriorityQueue(3, 30.0)
+
+    def drain(self):
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except Queue.Empty:
+                return items
+
+    def test_priority_then_fifo(self):
+        """Test that higher priorities come out first, and each level is first in first out"""
+        for index in range(5):
+            self.queue.put(("low", index), 2)
+            self.queue.put(("high", index), 0)
+            self.queue.put(("normal", index), 1)
+
+        self.assertEqual(self.queue.qsize(), 15)
+        self.assertEqual(
+            self.drain(),
+            [("high", index) for index in range(5)]
+            + [("normal", index) for index in range(5)]
+            + [("low", index) for index in range(5)],
+        )
+        self.assertTrue(self.queue.empty())
+
+    def test_aging(self):
+        """Test that an item which has waited too long goes ahead of higher priorities"""
+        self.queue.put("old low", 2)
+        self.now += 20
+        self.queue.put("old normal", 1)
+        self.now += 11
+        self.queue.put("high", 0)
+
+        self.assertEqual(self.queue.get_nowait(), "old low")
+        self.assertEqual(self.queue.get_nowait(), "high")
+        self.assertEqual(self.queue.get_nowait(), "old normal")
+
+        self.assertEqual([level["promoted"] for level in self.queue.stats], [0, 0, 1])
+
+    def test_stats(self):
+        """Test the depth and wait counters"""
+        self.queue.put("a", 1)
+        self.queue.put("b", 1)
+        self.queue.put("c", 2)
+        self.now += 4
+        self.queue.get_nowait()
+        self.now += 2
+        self.queue.get_nowait()
+
+        stats = self.queue.stats
+        self.assertEqual(stats[1]["depth"], 0)
+        self.assertEqual(stats[1]["enqueued"], 2)
+        self.assertEqual(stats[1]["dequeued"], 2)
+        self.assertEqual(stats[1]["mean_wait"], 5.0)
+        self.assertEqual(stats[1]["max_wait"], 6.0)
+        self.assertEqual(stats[2]["depth"], 1)
+        self.assertEqual(stats[2]["dequeued"], 0)
+        self.assertEqual(stats[0]["enqueued"], 0)
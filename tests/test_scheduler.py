@@ -0,0 +1,116 @@
+import time
+import threading
+
+import unittest
+
+from chroma_agent.lib.scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+
+        self.scheduler = Scheduler(2, name="TestScheduler")
+        self.scheduler.start()
+        self.addCleanup(self.scheduler.join)
+        self.addCleanup(self.scheduler.stop)
+
+    def wait_for(self, condition, timeout=5.0):
+        started_at = time.time()
+        while not condition():
+            if time.time() - started_at > timeout:
+                raise AssertionError("Timed out waiting for condition")
+            time.sleep(0.01)
+
+    def test_interval(self):
+        """Test that a job is called repeatedly"""
+        calls = []
+        self.scheduler.add("job", lambda: calls.append(time.time()), 0.05)
+
+        self.wait_for(lambda: len(calls) >= 4)
+
+        intervals = [b - a for a, b in zip(calls, calls[1:])]
+        self.assertTrue(all(interval >= 0.04 for interval in intervals), intervals)
+
+    def test_returned_delay(self):
+        """Test that the value returned by a job overrides its interval"""
+        calls = []
+
+        def job():
+            calls.append(time.time())
+            return 0.05
+
+        self.scheduler.add("job", job, 3600)
+
+        self.wait_for(lambda: len(calls) >= 3)
+
+    def test_delay_from_return(self):
+        """Test that a job can have the delay it returns counted from when it returned"""
+        calls = []
+
+        def job():
+            calls.append(time.time())
+            time.sleep(0.05)
+            return 0.05
+
+        self.scheduler.add("job", job, 3600, delay_from_return=True)
+
+        self.wait_for(lambda: len(calls) >= 3)
+
+        intervals = [b - a for a, b in zip(calls, calls[1:])]
+        self.assertTrue(all(interval >= 0.1 for interval in intervals), intervals)
+
+    def test_never_concurrent(self):
+        """Test that a job is not called again until its previous call returns"""
+        running = []
+        overlaps = []
+        calls = []
+
+        def job():
+            if running:
+                overlaps.append(True)
+            running.append(True)
+            time.sleep(0.05)
+            running.pop()
+            calls.append(True)
+            return 0
+
+        self.scheduler.add("job", job, 0)
+
+        self.wait_for(lambda: len(calls) >= 3)
+        self.assertEqual(overlaps, [])
+
+    def test_wake(self):
+        """Test that wake() runs a job immediately"""
+        called = threading.Event()
+        self.scheduler.add("job", called.set, 3600, delay=3600)
+        self.assertFalse(called.wait(0.1))
+
+        self.scheduler.wake("job")
+
+        self.assertTrue(called.wait(5))
+
+    def test_remove(self):
+        """Test that a removed job is no longer called"""
+        calls = []
+        self.scheduler.add("job", lambda: calls.append(True), 0.01)
+        self.wait_for(lambda: calls)
+
+        self.scheduler.remove("job")
+        time.sleep(0.05)
+        count = len(calls)
+        time.sleep(0.1)
+
+        self.assertEqual(len(calls), count)
+
+    def test_exception(self):
+        """Test that a job raising an exception is still rescheduled"""
+        calls = []
+
+        def job():
+            calls.append(True)
+            raise RuntimeError("Expected error")
+
+        self.scheduler.add("job", job, 0.01)
+
+        self.wait_for(lambda: len(calls) >= 2)
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+
+import unittest
+
+from chroma_agent.lib.spool import Spool
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        super(TestSpool, self).setUp()
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def records(self, spool):
+        return [record for _, record in spool.peek()]
+
+    def test_fifo(self):
+        """Test that records come back in the order they were appended"""
+        spool = Spool(self.path, 1024 * 1024)
+        self.assertTrue(spool.empty)
+
+        spool.append(["one", "two"])
+        spool.append(["three"])
+
+        self.assertFalse(spool.empty)
+        self.assertEqual(self.records(spool), ["one", "two", "three"])
+
+    def test_commit(self):
+        """Test that committed records are removed, and the rest remain"""
+        spool = Spool(self.path, 1024 * 1024, segment_bytes=16)
+        spool.append(["record %s" % index for index in range(10)])
+
+        cursors = [cursor for cursor, _ in spool.peek()]
+        spool.commit(cursors[3])
+        self.assertEqual(
+            self.records(spool), ["record %s" % index for index in range(4, 10)]
+        )
+
+        spool.commit(cursors[-1])
+        self.assertTrue(spool.empty)
+        self.assertEqual(self.records(spool), [])
+        # Fully committed segments are deleted
+        self.assertEqual(
+            len([f for f in os.listdir(self.path) if f.endswith(".seg")]), 1
+        )
+
+    def test_persistence(self):
+        """Test that uncommitted records survive reopening the spool"""
+        spool = Spool(self.path, 1024 * 1024, segment_bytes=16)
+        spool.append(["record %s" % index for index in range(5)])
+        spool.commit([cursor for cursor, _ in spool.peek()][1])
+        spool.close()
+
+        spool = Spool(self.path, 1024 * 1024, segment_bytes=16)
+
+        self.assertEqual(
+            self.records(spool), ["record %s" % index for index in range(2, 5)]
+        )
+
+    def test_torn_record(self):
+        """Test that a record truncated by a crash is discarded when the spool is reopened"""
+        spool = Spool(self.path, 1024 * 1024)
+        spool.append(["complete", "torn record"])
+        spool.close()
+
+        segment = os.path.join(self.path, "%020d.seg" % 0)
+        with open(segment, "r+b") as f:
+            f.truncate(os.path.getsize(segment) - 3)
+
+        spool = Spool(self.path, 1024 * 1024)
+        self.assertEqual(self.records(spool), ["complete"])
+
+        spool.append(["after"])
+        self.assertEqual(self.records(spool), ["complete", "after"])
+
+    def test_oldest_dropped_when_full(self):
+        """Test that when the spool is full the oldest records are dropped"""
+        spool = Spool(self.path, 256, segment_bytes=64)
+        appended = ["%04d" % index + "x" * 20 for index in range(50)]
+        dropped = spool.append(appended)
+
+        records = self.records(spool)
+        self.assertEqual(dropped + records, appended)
+
+        self.assertLessEqual(spool.size, 256)
+        self.assertLess(len(records), 50)
+        self.assertEqual(records[-1][:4], "0049")
+        self.assertEqual(
+            [int(record[:4]) for record in records],
+            range(50 - len(records), 50),
+        )
@@ -0,0 +1,47 @@
+import unittest
+
+from chroma_agent.lib.time_series import RingBuffer, TimeSeriesSet, summarize
+
+
+class TestRingBuffer(unittest.TestCase):
+    def test_wrap(self):
+        """Test that only the last capacity samples are kept, oldest first"""
+        ring = RingBuffer(3)
+        for time in range(5):
+            ring.append(float(time), time * 10.0)
+
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(ring.samples(), [(2.0, 20.0), (3.0, 30.0), (4.0, 40.0)])
+        self.assertEqual(ring.samples(since=3.0), [(3.0, 30.0), (4.0, 40.0)])
+        self.assertEqual(ring.latest_time, 4.0)
+
+
+class TestSummarize(unittest.TestCase):
+    def test_rates(self):
+        summary = summarize([(0.0, 0.0), (1.0, 10.0), (2.0, 40.0), (4.0, 60.0)])
+
+        self.assertEqual(summary["rate"], 15.0)
+        self.assertEqual(summary["min"], 10.0)
+        self.assertEqual(summary["max"], 30.0)
+        self.assertEqual(summary["p50"], 10.0)
+        self.assertEqual(summary["p99"], 30.0)
+        self.assertEqual(summary["samples"], 4)
+
+    def test_reset(self):
+        """Test that an interval in which the counter was reset is left out"""
+        summary = summarize([(0.0, 100.0), (1.0, 5.0), (2.0, 10.0)])
+
+        self.assertEqual(summary["rate"], 5.0)
+        self.assertEqual(summarize([(0.0, 100.0)]), None)
+
+
+class TestTimeSeriesSet(unittest.TestCase):
+    def test_summary(self):
+        series = TimeSeriesSet(8)
+        series.add(0.0, {"a": 0, "b": 0})
+        series.add(1.0, {"a": 10, "b": 0})
+        series.add(2.0, {"a": 30})
+
+        self.assertEqual(series.summary().keys(), ["a"])
+        self.assertEqual(series.summary(since=1.0)["a"]["rate"], 20.0)
+        self.assertEqual(series.latest_time, 2.0)
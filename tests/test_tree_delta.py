@@ -0,0 +1,58 @@
+import random
+
+import unittest
+
+from chroma_agent.lib import tree_delta
+
+
+def random_tree(rng, depth=3):
+    tree = {}
+    for key in rng.sample("abcdef", rng.randint(0, 4)):
+        if depth and rng.random() < 0.4:
+            tree[key] = random_tree(rng, depth - 1)
+        else:
+            tree[key] = rng.choice([0, 1, 2, "x", None, [1, 2]])
+    return tree
+
+
+class TestTreeDelta(unittest.TestCase):
+    def test_diff(self):
+        old = {"a": 1, "b": {"c": 1, "d": 1}, "e": {"f": 1}}
+        new = {"a": 1, "b": {"c": 2}, "e": 3, "g": {}}
+
+        self.assertEqual(
+            tree_delta.diff(old, new),
+            {
+                "changed": {"b": {"c": 2}, "e": 3, "g": {}},
+                "removed": [["b", "d"], ["e"]],
+            },
+        )
+        self.assertEqual(tree_delta.apply(old, tree_delta.diff(old, new)), new)
+        self.assertEqual(tree_delta.diff(new, new), None)
+
+    def test_compose(self):
+        """Test that composing deltas is the same as applying them in turn"""
+        rng = random.Random(0)
+
+        for _ in range(500):
+            first, second, third = [random_tree(rng) for _ in range(3)]
+            earlier = {
+                "delta": tree_delta.diff(first, second) or tree_delta.diff({}, {"z": 0})
+            }
+            later = {
+                "delta": tree_delta.diff(second, third) or tree_delta.diff({}, {"z": 1})
+            }
+            expected = tree_delta.apply(
+                tree_delta.apply(first, earlier["delta"]), later["delta"]
+            )
+
+            composed = tree_delta.compose(earlier, later)
+            self.assertTrue(tree_delta.is_delta(composed))
+            self.assertEqual(tree_delta.apply(first, composed["delta"]), expected)
+
+            # A whole tree followed by a delta is a whole tree
+            self.assertEqual(
+                tree_delta.compose(first, later),
+                tree_delta.apply(first, later["delta"]),
+            )
+            self.assertEqual(tree_delta.compose(earlier, third), third)
@@ -35,7 +35,25 @@ class PatchedContextTestCase(unittest.TestCase):
             "chroma_agent.device_plugins.audit.mixins.LustreGetParamMixin.list_params",
             self.mock_list_params,
         ).start()
+        mock.patch(
+            "chroma_agent.device_plugins.audit.mixins.LustreGetParamMixin.stream_params",
+            self.mock_stream_params,
+        ).start()
+        # Params are read from the fixture files as they are used, there is nothing to fetch first
+        mock.patch(
+            "chroma_agent.device_plugins.audit.mixins.LustreGetParamMixin.prefetch_params"
+        ).start()
         self.addCleanup(mock.patch.stopall)
+
+        # Audits keep collectors from scan to scan, start each test without them
+        from chroma_agent.device_plugins.audit.lustre import LustreAudit
+
+        for collectors in [
+            LustreAudit._job_stats_collectors,
+            LustreAudit._brw_stats_collectors,
+            LustreAudit._export_stats_collectors,
+        ]:
+            self.addCleanup(collectors.clear)
         super(PatchedContextTestCase, self).setUp()
 
     def _find_subclasses(self, klass):
@@ -93,6 +111,13 @@ class PatchedContextTestCase(unittest.TestCase):
                 ["lctl", "get_param", "-n", path],
             )
 
+    def mock_stream_params(self, path):
+        param = path.replace("/", ".")
+        daemon_log.info("mock_stream_params: " + param)
+        for fn in sorted(glob(param)):
+            with open(fn, "r") as content_file:
+                yield fn, iter(content_file.read().splitlines())
+
     def mock_list_params(self, path):
         fl = glob(path)
         if fl: